@@ -1,7 +1,9 @@
 import sqlite3
 import uuid
 import datetime
+import queue
 import threading
+from contextlib import contextmanager
 from enum import Enum
 
 class RequestStatus(Enum):
@@ -9,49 +11,204 @@ class RequestStatus(Enum):
   COMPLETED = 1
   FAILED = 2
 
+# row layout of the REQUESTS table, the request stores return rows as tuples in this order
+COLUMNS = ['id', 'requestid', 'input', 'status', 'utctime', 'queuetime', 'computetime']
+
 class API_DB:
-  conn = None
-  lock = threading.Lock()
-  def __init__(self, db_path):
-    self.conn = sqlite3.connect(db_path, check_same_thread=False)
-    with self.conn:
-      self.conn.execute("""
+  """
+  SQLite request store. The db runs in WAL mode so that status checks are not blocked by writes,
+  requests are looked up through an index on requestid and connections are taken from a pool that
+  is shared by all request threads. Status updates are queued and written in batches by a writer
+  thread, pending updates are already visible to check_request.
+  """
+
+  def __init__(self, db_path, pool_size=8, write_batch_size=256, write_interval_ms=50):
+    self.db_path = str(db_path)
+    self.pool_size = pool_size
+    self.write_batch_size = write_batch_size
+    self.write_interval_ms = write_interval_ms
+    self.pool = queue.LifoQueue()
+    self.num_connections = 0
+    self.pool_lock = threading.Lock()
+
+    self.pending_lock = threading.Lock()
+    self.pending_updates = {}
+    self.write_event = threading.Event()
+    self.flushed = threading.Condition(self.pending_lock)
+
+    with self.connection() as conn:
+      conn.execute("PRAGMA journal_mode=WAL;")
+      conn.execute("""
         CREATE TABLE IF NOT EXISTS REQUESTS (
           id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
           requestid TEXT NOT NULL,
           input TEXT NOT NULL,
           status INTEGER NOT NULL,
-          utctime INTEGER NOT NULL
+          utctime INTEGER NOT NULL,
+          queuetime REAL,
+          computetime REAL
         );
       """)
-    
+      columns = [row[1] for row in conn.execute("PRAGMA table_info(REQUESTS);")]
+      for column in ['queuetime', 'computetime']:
+        if column not in columns:
+          conn.execute(f"ALTER TABLE REQUESTS ADD COLUMN {column} REAL;")
+      conn.execute("CREATE INDEX IF NOT EXISTS REQUESTS_REQUESTID ON REQUESTS (requestid);")
+      conn.execute("CREATE INDEX IF NOT EXISTS REQUESTS_UTCTIME ON REQUESTS (utctime);")
+
+    self.writer = threading.Thread(target=self._write_updates, name='api-db-writer', daemon=True)
+    self.writer.start()
+
+  def _connect(self):
+    conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+    # in WAL mode a commit only needs to reach the log, which is synced at checkpoints
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    return conn
+
+  @contextmanager
+  def connection(self):
+    """ Takes a connection from the pool, the changes are committed when the block is left. """
+    try:
+      conn = self.pool.get_nowait()
+    except queue.Empty:
+      with self.pool_lock:
+        create = self.num_connections < self.pool_size
+        self.num_connections += 1 if create else 0
+      conn = self._connect() if create else self.pool.get()
+    try:
+      with conn:
+        yield conn
+    finally:
+      self.pool.put(conn)
+
+  def add_request(self, text):
+    request_id = str(uuid.uuid4())
+    status = RequestStatus.PENDING
+    timestamp = int(datetime.datetime.utcnow().timestamp())
+    with self.connection() as conn:
+      conn.execute("INSERT INTO REQUESTS (requestid, input, status, utctime) VALUES(?, ?, ?, ?);",
+                   (request_id, text, status.value, timestamp))
+    return (request_id, status)
+
+  def check_request(self, request_id):
+    with self.connection() as conn:
+      row = conn.execute("SELECT * FROM REQUESTS WHERE requestid = ?", (request_id,)).fetchone()
+    with self.pending_lock:
+      update = self.pending_updates.get(request_id)
+    if row is not None and update is not None:
+      row = self._apply_update(row, update)
+    return row
+
+  def update_request_status(self, request_id, status, queue_time=None, compute_time=None):
+    with self.pending_lock:
+      previous = self.pending_updates.get(request_id)
+      if previous is not None:
+        queue_time = queue_time if queue_time is not None else previous[1]
+        compute_time = compute_time if compute_time is not None else previous[2]
+      self.pending_updates[request_id] = (status, queue_time, compute_time)
+      num_pending = len(self.pending_updates)
+    if num_pending >= self.write_batch_size:
+      self.write_event.set()
+
+  def delete_requests_before(self, timestamp, limit=1000):
+    """ Deletes at most limit requests older than the utc timestamp, returns the number of deleted rows. """
+    with self.connection() as conn:
+      cur = conn.execute("""DELETE FROM REQUESTS WHERE id IN
+                            (SELECT id FROM REQUESTS WHERE utctime < ? ORDER BY utctime LIMIT ?);""", (timestamp, limit))
+      return cur.rowcount
+
+  def vacuum(self):
+    """ Returns the space of deleted rows to the file system. """
+    with self.connection() as conn:
+      conn.execute("VACUUM;")
+      conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+  def flush(self):
+    """ Blocks until all queued status updates are written. """
+    with self.pending_lock:
+      while len(self.pending_updates) > 0:
+        self.write_event.set()
+        self.flushed.wait(timeout=1.)
+
+  def _write_updates(self):
+    while True:
+      self.write_event.wait(self.write_interval_ms / 1000.)
+      self.write_event.clear()
+      with self.pending_lock:
+        updates = dict(self.pending_updates)
+      if len(updates) == 0:
+        continue
+      rows = [(status.value, queue_time, compute_time, request_id)
+              for request_id, (status, queue_time, compute_time) in updates.items()]
+      try:
+        with self.connection() as conn:
+          conn.executemany("""UPDATE REQUESTS
+                              SET status = ?,
+                                  queuetime = COALESCE(?, queuetime),
+                                  computetime = COALESCE(?, computetime)
+                              WHERE requestid = ?""", rows)
+      except sqlite3.Error as e:
+        print(f'Could not write {len(rows)} status updates, retrying: {e}')
+        continue
+      with self.pending_lock:
+        # keep updates that were replaced while writing
+        for request_id, update in updates.items():
+          if self.pending_updates.get(request_id) is update:
+            del self.pending_updates[request_id]
+        self.flushed.notify_all()
+
+  @staticmethod
+  def _apply_update(row, update):
+    status, queue_time, compute_time = update
+    row = list(row)
+    row[3] = status.value
+    row[5] = queue_time if queue_time is not None else row[5]
+    row[6] = compute_time if compute_time is not None else row[6]
+    return tuple(row)
+
+class MemoryRequestStore:
+  """ Request store that only keeps the requests in memory, for deployments without persistent request history. """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.rows = {}
+    self.next_id = 1
+
   def add_request(self, text):
     request_id = str(uuid.uuid4())
     status = RequestStatus.PENDING
     timestamp = int(datetime.datetime.utcnow().timestamp())
-    with self.conn:
-      self.lock.acquire()
-      self.conn.execute(f"INSERT INTO REQUESTS (requestid, input, status, utctime) VALUES(?, ?, ?, ?);", (request_id, text, status.value, timestamp))
-      self.lock.release()
+    with self.lock:
+      self.rows[request_id] = (self.next_id, request_id, text, status.value, timestamp, None, None)
+      self.next_id += 1
     return (request_id, status)
 
   def check_request(self, request_id):
-    with self.conn:
-      self.lock.acquire()
-      data = self.conn.execute(f"SELECT * FROM REQUESTS WHERE requestid = ?", (request_id,))
-      self.lock.release()
-      for row in data:
-        return row
-      return None
-
-  def update_request_status(self, request_id, status):
-    with self.conn:
-      self.lock.acquire()
-      ex = f"""UPDATE REQUESTS
-               SET status = ?
-               WHERE requestid = ?"""
-      cur = self.conn.cursor()
-      cur.execute(ex, (status.value, request_id))
-      self.conn.commit()
-      self.lock.release()
+    with self.lock:
+      return self.rows.get(request_id)
+
+  def update_request_status(self, request_id, status, queue_time=None, compute_time=None):
+    with self.lock:
+      row = self.rows.get(request_id)
+      if row is not None:
+        self.rows[request_id] = API_DB._apply_update(row, (status, queue_time, compute_time))
+
+  def delete_requests_before(self, timestamp, limit=1000):
+    with self.lock:
+      request_ids = [request_id for request_id, row in self.rows.items() if row[4] < timestamp][:limit]
+      for request_id in request_ids:
+        del self.rows[request_id]
+    return len(request_ids)
+
+  def vacuum(self):
+    pass
+
+  def flush(self):
+    pass
 
+def create_request_store(backend, db_path):
+  if backend == 'sqlite':
+    return API_DB(db_path)
+  elif backend == 'memory':
+    return MemoryRequestStore()
+  raise ValueError(f'Request store not supported: {backend}! Currently supported: [\'sqlite\', \'memory\']')
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Union
+
+from utils.files import pickle_binary, unpickle_binary
+
+_whitespace_re = re.compile(r'\s+')
+
+
+def checkpoint_id(path: Union[str, Path]) -> str:
+  """ Identity of a checkpoint file, changes whenever the file is replaced. """
+  path = Path(path).resolve()
+  stat = path.stat()
+  return f'{path}:{stat.st_mtime_ns}:{stat.st_size}'
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copyfile(src, dst)
+
+
+class AudioCache:
+  """
+  Persistent content-addressed cache of synthesized wavs. Every entry is keyed by a hash of the model
+  identity, the normalized text and the generation parameters and stored as <key>.wav in cache_dir.
+  The least recently used entries are evicted once the total size exceeds max_size_bytes.
+  """
+
+  def __init__(self, cache_dir: Union[str, Path], max_size_bytes: int):
+    self.cache_dir = Path(cache_dir)
+    self.cache_dir.mkdir(parents=True, exist_ok=True)
+    self.index_path = self.cache_dir / 'index.pkl'
+    self.max_size_bytes = max_size_bytes
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.entries: OrderedDict = OrderedDict()
+    if self.index_path.is_file():
+      try:
+        entries = unpickle_binary(self.index_path)
+        self.entries = OrderedDict((k, size) for k, size in entries.items() if self._path(k).is_file())
+      except Exception as e:
+        print(f'Could not load audio cache index, starting with an empty cache: {e}')
+    self.size_bytes = sum(self.entries.values())
+
+  @staticmethod
+  def key(model_id: str, text: str, params: Dict[str, Any]) -> str:
+    text = _whitespace_re.sub(' ', text).strip()
+    data = json.dumps([model_id, text, params], sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+  def get(self, key: str, target_path: Union[str, Path]) -> bool:
+    """ Writes the cached wav of the key to target_path, returns False on a cache miss. """
+    with self.lock:
+      if key not in self.entries:
+        self.misses += 1
+        return False
+      self.entries.move_to_end(key)
+      try:
+        # the wav is copied instead of linked, so that it gets its own mtime and the maintenance
+        # expires it by the time it was served instead of the time the cache entry was synthesized
+        shutil.copyfile(self._path(key), Path(target_path))
+      except OSError as e:
+        print(f'Could not read cached wav {key}: {e}')
+        self._remove(key)
+        self.misses += 1
+        return False
+      self.hits += 1
+      return True
+
+  def put(self, key: str, wav_path: Union[str, Path]) -> None:
+    with self.lock:
+      if key in self.entries:
+        self.entries.move_to_end(key)
+        return
+      cache_path = self._path(key)
+      try:
+        link_or_copy(Path(wav_path), cache_path)
+      except OSError as e:
+        print(f'Could not cache wav {wav_path}: {e}')
+        return
+      self.entries[key] = cache_path.stat().st_size
+      self.size_bytes += self.entries[key]
+      while self.size_bytes > self.max_size_bytes and len(self.entries) > 0:
+        self._remove(next(iter(self.entries)))
+        self.evictions += 1
+      self._save_index()
+
+  def stats(self) -> Dict[str, int]:
+    with self.lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'entries': len(self.entries),
+        'size_bytes': self.size_bytes,
+        'max_size_bytes': self.max_size_bytes
+      }
+
+  def _path(self, key: str) -> Path:
+    return self.cache_dir / f'{key}.wav'
+
+  def _remove(self, key: str) -> None:
+    self.size_bytes -= self.entries.pop(key)
+    try:
+      self._path(key).unlink()
+    except FileNotFoundError:
+      pass
+
+  def _save_index(self) -> None:
+    tmp_path = self.index_path.with_suffix('.tmp')
+    pickle_binary(dict(self.entries), tmp_path)
+    os.replace(tmp_path, self.index_path)
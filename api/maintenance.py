@@ -0,0 +1,128 @@
+import datetime
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Union
+
+
+class MaintenanceService:
+  """
+  Background thread that bounds the disk usage of a long running API. Every interval_s seconds it
+  deletes the wavs in output_path that are older than wav_ttl_s, then the oldest wavs until at most
+  max_output_bytes are used, and finally the request rows older than request_ttl_s. Rows are deleted
+  in batches of batch_size, so request threads only wait for one small transaction at a time, and the
+  db is vacuumed once vacuum_after_rows rows have been deleted. A limit of 0 disables the step.
+  Subdirectories of output_path (e.g. the audio cache) are left alone.
+  """
+
+  def __init__(self,
+               store: Any,
+               output_path: Union[str, Path],
+               wav_ttl_s: float = 0,
+               max_output_bytes: int = 0,
+               request_ttl_s: float = 0,
+               interval_s: float = 300,
+               batch_size: int = 1000,
+               vacuum_after_rows: int = 100000):
+    self.store = store
+    self.output_path = Path(output_path)
+    self.wav_ttl_s = wav_ttl_s
+    self.max_output_bytes = max_output_bytes
+    self.request_ttl_s = request_ttl_s
+    self.interval_s = interval_s
+    self.batch_size = batch_size
+    self.vacuum_after_rows = vacuum_after_rows
+    self.lock = threading.Lock()
+    self.thread = None
+    self.metrics = {
+      'runs': 0,
+      'deleted_files': 0,
+      'reclaimed_bytes': 0,
+      'deleted_rows': 0,
+      'vacuums': 0,
+      'output_bytes': 0,
+      'last_run_seconds': 0.,
+      'last_run_at': None
+    }
+    self.rows_since_vacuum = 0
+
+  def start(self) -> None:
+    self.thread = threading.Thread(target=self._run, name='api-maintenance', daemon=True)
+    self.thread.start()
+
+  def stats(self) -> Dict[str, Any]:
+    with self.lock:
+      return dict(self.metrics)
+
+  def run_once(self) -> Dict[str, Any]:
+    start = time.time()
+    deleted_files, reclaimed_bytes, output_bytes = self._delete_wavs(now=start)
+    deleted_rows = self._delete_rows()
+    vacuumed = False
+    self.rows_since_vacuum += deleted_rows
+    if self.vacuum_after_rows > 0 and self.rows_since_vacuum >= self.vacuum_after_rows:
+      self.store.vacuum()
+      self.rows_since_vacuum = 0
+      vacuumed = True
+    with self.lock:
+      self.metrics['runs'] += 1
+      self.metrics['deleted_files'] += deleted_files
+      self.metrics['reclaimed_bytes'] += reclaimed_bytes
+      self.metrics['deleted_rows'] += deleted_rows
+      self.metrics['vacuums'] += int(vacuumed)
+      self.metrics['output_bytes'] = output_bytes
+      self.metrics['last_run_seconds'] = time.time() - start
+      self.metrics['last_run_at'] = datetime.datetime.now()
+      return dict(self.metrics)
+
+  def _run(self) -> None:
+    while True:
+      try:
+        self.run_once()
+      except Exception as e:
+        print(f'Maintenance run failed: {e}')
+      time.sleep(self.interval_s)
+
+  def _list_wavs(self) -> List[tuple]:
+    wavs = []
+    for path in self.output_path.glob('*.wav'):
+      try:
+        stat = path.stat()
+      except FileNotFoundError:
+        continue
+      wavs.append((stat.st_mtime, path, stat.st_size, stat.st_nlink))
+    return sorted(wavs)
+
+  def _delete_wavs(self, now: float) -> tuple:
+    wavs = self._list_wavs()
+    total_bytes = sum(size for _, _, size, _ in wavs)
+    deleted_files, reclaimed_bytes = 0, 0
+    for mtime, path, size, nlink in wavs:
+      expired = self.wav_ttl_s > 0 and now - mtime > self.wav_ttl_s
+      over_quota = self.max_output_bytes > 0 and total_bytes > self.max_output_bytes
+      if not (expired or over_quota):
+        # the wavs are sorted by age, so all remaining ones are younger and within the quota
+        break
+      try:
+        path.unlink()
+      except FileNotFoundError:
+        continue
+      total_bytes -= size
+      deleted_files += 1
+      # wavs that are hard linked into the audio cache keep their data on disk
+      reclaimed_bytes += size if nlink == 1 else 0
+    return deleted_files, reclaimed_bytes, total_bytes
+
+  def _delete_rows(self) -> int:
+    if self.request_ttl_s <= 0:
+      return 0
+    # same clock as the utctime column of the request store
+    timestamp = int(datetime.datetime.utcnow().timestamp() - self.request_ttl_s)
+    deleted_rows = 0
+    while True:
+      num_deleted = self.store.delete_requests_before(timestamp, limit=self.batch_size)
+      deleted_rows += num_deleted
+      if num_deleted < self.batch_size:
+        return deleted_rows
+      # give the request threads a chance to write between the batches
+      time.sleep(0.01)
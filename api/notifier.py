@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from api.api_db import RequestStatus
+
+
+class _Entry:
+  def __init__(self, status: RequestStatus):
+    self.status = status
+    self.done = threading.Event()
+
+
+class StatusNotifier:
+  """
+  In-process channel for the status of TTS requests. The API publishes new requests as PENDING
+  and the workers publish the final status, which wakes up every thread waiting for the request.
+  Only the max_entries most recent requests are kept, older ones have to be looked up in the db.
+  """
+
+  def __init__(self, max_entries: int = 10000):
+    self.max_entries = max_entries
+    self.lock = threading.Lock()
+    self.entries: OrderedDict = OrderedDict()
+
+  def publish(self, request_id: str, status: RequestStatus) -> None:
+    with self.lock:
+      entry = self.entries.get(request_id)
+      if entry is None:
+        entry = _Entry(status)
+        self.entries[request_id] = entry
+        while len(self.entries) > self.max_entries:
+          self.entries.popitem(last=False)
+      entry.status = status
+    if status != RequestStatus.PENDING:
+      entry.done.set()
+
+  def status(self, request_id: str) -> Optional[RequestStatus]:
+    """ Returns the status of the request or None if the request is unknown. """
+    with self.lock:
+      entry = self.entries.get(request_id)
+    return entry.status if entry is not None else None
+
+  def wait(self, request_id: str, timeout: float) -> Optional[RequestStatus]:
+    """
+    Blocks until the request is finished or the timeout (in seconds) is over and returns the
+    latest status, or None if the request is unknown.
+    """
+    with self.lock:
+      entry = self.entries.get(request_id)
+    if entry is None:
+      return None
+    entry.done.wait(timeout)
+    return entry.status
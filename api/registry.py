@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List
+
+import torch
+
+
+def module_memory(module: torch.nn.Module) -> int:
+  """ Bytes used by the parameters and buffers of a torch module. """
+  tensors = list(module.parameters()) + list(module.buffers())
+  return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def generator_memory(generator: Any) -> int:
+  # the vocoder is shared between the generators and not counted here
+  return module_memory(generator.tts_model)
+
+
+class ModelRegistry:
+  """
+  Loads models on first use and keeps at most max_models of them resident. Once max_models or
+  max_memory_bytes (if > 0) is exceeded, the least recently used models are evicted. Evicted models
+  stay valid for callers that still hold a reference and are freed once they are done.
+
+  Objects that can be used by several models (e.g. a vocoder) are created once with shared().
+  """
+
+  def __init__(self,
+               max_models: int = 0,
+               max_memory_bytes: int = 0,
+               memory_func: Callable[[Any], int] = generator_memory):
+    self.max_models = max_models
+    self.max_memory_bytes = max_memory_bytes
+    self.memory_func = memory_func
+    self.factories: Dict[str, Callable[[], Any]] = {}
+    self.models: OrderedDict = OrderedDict()
+    self.sizes: Dict[str, int] = {}
+    self.shared_objects: Dict[Hashable, Any] = {}
+    self.lock = threading.Lock()
+    self.load_locks: Dict[Hashable, threading.Lock] = {}
+    self.loads = 0
+    self.evictions = 0
+
+  def register(self, name: str, factory: Callable[[], Any]) -> None:
+    self.factories[name] = factory
+    self.load_locks[name] = threading.Lock()
+
+  def names(self) -> List[str]:
+    return list(self.factories.keys())
+
+  def __contains__(self, name: str) -> bool:
+    return name in self.factories
+
+  def get(self, name: str) -> Any:
+    with self.lock:
+      if name in self.models:
+        self.models.move_to_end(name)
+        return self.models[name]
+    # only one thread loads a model, the others wait for it
+    with self.load_locks[name]:
+      with self.lock:
+        if name in self.models:
+          self.models.move_to_end(name)
+          return self.models[name]
+      print(f'Loading model {name}.')
+      model = self.factories[name]()
+      size = self.memory_func(model)
+      with self.lock:
+        self.models[name] = model
+        self.sizes[name] = size
+        self.loads += 1
+        self._evict(keep=name)
+      return model
+
+  def shared(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+    """ Returns the object for the key, it is created by the factory on first use. """
+    with self.lock:
+      if key in self.shared_objects:
+        return self.shared_objects[key]
+      load_lock = self.load_locks.setdefault(key, threading.Lock())
+    with load_lock:
+      with self.lock:
+        if key in self.shared_objects:
+          return self.shared_objects[key]
+      obj = factory()
+      with self.lock:
+        self.shared_objects[key] = obj
+      return obj
+
+  def stats(self) -> Dict[str, Any]:
+    with self.lock:
+      return {
+        'loaded_models': list(self.models.keys()),
+        'memory_bytes': sum(self.sizes.values()),
+        'max_models': self.max_models,
+        'max_memory_bytes': self.max_memory_bytes,
+        'loads': self.loads,
+        'evictions': self.evictions
+      }
+
+  def _evict(self, keep: str) -> None:
+    while len(self.models) > 1:
+      too_many = self.max_models > 0 and len(self.models) > self.max_models
+      too_large = self.max_memory_bytes > 0 and sum(self.sizes.values()) > self.max_memory_bytes
+      if not (too_many or too_large):
+        break
+      name = next(n for n in self.models if n != keep)
+      print(f'Evicting model {name}.')
+      del self.models[name]
+      del self.sizes[name]
+      self.evictions += 1
@@ -0,0 +1,110 @@
+import queue
+import threading
+import time
+from typing import Callable, Dict, Any, List
+
+
+class QueueFullError(Exception):
+  pass
+
+
+class Job:
+  def __init__(self, request_id: str, model_name: str, params: Dict[str, Any]):
+    self.request_id = request_id
+    self.model_name = model_name
+    self.params = params
+    self.enqueued_at = time.time()
+    self.started_at = None
+    self.finished_at = None
+    self.result = None
+
+  @property
+  def queue_time(self) -> float:
+    return self.started_at - self.enqueued_at
+
+  @property
+  def compute_time(self) -> float:
+    return self.finished_at - self.started_at
+
+
+class JobScheduler:
+  """
+  Bounded job queue with a fixed pool of inference workers per model.
+  Jobs are rejected with a QueueFullError instead of piling up once the
+  queue of a model is full, so latency stays bounded under load.
+
+  Workers hand the jobs to run_batch in micro-batches: after taking a job a
+  worker waits up to max_batch_wait_ms for more jobs of the same model, until
+  max_batch_size jobs are collected. run_batch returns one result per job.
+  """
+
+  def __init__(self,
+               run_batch: Callable[[List[Job]], List[Any]],
+               on_finished: Callable[[Job], None],
+               workers_per_model: int = 1,
+               max_queue_size: int = 32,
+               max_batch_size: int = 1,
+               max_batch_wait_ms: float = 0.):
+    self.run_batch = run_batch
+    self.on_finished = on_finished
+    self.workers_per_model = workers_per_model
+    self.max_queue_size = max_queue_size
+    self.max_batch_size = max_batch_size
+    self.max_batch_wait_ms = max_batch_wait_ms
+    self.queues: Dict[str, queue.Queue] = {}
+    self.workers: List[threading.Thread] = []
+
+  def add_model(self, model_name: str) -> None:
+    if model_name in self.queues:
+      return
+    job_queue = queue.Queue(maxsize=self.max_queue_size)
+    self.queues[model_name] = job_queue
+    for i in range(self.workers_per_model):
+      worker = threading.Thread(target=self._work, args=(job_queue,),
+                                name=f'tts-worker-{model_name}-{i}', daemon=True)
+      worker.start()
+      self.workers.append(worker)
+
+  def submit(self, job: Job) -> None:
+    try:
+      self.queues[job.model_name].put_nowait(job)
+    except queue.Full:
+      raise QueueFullError(f'Job queue for model {job.model_name} is full.')
+
+  def queue_sizes(self) -> Dict[str, int]:
+    return {name: q.qsize() for name, q in self.queues.items()}
+
+  def _collect_batch(self, job_queue: queue.Queue) -> List[Job]:
+    jobs = [job_queue.get()]
+    deadline = time.time() + self.max_batch_wait_ms / 1000.
+    while len(jobs) < self.max_batch_size:
+      timeout = deadline - time.time()
+      try:
+        if timeout > 0:
+          jobs.append(job_queue.get(timeout=timeout))
+        else:
+          jobs.append(job_queue.get_nowait())
+      except queue.Empty:
+        break
+    return jobs
+
+  def _work(self, job_queue: queue.Queue) -> None:
+    while True:
+      jobs = self._collect_batch(job_queue)
+      started_at = time.time()
+      for job in jobs:
+        job.started_at = started_at
+      try:
+        results = self.run_batch(jobs)
+        for job, result in zip(jobs, results):
+          job.result = result
+      except Exception as e:
+        print(f'Batch of {len(jobs)} jobs raised an exception: {e}')
+      finished_at = time.time()
+      for job in jobs:
+        job.finished_at = finished_at
+        try:
+          self.on_finished(job)
+        except Exception as e:
+          print(f'Could not finish job {job.request_id}: {e}')
+        job_queue.task_done()
@@ -0,0 +1,29 @@
+import struct
+from typing import Iterator
+
+import numpy as np
+
+# data size used in the header of a wav stream whose length is not known up front
+STREAM_DATA_SIZE = 0xFFFFFFFF - 36
+
+
+def wav_stream_header(sample_rate: int, channels: int = 1, bits: int = 16) -> bytes:
+  """ Header of a PCM wav stream with unknown length, players read the data until the stream ends. """
+  block_align = channels * bits // 8
+  return b''.join([
+    b'RIFF', struct.pack('<I', STREAM_DATA_SIZE + 36), b'WAVE',
+    b'fmt ', struct.pack('<IHHIIHH', 16, 1, channels, sample_rate, sample_rate * block_align, block_align, bits),
+    b'data', struct.pack('<I', STREAM_DATA_SIZE)
+  ])
+
+
+def to_pcm16(wav: np.array) -> bytes:
+  wav = np.clip(wav, -1., 1.)
+  return (wav * 32767).astype('<i2').tobytes()
+
+
+def wav_stream(chunks: Iterator[np.array], sample_rate: int) -> Iterator[bytes]:
+  yield wav_stream_header(sample_rate)
+  for chunk in chunks:
+    if len(chunk) > 0:
+      yield to_pcm16(chunk)
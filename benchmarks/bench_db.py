@@ -0,0 +1,80 @@
+import argparse
+import datetime
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from api.api_db import API_DB, MemoryRequestStore, RequestStatus
+from utils.display import simple_table
+
+
+def fill_db(db_path: Path, num_rows: int, batch_size: int = 100_000) -> list:
+    """ Bulk inserts num_rows requests and returns their request ids. """
+    conn = sqlite3.connect(str(db_path))
+    timestamp = int(datetime.datetime.utcnow().timestamp())
+    request_ids = []
+    for start in range(0, num_rows, batch_size):
+        rows = [(str(uuid.uuid4()), 'benchmark text', RequestStatus.COMPLETED.value, timestamp)
+                for _ in range(min(batch_size, num_rows - start))]
+        request_ids += [row[0] for row in rows]
+        with conn:
+            conn.executemany('INSERT INTO REQUESTS (requestid, input, status, utctime) VALUES(?, ?, ?, ?);', rows)
+    conn.close()
+    return request_ids
+
+
+def time_status_checks(store, request_ids: list, num_checks: int) -> np.array:
+    times = []
+    for request_id in random.sample(request_ids, num_checks):
+        start = time.perf_counter()
+        store.check_request(request_id)
+        times.append(time.perf_counter() - start)
+    return np.array(times) * 1000.
+
+
+def time_status_updates(store, request_ids: list, num_updates: int) -> float:
+    start = time.perf_counter()
+    for request_id in random.sample(request_ids, num_updates):
+        store.update_request_status(request_id, RequestStatus.COMPLETED, queue_time=0.1, compute_time=1.)
+    store.flush()
+    return (time.perf_counter() - start) / num_updates * 1000.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks status checks of the API request stores.')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Number of stored requests.')
+    parser.add_argument('--checks', type=int, default=1000, help='Number of timed status checks.')
+    parser.add_argument('--unindexed_checks', type=int, default=20, help='Number of timed checks without index.')
+    args = parser.parse_args()
+
+    random.seed(42)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir) / 'bench.db'
+        store = API_DB(db_path)
+        print(f'Inserting {args.rows} rows...')
+        request_ids = fill_db(db_path, args.rows)
+
+        times = time_status_checks(store, request_ids, args.checks)
+        results.append(('sqlite check p50/p99 ms', f'{np.median(times):.3f}/{np.percentile(times, 99):.3f}'))
+        results.append(('sqlite update ms', f'{time_status_updates(store, request_ids, args.checks):.3f}'))
+
+        with store.connection() as conn:
+            conn.execute('DROP INDEX REQUESTS_REQUESTID;')
+        times = time_status_checks(store, request_ids, args.unindexed_checks)
+        results.append(('no index check p50 ms', f'{np.median(times):.3f}'))
+
+    memory_store = MemoryRequestStore()
+    request_ids = [memory_store.add_request('benchmark text')[0] for _ in range(args.rows)]
+    times = time_status_checks(memory_store, request_ids, args.checks)
+    results.append(('memory check p50/p99 ms', f'{np.median(times):.3f}/{np.percentile(times, 99):.3f}'))
+
+    simple_table([('Rows', args.rows)] + results)
@@ -0,0 +1,76 @@
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from utils.dataset import ForwardDataset, VocoderDataset
+from utils.feature_store import pack_feature
+from utils.text.tokenizer import Tokenizer
+
+FORWARD_FEATURES = ['mel', 'alg', 'phon_pitch', 'phon_energy']
+
+
+def create_data(path: Path, num_items: int, hop_length: int) -> None:
+    """ Writes random features with one .npy file per item. """
+    rng = np.random.RandomState(42)
+    for feature in FORWARD_FEATURES + ['quant']:
+        (path / feature).mkdir(parents=True)
+    for i in range(num_items):
+        mel_len, x_len = rng.randint(200, 800), rng.randint(50, 200)
+        np.save(path / 'mel' / f'{i}.npy', rng.randn(80, mel_len).astype(np.float32))
+        np.save(path / 'quant' / f'{i}.npy', rng.randint(0, 2 ** 9, mel_len * hop_length).astype(np.uint16))
+        np.save(path / 'alg' / f'{i}.npy', rng.randint(0, 10, x_len))
+        np.save(path / 'phon_pitch' / f'{i}.npy', rng.randn(x_len).astype(np.float32))
+        np.save(path / 'phon_energy' / f'{i}.npy', rng.randn(x_len).astype(np.float32))
+
+
+def time_dataset(dataset, num_items: int) -> float:
+    order = np.random.RandomState(0).permutation(num_items)
+    start = time.perf_counter()
+    for i in order:
+        item = dataset[i]
+        # touch the data, memmap slices are read lazily
+        float(np.sum(item['mel']))
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares loading items from .npy files and packed shard files.')
+    parser.add_argument('--data_path', type=str, default=None, help='Directory for the benchmark data, should be '
+                                                                    'on the file system to test, defaults to a temp dir.')
+    parser.add_argument('--num_items', type=int, default=1000, help='Number of random items.')
+    parser.add_argument('--hop_length', type=int, default=256, help='Hop length of the random quant files.')
+    args = parser.parse_args()
+
+    root = Path(tempfile.mkdtemp(prefix='BenchFeatureStore', dir=args.data_path))
+    try:
+        npy_path, packed_path = root / 'npy', root / 'packed'
+        create_data(npy_path, args.num_items, args.hop_length)
+        shutil.copytree(npy_path, packed_path)
+        for feature in FORWARD_FEATURES + ['quant']:
+            pack_feature(packed_path / feature)
+
+        ids = [str(i) for i in range(args.num_items)]
+        text_dict = {item_id: 'abc' for item_id in ids}
+        rows = []
+        for name, path in [('npy files', npy_path), ('packed', packed_path)]:
+            forward_dataset = ForwardDataset(path=path, dataset_ids=ids, text_dict=text_dict, tokenizer=Tokenizer())
+            voc_dataset = VocoderDataset(path=path, dataset_ids=ids)
+            voc_window_dataset = VocoderDataset(path=path, dataset_ids=ids, hop_length=args.hop_length,
+                                                voc_pad=2, voc_seq_len=args.hop_length * 5)
+            forward_s = time_dataset(forward_dataset, args.num_items)
+            voc_s = time_dataset(voc_dataset, args.num_items)
+            voc_window_s = time_dataset(voc_window_dataset, args.num_items)
+            rows.append(f'{name:>9} | {forward_s:>9.3f} | {voc_s:>9.3f} | {voc_window_s:>16.3f}')
+
+        print(f'Items: {args.num_items}, data dir: {root} (page cache is not dropped between runs)')
+        print('   Layout | Forward s | Vocoder s | Vocoder window s')
+        print('\n'.join(rows))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,71 @@
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from export_forward import export_scripted
+from gen_forward import load_tts_model
+from utils.display import simple_table
+
+
+def time_generate(generate_func, x: torch.Tensor, num_runs: int) -> np.array:
+    times = []
+    for _ in range(num_runs):
+        start = time.perf_counter()
+        with torch.no_grad():
+            generate_func(x)
+        times.append(time.perf_counter() - start)
+    return np.array(times) * 1000.
+
+
+def time_cold_start(checkpoint_path: str, x: torch.Tensor) -> float:
+    """ Time from loading the model until the first mel is generated. """
+    start = time.perf_counter()
+    tts_model, _ = load_tts_model(checkpoint_path)
+    tts_model.eval()
+    with torch.no_grad():
+        tts_model.generate_jit(x, 1., 1., 1.)
+    return (time.perf_counter() - start) * 1000.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks eager vs. scripted inference of a tts model on CPU.')
+    parser.add_argument('--checkpoint', type=str, required=True, help='[string/path] path to .pt model file.')
+    parser.add_argument('--num_chars', type=int, default=200, help='Length of the input token sequence.')
+    parser.add_argument('--runs', type=int, default=20, help='Number of timed runs.')
+    parser.add_argument('--threads', type=int, default=1, help='Number of torch threads.')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(42)
+    tts_model, config = load_tts_model(args.checkpoint)
+    tts_model.eval()
+    x = torch.randint(1, 30, (1, args.num_chars))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scripted_path = str(Path(tmp_dir) / 'model.ts.pt')
+        export_scripted(args.checkpoint, scripted_path)
+        eager_cold = time_cold_start(args.checkpoint, x)
+        scripted_cold = time_cold_start(scripted_path, x)
+        scripted_model, _ = load_tts_model(scripted_path)
+
+    # warm up, the profiling executor optimizes the scripted graph in the first runs
+    for _ in range(3):
+        time_generate(lambda t: tts_model.generate_jit(t, 1., 1., 1.), x, 1)
+        time_generate(lambda t: scripted_model.generate_jit(t, 1., 1., 1.), x, 1)
+
+    eager_times = time_generate(lambda t: tts_model.generate_jit(t, 1., 1., 1.), x, args.runs)
+    scripted_times = time_generate(lambda t: scripted_model.generate_jit(t, 1., 1., 1.), x, args.runs)
+
+    simple_table([('Model', config.get('tts_model', 'forward_tacotron')),
+                  ('Chars', args.num_chars),
+                  ('eager p50/p90 ms', f'{np.median(eager_times):.1f}/{np.percentile(eager_times, 90):.1f}'),
+                  ('scripted p50/p90 ms', f'{np.median(scripted_times):.1f}/{np.percentile(scripted_times, 90):.1f}'),
+                  ('eager cold start ms', f'{eager_cold:.1f}'),
+                  ('scripted cold start ms', f'{scripted_cold:.1f}')])
@@ -0,0 +1,55 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from models.common_layers import LengthRegulator
+
+
+def expand_loop(x: torch.Tensor, dur: torch.Tensor) -> torch.Tensor:
+    """ Previous implementation with one repeat_interleave per batch item. """
+    dur = torch.clamp(dur, min=0.)
+    x_expanded = [torch.repeat_interleave(x[i], (dur[i] + 0.5).long(), dim=0) for i in range(x.size(0))]
+    return pad_sequence(x_expanded, padding_value=0., batch_first=True)
+
+
+def time_func(func, num_runs: int) -> float:
+    func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_runs):
+        func()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_runs * 1000.
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the length regulator against the per-item loop.')
+    parser.add_argument('--num_chars', type=int, default=150, help='Tokens per batch item.')
+    parser.add_argument('--channels', type=int, default=256, help='Channels of the expanded sequence.')
+    parser.add_argument('--runs', type=int, default=50, help='Number of timed runs per batch size.')
+    args = parser.parse_args()
+
+    torch.manual_seed(42)
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    length_regulator = LengthRegulator()
+    rows = []
+    for batch_size in [1, 2, 4, 8, 16, 32, 64]:
+        x = torch.randn(batch_size, args.num_chars, args.channels, device=device)
+        dur = torch.rand(batch_size, args.num_chars, device=device) * 10.
+        assert torch.equal(expand_loop(x, dur), length_regulator(x, dur)[0])
+        loop_ms = time_func(lambda: expand_loop(x, dur), args.runs)
+        vectorized_ms = time_func(lambda: length_regulator(x, dur), args.runs)
+        rows.append(f'{batch_size:>10} | {loop_ms:>9.3f} | {vectorized_ms:>13.3f} | {loop_ms / vectorized_ms:>6.1f}x')
+
+    print(f'Device: {device}, chars: {args.num_chars}, channels: {args.channels}')
+    print('Batch size |   Loop ms | Vectorized ms | Speedup')
+    print('\n'.join(rows))
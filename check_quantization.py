@@ -0,0 +1,72 @@
+import argparse
+import time
+from pathlib import Path
+
+import torch
+
+from gen_forward import load_tts_model
+from gen_tacotron import load_taco
+from trainer.common import MaskedL1, to_device
+from utils.dataset import get_tts_datasets
+from utils.display import progbar, simple_table, stream
+from utils.quantization import quantize_model
+
+
+def predict_mel(model: torch.nn.Module, batch: dict, model_type: str) -> torch.Tensor:
+    if model_type == 'tacotron':
+        _, mel_post, _ = model(batch['x'], batch['mel'])
+        return mel_post
+    return model(batch)['mel_post']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the mels of a tts model with and without dynamic int8 '
+                                                 'quantization on the validation set (teacher forced).')
+    parser.add_argument('--checkpoint', type=str, required=True, help='[string/path] path to .pt model file.')
+    parser.add_argument('--model_type', type=str, default='forward', choices=['forward', 'tacotron'],
+                        help='Type of the checkpoint, forward covers ForwardTacotron and FastPitch.')
+    parser.add_argument('--data_path', type=str, default=None, help='[string/path] preprocessed data, '
+                                                                    'defaults to data_path of the checkpoint config.')
+    parser.add_argument('--batch_size', type=int, default=8, help='Batch size for the validation set.')
+    parser.add_argument('--max_mel_len', type=int, default=None, help='Skip validation files with longer mels.')
+    args = parser.parse_args()
+
+    torch.manual_seed(42)
+    if args.model_type == 'tacotron':
+        model, config = load_taco(args.checkpoint)
+    else:
+        model, config = load_tts_model(args.checkpoint)
+    model.eval()
+    quantized_model = quantize_model(model)
+    model.cpu()
+
+    data_path = Path(args.data_path or config['data_path'])
+    r = model.r if args.model_type == 'tacotron' else 1
+    _, val_set = get_tts_datasets(path=data_path, batch_size=args.batch_size, r=r, max_mel_len=args.max_mel_len,
+                                  filter_attention=False, model_type=args.model_type)
+
+    l1 = MaskedL1()
+    fp32_loss, int8_loss, diff = 0., 0., 0.
+    fp32_time, int8_time = 0., 0.
+    for i, batch in enumerate(val_set, 1):
+        batch = to_device(batch, device=torch.device('cpu'))
+        with torch.no_grad():
+            start = time.perf_counter()
+            mel_fp32 = predict_mel(model, batch, args.model_type)
+            fp32_time += time.perf_counter() - start
+            start = time.perf_counter()
+            mel_int8 = predict_mel(quantized_model, batch, args.model_type)
+            int8_time += time.perf_counter() - start
+        fp32_loss += l1(mel_fp32, batch['mel'], batch['mel_len']).item()
+        int8_loss += l1(mel_int8, batch['mel'], batch['mel_len']).item()
+        diff += l1(mel_int8, mel_fp32, batch['mel_len']).item()
+        stream(f'{progbar(i, len(val_set))} {i}/{len(val_set)} Batches ')
+
+    n = len(val_set)
+    print()
+    simple_table([('Val batches', n),
+                  ('Mel L1 fp32', f'{fp32_loss / n:#.4}'),
+                  ('Mel L1 int8', f'{int8_loss / n:#.4}'),
+                  ('Mel L1 int8 vs fp32', f'{diff / n:#.4}'),
+                  ('Time fp32 (s)', f'{fp32_time:.2f}'),
+                  ('Time int8 (s)', f'{int8_time:.2f}')])
@@ -0,0 +1,38 @@
+import argparse
+from pathlib import Path
+
+import torch
+import yaml
+
+from utils.checkpoints import init_tts_model
+from utils.quantization import quantize_model
+
+# name of the config inside the extra files of a scripted tts model
+SCRIPTED_CONFIG_FILE = 'config.yaml'
+
+
+def export_scripted(checkpoint_path: str, output_path: str, quantize: bool = False) -> None:
+    checkpoint = torch.load(checkpoint_path, map_location=torch.device('cpu'))
+    config = checkpoint['config']
+    tts_model = init_tts_model(config)
+    tts_model.load_state_dict(checkpoint['model'])
+    tts_model.eval()
+    if quantize:
+        tts_model = quantize_model(tts_model)
+    model_script = torch.jit.script(tts_model)
+    extra_files = {SCRIPTED_CONFIG_FILE: yaml.dump(config)}
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    torch.jit.save(model_script, output_path, _extra_files=extra_files)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports a ForwardTacotron or FastPitch checkpoint as TorchScript model.')
+    parser.add_argument('--checkpoint', type=str, required=True, help='[string/path] path to .pt model file.')
+    parser.add_argument('--output', type=str, default=None, help='[string/path] path of the scripted model, '
+                                                                  'defaults to the checkpoint path with suffix .ts.pt')
+    parser.add_argument('--quantize', action='store_true', help='Export the model with dynamic int8 quantization.')
+    args = parser.parse_args()
+
+    output_path = args.output or str(Path(args.checkpoint).with_suffix('.ts.pt'))
+    export_scripted(args.checkpoint, output_path, quantize=args.quantize)
+    print(f'Saved scripted model to {output_path}. It can be used as checkpoint for gen_forward.py and tts_api.py.')
@@ -1,9 +1,14 @@
 import argparse
+import queue
+import threading
+import zipfile
 from pathlib import Path
 from typing import Tuple, Dict, Any, Union
 import numpy as np
 import torch
+import yaml
 
+from export_forward import SCRIPTED_CONFIG_FILE
 from models.fast_pitch import FastPitch
 from models.fatchord_version import WaveRNN
 from models.forward_tacotron import ForwardTacotron
@@ -12,10 +17,31 @@ from utils.display import simple_table
 from utils.dsp import DSP
 from utils.files import read_config
 from utils.paths import Paths
+from utils.quantization import quantize_model
 from utils.text.cleaners import Cleaner
+from utils.text.splitter import split_sentences
 from utils.text.tokenizer import Tokenizer
 
+def is_scripted_model(checkpoint_path: str) -> bool:
+  # TorchScript archives contain the compiled code next to the weights
+  if not zipfile.is_zipfile(checkpoint_path):
+    return False
+  with zipfile.ZipFile(checkpoint_path) as archive:
+    return any('/code/' in name for name in archive.namelist())
+
+
+def load_scripted_tts_model(checkpoint_path: str) -> Tuple[torch.jit.ScriptModule, Dict[str, Any]]:
+  print(f'Loading scripted tts model {checkpoint_path}')
+  extra_files = {SCRIPTED_CONFIG_FILE: ''}
+  tts_model = torch.jit.load(checkpoint_path, map_location=torch.device('cpu'), _extra_files=extra_files)
+  config = yaml.load(extra_files[SCRIPTED_CONFIG_FILE], Loader=yaml.FullLoader)
+  print(f'Restored scripted model with step {tts_model.get_step()}')
+  return tts_model, config
+
+
 def load_tts_model(checkpoint_path: str) -> Tuple[Union[ForwardTacotron, FastPitch], Dict[str, Any]]:
+  if is_scripted_model(str(checkpoint_path)):
+    return load_scripted_tts_model(str(checkpoint_path))
   print(f'Loading tts checkpoint {checkpoint_path}')
   checkpoint = torch.load(checkpoint_path, map_location=torch.device('cpu'))
   config = checkpoint['config']
@@ -32,9 +58,14 @@ def load_wavernn(checkpoint_path: str) -> Tuple[WaveRNN, Dict[str, Any]]:
   config = checkpoint['config']
   voc_model = WaveRNN.from_config(config)
   voc_model.load_state_dict(checkpoint['model'])
+  # the vocoder is shared by all generators, so it is put in eval mode once instead of switching the mode per call
+  voc_model.eval()
   print(f'Loaded model with step {voc_model.get_step()}')
   return voc_model, config
 
+# log of the mel clipping value in DSP.normalize
+MEL_SILENCE = -11.5129
+
 class ForwardGenerator:
   tts_model = None
   voc_model = None
@@ -47,18 +78,44 @@ class ForwardGenerator:
   tokenizer = None
 
   vocoder_type = ""
+  checkpoint_path = ""
   device = None
 
-  def __init__(self, checkpoint_path, vocoder_type, vocoder_checkpoint_path = ""):
+  max_sentence_chars = 300
+  sentence_pause = 0.3
+  sentences_per_step = 1
+  max_pending_mels = 2
+
+  def __init__(self, checkpoint_path, vocoder_type, vocoder_checkpoint_path = "",
+               max_sentence_chars = 300, sentence_pause = 0.3, sentences_per_step = 1, max_pending_mels = 2,
+               voc_model = None, voc_config = None, voc_jit = False, quantize = False, voc_quantize = False):
     self.vocoder_type = vocoder_type
+    self.checkpoint_path = checkpoint_path
+    self.max_sentence_chars = max_sentence_chars
+    self.sentence_pause = sentence_pause
+    self.sentences_per_step = sentences_per_step
+    self.max_pending_mels = max_pending_mels
     self.tts_model, self.tts_config = load_tts_model(checkpoint_path)
+    if quantize:
+      self.tts_model = quantize_model(self.tts_model)
     self.tts_dsp = DSP.from_config(self.tts_config)
 
     if self.vocoder_type == 'wavernn':
-      self.voc_model, self.voc_config = load_wavernn(vocoder_checkpoint_path)
+      # a preloaded vocoder can be shared between several generators
+      if voc_model is not None:
+        self.voc_model, self.voc_config = voc_model, voc_config
+      else:
+        self.voc_model, self.voc_config = load_wavernn(vocoder_checkpoint_path)
       self.voc_dsp = DSP.from_config(self.voc_config)
-
-    self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+      # run the sample loop of the vocoder with TorchScript
+      if voc_jit:
+        self.voc_model.use_jit = True
+      # int8 weights for the linear and gru layers of the sample loop
+      if voc_quantize:
+        self.voc_model.use_quantized = True
+
+    # quantized models only run on CPU
+    self.device = torch.device('cuda') if torch.cuda.is_available() and not quantize else torch.device('cpu')
     self.tts_model.to(self.device)
 
     self.cleaner = Cleaner.from_config(self.tts_config)
@@ -70,81 +127,201 @@ class ForwardGenerator:
     simple_table([('Forward Tacotron', str(tts_k) + 'k'), ('Vocoder Type', vocoder_type)])
 
   def generate(self, input_text, output_path, alpha = 1, amp = 1, overlap = 550, target = 11000):
-    # simple amplification of pitch
-    pitch_function = lambda x: x * amp
-    energy_function = lambda x: x
-
     outpath = Path(output_path)
     outpath.parent.mkdir(parents=True, exist_ok=True)
 
-    text = input_text
-    text = self.cleaner(text)
-    print("Cleaned text.")
-    text = self.tokenizer(text)
-    print("Tokenized text.")
-    text = torch.as_tensor(text, dtype=torch.long, device=self.device).unsqueeze(0)
-
     print("Generating TTS input to vocoder.")
-    gen = self.tts_model.generate(x=text,
-                                  alpha=alpha,
-                                  pitch_function=pitch_function,
-                                  energy_function=energy_function)
+    mels = self.generate_sentence_mels(input_text, alpha=alpha, amp=amp)
 
     print("Vocoding...")
-    m = gen['mel_post'].cpu()
     if self.vocoder_type == 'melgan':
-        torch.save(m, str(outpath))
+        torch.save(self.join_mels(mels), str(outpath))
     elif self.vocoder_type == 'hifigan':
-        np.save(str(outpath), m.numpy(), allow_pickle=False)
+        np.save(str(outpath), self.join_mels(mels).numpy(), allow_pickle=False)
     elif self.vocoder_type == 'wavernn':
-        wav = self.voc_model.generate(mels=m,
-                                      batched=True,
-                                      target=target,
-                                      overlap=overlap,
-                                      mu_law=self.voc_dsp.mu_law)
-        self.tts_dsp.save_wav(wav, str(outpath))
+        wavs = (self.voc_model.generate(mels=m,
+                                        batched=True,
+                                        target=target,
+                                        overlap=overlap,
+                                        mu_law=self.voc_dsp.mu_law) for m in mels)
+        self.tts_dsp.save_wav(self.join_wavs(wavs), str(outpath))
     elif self.vocoder_type == 'griffinlim':
-        wav = self.tts_dsp.griffinlim(m.squeeze().numpy())
-        self.tts_dsp.save_wav(wav, str(outpath))
+        wavs = (self.tts_dsp.griffinlim(m.squeeze().numpy()) for m in mels)
+        self.tts_dsp.save_wav(self.join_wavs(wavs), str(outpath))
+
+  def split_text(self, input_text):
+    """ Cleans a text and returns the token sequences of its sentences. """
+    cleaned = self.cleaner(input_text)
+    sentences = split_sentences(cleaned, max_chars=self.max_sentence_chars) or [cleaned]
+    return [self.tokenizer(sentence) for sentence in sentences]
+
+  def generate_sentence_mels(self, input_text, alpha = 1, amp = 1):
+    """
+    Yields the mels of the sentences of a text. The mels are generated by a producer thread, so that the
+    tts model already works on the next sentences while the caller vocodes the current one. At most
+    max_pending_mels mels are buffered between the two stages.
+    """
+    tokens = self.split_text(input_text)
+    print(f"Split text into {len(tokens)} sentences.")
+    mel_queue = queue.Queue(maxsize=self.max_pending_mels)
+    stop = threading.Event()
+
+    def produce():
+      try:
+        for i in range(0, len(tokens), self.sentences_per_step):
+          for mel in self.generate_mels_from_tokens(tokens[i:i+self.sentences_per_step], alpha=alpha, amp=amp):
+            if stop.is_set():
+              return
+            mel_queue.put(mel)
+      except Exception as e:
+        mel_queue.put(e)
+      mel_queue.put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+      while True:
+        mel = mel_queue.get()
+        if mel is None:
+          break
+        if isinstance(mel, Exception):
+          raise mel
+        yield mel
+    finally:
+      # unblock the producer if the consumer stopped early
+      stop.set()
+      while producer.is_alive():
+        try:
+          mel_queue.get(timeout=0.1)
+        except queue.Empty:
+          pass
+
+  def join_wavs(self, wavs):
+    """ Concatenates the wavs of consecutive sentences with a pause of sentence_pause seconds. """
+    pause = np.zeros(int(self.sentence_pause * self.tts_dsp.sample_rate), dtype=np.float32)
+    parts = []
+    for wav in wavs:
+      if len(parts) > 0:
+        parts.append(pause)
+      parts.append(wav.astype(np.float32))
+    return np.concatenate(parts)
+
+  def join_mels(self, mels):
+    """ Concatenates the mels of consecutive sentences along the time axis with silent frames in between. """
+    pause_frames = int(self.sentence_pause * self.tts_dsp.sample_rate / self.tts_dsp.hop_length)
+    pause = torch.full((1, self.tts_dsp.n_mels, pause_frames), fill_value=MEL_SILENCE)
+    parts = []
+    for mel in mels:
+      if len(parts) > 0:
+        parts.append(pause)
+      parts.append(mel)
+    return torch.cat(parts, dim=-1)
+
+  def generate_mels(self, input_texts, alpha = 1, amp = 1, bucket_ratio = 2.):
+    """ Generates the mels of several texts, each text is synthesized as a whole. """
+    tokens = [self.tokenizer(self.cleaner(text)) for text in input_texts]
+    print(f"Cleaned and tokenized {len(tokens)} texts.")
+    return self.generate_mels_from_tokens(tokens, alpha=alpha, amp=amp, bucket_ratio=bucket_ratio)
+
+  def generate_mels_from_tokens(self, tokens, alpha = 1, amp = 1, bucket_ratio = 2.):
+    """
+    Generates the mels of several token sequences with padded batch calls of the tts model. The sequences
+    are bucketed by length so that a batch never pads a sequence to more than bucket_ratio times its
+    own length. Returns the mels in the order of the input, each of shape (1, n_mels, T).
+    """
+    order = sorted(range(len(tokens)), key=lambda i: len(tokens[i]))
+    buckets = []
+    for i in order:
+      if len(buckets) > 0 and len(tokens[i]) <= bucket_ratio * max(1, len(tokens[buckets[-1][0]])):
+        buckets[-1].append(i)
+      else:
+        buckets.append([i])
+
+    mels = [None] * len(tokens)
+    for bucket in buckets:
+      x_lens = torch.tensor([len(tokens[i]) for i in bucket], dtype=torch.long)
+      x = torch.zeros((len(bucket), int(x_lens.max())), dtype=torch.long)
+      for b, i in enumerate(bucket):
+        x[b, :len(tokens[i])] = torch.as_tensor(tokens[i], dtype=torch.long)
+      # generate_jit is available for eager and scripted models, beta is a simple amplification of pitch
+      gen = self.tts_model.generate_jit(x=x.to(self.device),
+                                        alpha=float(alpha),
+                                        beta=float(amp),
+                                        gamma=1.,
+                                        x_lens=x_lens.to(self.device))
+      mel_post = gen['mel_post'].cpu()
+      for b, i in enumerate(bucket):
+        mels[i] = mel_post[b:b+1, :, :int(gen['mel_len'][b])]
+    return mels
+
+  def generate_batch(self, input_texts, output_paths, vocoder = "wavernn", alpha = 1, amp = 1, overlap = 550, target = 11000):
+    """ Generates the wavs of several texts, sharing the tts model and vocoder calls between all of their sentences. """
+    for output_path in output_paths:
+      Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+
+    text_tokens = [self.split_text(text) for text in input_texts]
+    tokens = [t for sentence_tokens in text_tokens for t in sentence_tokens]
+    print(f"Generating TTS input to vocoder for a batch of {len(input_texts)} texts with {len(tokens)} sentences.")
+    mels = self.generate_mels_from_tokens(tokens, alpha=alpha, amp=amp)
 
-  def generate_grifflim(self, input_text, output_path, alpha = 1, amp = 1, overlap = 550, target = 11000):
-    # simple amplification of pitch
-    pitch_function = lambda x: x * amp
-    energy_function = lambda x: x
+    print("Vocoding...")
+    if vocoder == 'wavernn' and self.voc_model is not None:
+      # all mels share a single sample loop of the vocoder
+      wavs = self.voc_model.generate_batch(mels=mels,
+                                           target=target,
+                                           overlap=overlap,
+                                           mu_law=self.voc_dsp.mu_law)
+    else:
+      wavs = [self.tts_dsp.griffinlim(m.squeeze().numpy()) for m in mels]
+
+    start = 0
+    for sentence_tokens, output_path in zip(text_tokens, output_paths):
+      end = start + len(sentence_tokens)
+      self.tts_dsp.save_wav(self.join_wavs(wavs[start:end]), str(output_path))
+      start = end
+
+  def generate_stream(self, input_text, vocoder = "wavernn", alpha = 1, amp = 1, overlap = 550, target = 11000):
+    """ Yields the wav of a text in chunks as soon as they are vocoded. """
+    pause = np.zeros(int(self.sentence_pause * self.tts_dsp.sample_rate), dtype=np.float32)
+    print("Streaming vocoder output...")
+    for i, m in enumerate(self.generate_sentence_mels(input_text, alpha=alpha, amp=amp)):
+      if i > 0:
+        yield pause
+      if vocoder == 'wavernn' and self.voc_model is not None:
+        yield from self.voc_model.generate_stream(mels=m,
+                                                  target=target,
+                                                  overlap=overlap,
+                                                  mu_law=self.voc_dsp.mu_law)
+      else:
+        yield from self.tts_dsp.griffinlim_stream(m.squeeze().numpy())
 
+  def generate_grifflim(self, input_text, output_path, alpha = 1, amp = 1, overlap = 550, target = 11000):
     outpath = Path(output_path)
     outpath.parent.mkdir(parents=True, exist_ok=True)
 
-    text = input_text
-    text = self.cleaner(text)
-    print("Cleaned text.")
-    text = self.tokenizer(text)
-    print("Tokenized text.")
-    text = torch.as_tensor(text, dtype=torch.long, device=self.device).unsqueeze(0)
-
     print("Generating TTS input to vocoder.")
-    gen = self.tts_model.generate(x=text,
-                                  alpha=alpha,
-                                  pitch_function=pitch_function,
-                                  energy_function=energy_function)
+    mels = self.generate_sentence_mels(input_text, alpha=alpha, amp=amp)
 
     print("Vocoding...")
-    m = gen['mel_post'].cpu()
-    wav = self.tts_dsp.griffinlim(m.squeeze().numpy())
-    self.tts_dsp.save_wav(wav, str(outpath))
+    wavs = (self.tts_dsp.griffinlim(m.squeeze().numpy()) for m in mels)
+    self.tts_dsp.save_wav(self.join_wavs(wavs), str(outpath))
 
-def generate(checkpoint_path, vocoder, voc_checkpoint_path = "", input_text = "", output_path = "", alpha = 1, amp = 1, overlap = 550, target = 11000):
+def generate(checkpoint_path, vocoder, voc_checkpoint_path = "", input_text = "", output_path = "", alpha = 1, amp = 1, overlap = 550, target = 11000, voc_jit = False, quantize = False):
   tts_model, config = load_tts_model(checkpoint_path)
+  if quantize:
+    tts_model = quantize_model(tts_model)
   dsp = DSP.from_config(config)
 
   voc_model, voc_dsp = None, None
   if vocoder == 'wavernn':
     voc_model, voc_config = load_wavernn(voc_checkpoint_path)
+    voc_model.use_jit = voc_jit
+    voc_model.use_quantized = quantize
     voc_dsp = DSP.from_config(voc_config)
 
   out_path = Path('model_outputs/forward')
   out_path.mkdir(parents=True, exist_ok=True)
-  device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+  device = torch.device('cuda') if torch.cuda.is_available() and not quantize else torch.device('cpu')
   tts_model.to(device)
   cleaner = Cleaner.from_config(config)
   tokenizer = Tokenizer()
@@ -162,10 +339,6 @@ def generate(checkpoint_path, vocoder, voc_checkpoint_path = "", input_text = ""
   simple_table([('Forward Tacotron', str(tts_k) + 'k'),
   ('Vocoder Type', vocoder)])
 
-  # simple amplification of pitch
-  pitch_function = lambda x: x * amp
-  energy_function = lambda x: x
-
   for i, x in enumerate(texts, 1):
     print(f'\n| Generating {i}/{len(texts)}')
     text = x
@@ -184,10 +357,8 @@ def generate(checkpoint_path, vocoder, voc_checkpoint_path = "", input_text = ""
       wavpath = out_path / f'{wav_name}.wav'
 
     print("Generating TTS input to vocoder.")
-    gen = tts_model.generate(x=x,
-                             alpha=alpha,
-                             pitch_function=pitch_function,
-                             energy_function=energy_function)
+    # beta is a simple amplification of pitch
+    gen = tts_model.generate_jit(x=x, alpha=float(alpha), beta=float(amp), gamma=1.)
 
     print("Vocoding...")
     m = gen['mel_post'].cpu()
@@ -219,6 +390,7 @@ if __name__ == '__main__':
                                                               'or slow-down of generated speech, e.g. alpha=2.0 is double-time')
   parser.add_argument('--amp', type=float, default=1., help='Parameter for controlling pitch amplification')
   parser.add_argument('--output', type=str, default=None, help='[string/path]')
+  parser.add_argument('--quantize', action='store_true', help='Run the tts model and WaveRNN with dynamic int8 quantization on CPU')
 
   # name of subcommand goes to args.vocoder
   subparsers = parser.add_subparsers(dest='vocoder')
@@ -226,6 +398,7 @@ if __name__ == '__main__':
   wr_parser.add_argument('--overlap', '-o', default=550,  type=int, help='[int] number of crossover samples')
   wr_parser.add_argument('--target', '-t', default=11_000, type=int, help='[int] number of samples in each batch index')
   wr_parser.add_argument('--voc_checkpoint', type=str, help='[string/path] Load in different WaveRNN weights')
+  wr_parser.add_argument('--jit', action='store_true', help='Run the WaveRNN sample loop with TorchScript')
 
   gl_parser = subparsers.add_parser('griffinlim')
   mg_parser = subparsers.add_parser('melgan')
@@ -237,6 +410,6 @@ if __name__ == '__main__':
     'Please provide a valid vocoder! Choices: [\'griffinlim\', \'wavernn\', \'melgan\', \'hifigan\']'
 
   if args.vocoder == "wavernn":
-    generate(args.checkpoint, args.vocoder, args.voc_checkpoint, args.input_text, args.output, args.alpha, args.amp, args.overlap, args.target)
+    generate(args.checkpoint, args.vocoder, args.voc_checkpoint, args.input_text, args.output, args.alpha, args.amp, args.overlap, args.target, args.jit, args.quantize)
   else:
-    generate(args.checkpoint, args.vocoder, input_text=args.input_text, output_path=args.output, alpha=args.alpha, amp=args.amp)
+    generate(args.checkpoint, args.vocoder, input_text=args.input_text, output_path=args.output, alpha=args.alpha, amp=args.amp, quantize=args.quantize)
@@ -11,6 +11,7 @@ from utils.display import simple_table
 from utils.dsp import DSP
 from utils.files import read_config
 from utils.paths import Paths
+from utils.quantization import quantize_model
 from utils.text.cleaners import Cleaner
 from utils.text.tokenizer import Tokenizer
 
@@ -46,18 +47,34 @@ class TacotronGenerator:
   tokenizer = None
 
   vocoder_type = ""
+  checkpoint_path = ""
   device = None
 
-  def __init__(self, checkpoint_path, vocoder_type, vocoder_checkpoint_path = ""):
+  def __init__(self, checkpoint_path, vocoder_type, vocoder_checkpoint_path = "", voc_model = None, voc_config = None,
+               voc_jit = False, quantize = False, voc_quantize = False):
     self.vocoder_type = vocoder_type
+    self.checkpoint_path = checkpoint_path
     self.tts_model, self.tts_config = load_taco(checkpoint_path)
+    if quantize:
+      self.tts_model = quantize_model(self.tts_model)
     self.tts_dsp = DSP.from_config(self.tts_config)
 
     if self.vocoder_type == 'wavernn':
-      self.voc_model, self.voc_config = load_wavernn(vocoder_checkpoint_path)
+      # a preloaded vocoder can be shared between several generators
+      if voc_model is not None:
+        self.voc_model, self.voc_config = voc_model, voc_config
+      else:
+        self.voc_model, self.voc_config = load_wavernn(vocoder_checkpoint_path)
       self.voc_dsp = DSP.from_config(self.voc_config)
-
-    self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+      # run the sample loop of the vocoder with TorchScript
+      if voc_jit:
+        self.voc_model.use_jit = True
+      # int8 weights for the linear and gru layers of the sample loop
+      if voc_quantize:
+        self.voc_model.use_quantized = True
+
+    # quantized models only run on CPU
+    self.device = torch.device('cuda') if torch.cuda.is_available() and not quantize else torch.device('cpu')
     self.tts_model.to(self.device)
 
     self.cleaner = Cleaner.from_config(self.tts_config)
@@ -100,6 +117,25 @@ class TacotronGenerator:
         wav = self.tts_dsp.griffinlim(m)
         self.tts_dsp.save_wav(wav, str(outpath))
 
+  def generate_stream(self, input_text, vocoder = "wavernn", steps = 1000, overlap = 550, target = 11000):
+    """ Yields the wav of a text in chunks as soon as they are vocoded. """
+    text = self.cleaner(input_text)
+    text = self.tokenizer(text)
+    text = torch.as_tensor(text, dtype=torch.long, device=self.device).unsqueeze(0)
+
+    print("Generating TTS input to vocoder.")
+    _, m, _ = self.tts_model.generate(x=text, steps=steps)
+
+    print("Streaming vocoder output...")
+    if vocoder == 'wavernn' and self.voc_model is not None:
+      m = torch.tensor(m).unsqueeze(0)
+      yield from self.voc_model.generate_stream(mels=m,
+                                                target=target,
+                                                overlap=overlap,
+                                                mu_law=self.voc_dsp.mu_law)
+    else:
+      yield from self.tts_dsp.griffinlim_stream(m)
+
   def generate_grifflim(self, input_text, output_path, steps=1000, overlap = 550, target = 11000):
     outpath = Path(output_path)
     outpath.parent.mkdir(parents=True, exist_ok=True)
@@ -118,18 +154,22 @@ class TacotronGenerator:
     wav = self.tts_dsp.griffinlim(m)
     self.tts_dsp.save_wav(wav, str(outpath))
 
-def generate(checkpoint_path, vocoder, voc_checkpoint_path = "", input_text = "", output_path = "", steps=1000, overlap = 550, target = 11000):
+def generate(checkpoint_path, vocoder, voc_checkpoint_path = "", input_text = "", output_path = "", steps=1000, overlap = 550, target = 11000, voc_jit = False, quantize = False):
   tts_model, config = load_taco(checkpoint_path)
+  if quantize:
+    tts_model = quantize_model(tts_model)
   dsp = DSP.from_config(config)
 
   voc_model, voc_dsp = None, None
   if vocoder == 'wavernn':
     voc_model, voc_config = load_wavernn(voc_checkpoint_path)
+    voc_model.use_jit = voc_jit
+    voc_model.use_quantized = quantize
     voc_dsp = DSP.from_config(voc_config)
 
   out_path = Path('model_outputs/tacotron')
   out_path.mkdir(parents=True, exist_ok=True)
-  device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+  device = torch.device('cuda') if torch.cuda.is_available() and not quantize else torch.device('cpu')
   tts_model.to(device)
   cleaner = Cleaner.from_config(config)
   tokenizer = Tokenizer()
@@ -196,6 +236,7 @@ if __name__ == '__main__':
                                                                               'used if no checkpoint is set.')
   parser.add_argument('--steps', type=int, default=1000, help='Max number of steps.')
   parser.add_argument('--output', type=str, default=None, help='[string/path]')
+  parser.add_argument('--quantize', action='store_true', help='Run the tts model and WaveRNN with dynamic int8 quantization on CPU')
 
   # name of subcommand goes to args.vocoder
   subparsers = parser.add_subparsers(dest='vocoder')
@@ -203,6 +244,7 @@ if __name__ == '__main__':
   wr_parser.add_argument('--overlap', '-o', default=550,  type=int, help='[int] number of crossover samples')
   wr_parser.add_argument('--target', '-t', default=11_000, type=int, help='[int] number of samples in each batch index')
   wr_parser.add_argument('--voc_checkpoint', '-v', type=str, help='[string/path] Load in different WaveRNN weights')
+  wr_parser.add_argument('--jit', action='store_true', help='Run the WaveRNN sample loop with TorchScript')
 
   gl_parser = subparsers.add_parser('griffinlim')
   mg_parser = subparsers.add_parser('melgan')
@@ -213,6 +255,6 @@ if __name__ == '__main__':
       'Please provide a valid vocoder! Choices: [\'griffinlim\', \'wavernn\', \'melgan\']'
 
   if args.vocoder == "wavernn":
-    generate(args.checkpoint, args.vocoder, args.voc_checkpoint, args.input_text, args.output, args.steps, args.overlap, args.target)
+    generate(args.checkpoint, args.vocoder, args.voc_checkpoint, args.input_text, args.output, args.steps, args.overlap, args.target, args.jit, args.quantize)
   else:
-    generate(args.checkpoint, args.vocoder, input_text=args.input_text, output_path=args.output, steps=args.steps)
+    generate(args.checkpoint, args.vocoder, input_text=args.input_text, output_path=args.output, steps=args.steps, quantize=args.quantize)
@@ -1,7 +1,9 @@
+from typing import Optional, Tuple
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.nn.utils.rnn import pad_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 
 class LengthRegulator(nn.Module):
@@ -9,14 +11,26 @@ class LengthRegulator(nn.Module):
     def __init__(self):
         super().__init__()
 
-    def forward(self, x: torch.Tensor, dur: torch.Tensor) -> torch.Tensor:
-        dur[dur < 0] = 0.
-        x_expanded = []
-        for i in range(x.size(0)):
-            x_exp = torch.repeat_interleave(x[i], (dur[i] + 0.5).long(), dim=0)
-            x_expanded.append(x_exp)
-        x_expanded = pad_sequence(x_expanded, padding_value=0., batch_first=True)
-        return x_expanded
+    def forward(self, x: torch.Tensor, dur: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Repeats every token of x (b, t, c) by its duration in dur (b, t), rounded to frames, negative
+        durations count as zero. Returns the expanded sequences (b, T, c), zero padded to the longest one,
+        and the mask (b, T) of the valid frames.
+        """
+        b, t, c = x.size()
+        dur = (torch.clamp(dur, min=0.) + 0.5).long()
+        ends = torch.cumsum(dur, dim=1)
+        mel_lens = ends[:, -1]
+        max_len = int(mel_lens.max()) if b > 0 else 0
+        frames = torch.arange(max_len, device=x.device)
+        # the token of a frame is the number of tokens that end before or at the frame,
+        # frames after the last token point to an appended zero token
+        index = torch.searchsorted(ends, frames.expand(b, max_len).contiguous(), right=True)
+        index = index + torch.arange(b, device=x.device)[:, None] * (t + 1)
+        x = F.pad(x, [0, 0, 0, 1])
+        x_expanded = x.reshape(b * (t + 1), c).index_select(0, index.flatten()).view(b, max_len, c)
+        mask = frames[None, :] < mel_lens[:, None]
+        return x_expanded, mask
 
 
 class HighwayNetwork(nn.Module):
@@ -83,9 +97,17 @@ class CBHG(nn.Module):
 
         self.rnn = nn.GRU(channels, channels, batch_first=True, bidirectional=True)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        residual = x
+    def forward(self,
+                x: torch.Tensor,
+                x_lens: Optional[torch.Tensor] = None) -> torch.Tensor:
         seq_len = x.size(-1)
+        mask = torch.ones(1, 1, seq_len, device=x.device)
+        if x_lens is not None:
+            # zero the padded steps so that the convolutions see the same context as for unpadded input
+            mask = (torch.arange(seq_len, device=x.device)[None, :] < x_lens[:, None].to(x.device)).float()
+            mask = mask.unsqueeze(1)
+            x = x * mask
+        residual = x
         conv_bank = []
 
         # Convolution Bank
@@ -97,11 +119,11 @@ class CBHG(nn.Module):
         conv_bank = torch.cat(conv_bank, dim=1)
 
         # dump the last padding to fit residual
-        x = self.maxpool(conv_bank)[:, :, :seq_len]
+        x = self.maxpool(conv_bank)[:, :, :seq_len] * mask
         x = F.dropout(x, p=self.dropout, training=self.training)
 
         # Conv1d projections
-        x = self.conv_project1(x)
+        x = self.conv_project1(x) * mask
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = self.conv_project2(x)
 
@@ -114,6 +136,11 @@ class CBHG(nn.Module):
         for h in self.highways:
             x = h(x)
 
-        # And then the RNN
-        x, _ = self.rnn(x)
-        return x
\ No newline at end of file
+        # And then the RNN, packed if the batch is padded
+        if x_lens is not None:
+            x_packed = pack_padded_sequence(x, lengths=x_lens.cpu(), enforce_sorted=False, batch_first=True)
+            x_packed, _ = self.rnn(x_packed)
+            x, _ = pad_packed_sequence(x_packed, batch_first=True, total_length=seq_len)
+        else:
+            x, _ = self.rnn(x)
+        return x
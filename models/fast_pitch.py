@@ -1,7 +1,7 @@
 import copy
 import math
 from pathlib import Path
-from typing import Union, Callable, Dict, Any, Optional
+from typing import Union, Callable, Dict, Any, Optional, Tuple
 
 import numpy as np
 import torch
@@ -45,10 +45,8 @@ def make_token_len_mask(x: torch.Tensor) -> torch.Tensor:
 
 
 def make_mel_len_mask(x: torch.Tensor, mel_lens: torch.Tensor) -> torch.Tensor:
-    len_mask = torch.zeros((x.size(0), x.size(1))).bool().to(x.device)
-    for i, mel_len in enumerate(mel_lens):
-        len_mask[i, mel_len:] = True
-    return len_mask
+    seq_range = torch.arange(x.size(1), device=x.device)
+    return seq_range[None, :] >= mel_lens[:, None].to(x.device)
 
 
 class FFTBlock(nn.Module):
@@ -75,7 +73,8 @@ class FFTBlock(nn.Module):
 
     def forward(self,
                 src: torch.Tensor,
-                src_pad_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+                src_pad_mask: Optional[torch.Tensor] = None,
+                mask_convs: bool = False) -> torch.Tensor:
 
         src2 = self.self_attn(src, src, src,
                               attn_mask=None,
@@ -83,9 +82,14 @@ class FFTBlock(nn.Module):
         src = src + self.dropout1(src2)
         src = self.norm1(src)
         src = src.transpose(0, 1).transpose(1, 2)
-        src2 = self.conv1(src)
+        conv_mask = torch.ones(1, 1, src.size(2), device=src.device)
+        if mask_convs and src_pad_mask is not None:
+            # keeps padded steps out of the receptive field of the convolutions, only used for batched
+            # inference, so that the training and the outputs of trained models stay unchanged
+            conv_mask = (~src_pad_mask).unsqueeze(1).float()
+        src2 = self.conv1(src * conv_mask)
         src2 = self.activation(src2)
-        src2 = self.conv2(src2)
+        src2 = self.conv2(src2 * conv_mask)
         src = src + self.dropout2(src2)
         src = src.transpose(1, 2).transpose(0, 1)
         src = self.norm2(src)
@@ -120,11 +124,12 @@ class ForwardTransformer(torch.nn.Module):
 
     def forward(self,
                 x: torch.Tensor,
-                src_pad_mask: Optional[torch.Tensor] = None) -> torch.Tensor:         # shape: [N, T]
+                src_pad_mask: Optional[torch.Tensor] = None,
+                mask_convs: bool = False) -> torch.Tensor:         # shape: [N, T]
         x = x.transpose(0, 1)        # shape: [T, N]
         x = self.pos_encoder(x)
         for layer in self.layers:
-            x = layer(x, src_pad_mask=src_pad_mask)
+            x = layer(x, src_pad_mask=src_pad_mask, mask_convs=mask_convs)
         x = self.norm(x)
         x = x.transpose(0, 1)
         return x
@@ -153,9 +158,10 @@ class SeriesPredictor(nn.Module):
     def forward(self,
                 x: torch.Tensor,
                 src_pad_mask: Optional[torch.Tensor] = None,
-                alpha: float = 1.0) -> torch.Tensor:
+                alpha: float = 1.0,
+                mask_convs: bool = False) -> torch.Tensor:
         x = self.embedding(x)
-        x = self.transformer(x, src_pad_mask=src_pad_mask)
+        x = self.transformer(x, src_pad_mask=src_pad_mask, mask_convs=mask_convs)
         x = self.lin(x)
         return x / alpha
 
@@ -266,12 +272,9 @@ class FastPitch(nn.Module):
         energy_proj = energy_proj.transpose(1, 2)
         x = x + energy_proj * self.energy_strength
 
-        x = self.lr(x, dur)
-
-        len_mask = torch.zeros((x.size(0), x.size(1))).bool().to(x.device)
-        for i, mel_len in enumerate(mel_lens):
-            len_mask[i, mel_len:] = True
+        x, _ = self.lr(x, dur)
 
+        len_mask = make_mel_len_mask(x, mel_lens)
         x = self.postnet(x, src_pad_mask=len_mask)
 
         x = self.lin(x)
@@ -287,39 +290,84 @@ class FastPitch(nn.Module):
                  x: torch.Tensor,
                  alpha=1.0,
                  pitch_function: Callable[[torch.Tensor], torch.Tensor] = lambda x: x,
-                 energy_function: Callable[[torch.Tensor], torch.Tensor] = lambda x: x) -> Dict[str, torch.Tensor]:
+                 energy_function: Callable[[torch.Tensor], torch.Tensor] = lambda x: x,
+                 x_lens: Optional[torch.Tensor] = None) -> Dict[str, torch.Tensor]:
+        """
+        Generates mels for a single sequence or for a zero padded batch of sequences.
+        For padded batches, x_lens must be given, the returned 'mel_len' holds the
+        number of valid mel frames of each batch item.
+        """
         self.eval()
         with torch.no_grad():
-            dur_hat = self.dur_pred(x, alpha=alpha)
-            dur_hat = dur_hat.squeeze(2)
+            dur_hat, pitch_hat, energy_hat = self._predict(x, alpha=alpha, x_lens=x_lens)
+            return self._generate_mel(x=x, dur_hat=dur_hat,
+                                      pitch_hat=pitch_function(pitch_hat),
+                                      energy_hat=energy_function(energy_hat),
+                                      x_lens=x_lens)
+
+    @torch.jit.export
+    def generate_jit(self,
+                     x: torch.Tensor,
+                     alpha: float = 1.0,
+                     beta: float = 1.0,
+                     gamma: float = 1.0,
+                     x_lens: Optional[torch.Tensor] = None) -> Dict[str, torch.Tensor]:
+        """
+        Scriptable variant of generate, the pitch and energy are scaled by beta and gamma.
+        """
+        with torch.no_grad():
+            dur_hat, pitch_hat, energy_hat = self._predict(x, alpha=alpha, x_lens=x_lens)
+            return self._generate_mel(x=x, dur_hat=dur_hat,
+                                      pitch_hat=pitch_hat * beta,
+                                      energy_hat=energy_hat * gamma,
+                                      x_lens=x_lens)
+
+    def _predict(self,
+                 x: torch.Tensor,
+                 alpha: float,
+                 x_lens: Optional[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        src_pad_mask: Optional[torch.Tensor] = None
+        if x_lens is not None:
+            src_pad_mask = make_mel_len_mask(x, x_lens)
+        dur_hat = self.dur_pred(x, src_pad_mask=src_pad_mask, alpha=alpha, mask_convs=x_lens is not None)
+        dur_hat = dur_hat.squeeze(2)
+        if src_pad_mask is None:
             if torch.sum(dur_hat.long()) <= 0:
                 torch.fill_(dur_hat, value=2.)
-            pitch_hat = self.pitch_pred(x).transpose(1, 2)
-            pitch_hat = pitch_function(pitch_hat)
-            energy_hat = self.energy_pred(x).transpose(1, 2)
-            energy_hat = energy_function(energy_hat)
-            return self._generate_mel(x=x, dur_hat=dur_hat,
-                                      pitch_hat=pitch_hat,
-                                      energy_hat=energy_hat)
+        else:
+            len_mask = (~src_pad_mask).float()
+            dur_hat = dur_hat * len_mask
+            empty = torch.sum(dur_hat.long(), dim=1) <= 0
+            dur_hat[empty] = 2. * len_mask[empty]
+        pitch_hat = self.pitch_pred(x, src_pad_mask=src_pad_mask, mask_convs=x_lens is not None).transpose(1, 2)
+        energy_hat = self.energy_pred(x, src_pad_mask=src_pad_mask, mask_convs=x_lens is not None).transpose(1, 2)
+        return dur_hat, pitch_hat, energy_hat
 
     def pad(self, x: torch.Tensor, max_len: int) -> torch.Tensor:
         x = x[:, :, :max_len]
         x = F.pad(x, [0, max_len - x.size(2), 0, 0], 'constant', self.padding_value)
         return x
 
+    @torch.jit.export
     def get_step(self) -> int:
-        return self.step.data.item()
+        return int(self.step.item())
 
     def _generate_mel(self,
                       x: torch.Tensor,
                       dur_hat: torch.Tensor,
                       pitch_hat: torch.Tensor,
-                      energy_hat: torch.Tensor) -> Dict[str, torch.Tensor]:
+                      energy_hat: torch.Tensor,
+                      x_lens: Optional[torch.Tensor] = None) -> Dict[str, torch.Tensor]:
 
-        len_mask = make_token_len_mask(x.transpose(0, 1))
+        if x_lens is not None:
+            len_mask = make_mel_len_mask(x, x_lens)
+            pitch_hat = pitch_hat * (~len_mask).unsqueeze(1).float()
+            energy_hat = energy_hat * (~len_mask).unsqueeze(1).float()
+        else:
+            len_mask = make_token_len_mask(x.transpose(0, 1))
 
         x = self.embedding(x)
-        x = self.prenet(x, src_pad_mask=len_mask)
+        x = self.prenet(x, src_pad_mask=len_mask, mask_convs=x_lens is not None)
 
         pitch_proj = self.pitch_proj(pitch_hat)
         pitch_proj = pitch_proj.transpose(1, 2)
@@ -329,15 +377,21 @@ class FastPitch(nn.Module):
         energy_proj = energy_proj.transpose(1, 2)
         x = x + energy_proj * self.energy_strength
 
-        x = self.lr(x, dur_hat)
+        dur_hat = torch.clamp(dur_hat, min=0.)
+        x, mel_mask = self.lr(x, dur_hat)
+        mel_lens = torch.sum(mel_mask, dim=1)
+
+        mel_pad_mask: Optional[torch.Tensor] = None
+        if x_lens is not None:
+            mel_pad_mask = ~mel_mask
 
-        x = self.postnet(x, src_pad_mask=None)
+        x = self.postnet(x, src_pad_mask=mel_pad_mask, mask_convs=x_lens is not None)
 
         x = self.lin(x)
         x = x.transpose(1, 2)
 
         return {'mel': x, 'mel_post': x, 'dur': dur_hat,
-                'pitch': pitch_hat, 'energy': energy_hat}
+                'pitch': pitch_hat, 'energy': energy_hat, 'mel_len': mel_lens}
 
     @classmethod
     def from_config(cls, config: Dict[str, Any]) -> 'FastPitch':
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Union
+from typing import Union, List, Iterator, Dict, Tuple
 
 import numpy as np
 import torch
@@ -9,6 +9,7 @@ import torch.nn.functional as F
 from utils.display import *
 from utils.distribution import sample_from_discretized_mix_logistic
 from utils.dsp import *
+from utils.quantization import quantize_model
 
 
 class ResBlock(nn.Module):
@@ -90,6 +91,69 @@ class UpsampleNetwork(nn.Module):
         return m.transpose(1, 2), aux.transpose(1, 2)
 
 
+class WaveRNNSampler(nn.Module):
+    """
+    Autoregressive sample loop of a WaveRNN as module that can be compiled with TorchScript,
+    so that the per-sample steps run without the Python interpreter. Uses the weights of the given model.
+    """
+
+    def __init__(self, model: 'WaveRNN'):
+        super().__init__()
+        self.mode = model.mode
+        self.n_classes = model.n_classes
+        self.rnn_dims = model.rnn_dims
+        self.aux_dims = model.aux_dims
+        self.I = model.I
+        self.rnn1 = model.get_gru_cell(model.rnn1)
+        self.rnn2 = model.get_gru_cell(model.rnn2)
+        self.fc1 = model.fc1
+        self.fc2 = model.fc2
+        self.fc3 = model.fc3
+
+    def forward(self, mels: torch.Tensor, aux: torch.Tensor) -> torch.Tensor:
+        b_size, seq_len = mels.size(0), mels.size(1)
+        h1 = torch.zeros(b_size, self.rnn_dims, device=mels.device)
+        h2 = torch.zeros(b_size, self.rnn_dims, device=mels.device)
+        x = torch.zeros(b_size, 1, device=mels.device)
+
+        d = self.aux_dims
+        a1, a2, a3, a4 = aux[:, :, :d], aux[:, :, d:2 * d], aux[:, :, 2 * d:3 * d], aux[:, :, 3 * d:4 * d]
+        output: List[torch.Tensor] = []
+
+        for i in range(seq_len):
+            x = torch.cat([x, mels[:, i, :], a1[:, i, :]], dim=1)
+            x = self.I(x)
+            h1 = self.rnn1(x, h1)
+
+            x = x + h1
+            inp = torch.cat([x, a2[:, i, :]], dim=1)
+            h2 = self.rnn2(inp, h2)
+
+            x = x + h2
+            x = torch.cat([x, a3[:, i, :]], dim=1)
+            x = F.relu(self.fc1(x))
+
+            x = torch.cat([x, a4[:, i, :]], dim=1)
+            x = F.relu(self.fc2(x))
+
+            logits = self.fc3(x)
+
+            if self.mode == 'MOL':
+                sample = sample_from_discretized_mix_logistic(logits.unsqueeze(0).transpose(1, 2))
+                output.append(sample.view(-1))
+                x = sample.transpose(0, 1)
+            else:
+                # same steps as torch.distributions.Categorical, which is not supported by TorchScript
+                posterior = F.softmax(logits, dim=1)
+                posterior = posterior / posterior.sum(-1, keepdim=True)
+                sample = torch.multinomial(posterior, 1, True).squeeze(1)
+                sample = 2 * sample.float() / (self.n_classes - 1.) - 1.
+                output.append(sample)
+                x = sample.unsqueeze(-1)
+
+        return torch.stack(output).transpose(0, 1)
+
+
 class WaveRNN(nn.Module):
     def __init__(self, rnn_dims, fc_dims, bits, pad, upsample_factors,
                  feat_dims, compute_dims, res_out_dims, res_blocks,
@@ -126,6 +190,11 @@ class WaveRNN(nn.Module):
         self.register_buffer('step', torch.zeros(1, dtype=torch.long))
         self.num_params()
 
+        # if set, the generate methods run the sample loop with a scripted and/or int8 quantized WaveRNNSampler
+        self.use_jit = False
+        self.use_quantized = False
+        self._samplers: Dict[Tuple[str, int, bool, bool], nn.Module] = {}
+
         # Avoid fragmentation of RNN parameters and associated warning
         self._flatten_parameters()
 
@@ -175,11 +244,6 @@ class WaveRNN(nn.Module):
 
         mu_law = mu_law if self.mode == 'RAW' else False
 
-        output = []
-        start = time.time()
-        rnn1 = self.get_gru_cell(self.rnn1)
-        rnn2 = self.get_gru_cell(self.rnn2)
-
         with torch.no_grad():
 
             mels = torch.as_tensor(mels, device=device)
@@ -191,79 +255,207 @@ class WaveRNN(nn.Module):
                 mels = self.fold_with_overlap(mels, target, overlap)
                 aux = self.fold_with_overlap(aux, target, overlap)
 
-            b_size, seq_len, _ = mels.size()
+            output = self._sample(mels, aux, silent)
 
-            h1 = torch.zeros(b_size, self.rnn_dims, device=device)
-            h2 = torch.zeros(b_size, self.rnn_dims, device=device)
-            x = torch.zeros(b_size, 1, device=device)
+        if mu_law:
+            output = DSP.decode_mu_law(output, self.n_classes, False)
 
-            d = self.aux_dims
-            aux_split = [aux[:, :, d * i:d * (i + 1)] for i in range(4)]
+        if batched:
+            output = self.xfade_and_unfold(output, target, overlap)
+        else:
+            output = output[0]
 
-            for i in range(seq_len):
+        output = self._fade_out(output, wave_len)
 
-                m_t = mels[:, i, :]
+        return output
 
-                a1_t, a2_t, a3_t, a4_t = \
-                    (a[:, i, :] for a in aux_split)
+    def generate_batch(self, mels: List[torch.Tensor], target, overlap, mu_law, silent=False) -> List[np.array]:
+        """
+        Generates the waveforms of several mels (e.g. from different requests) with a single sample loop.
+        The folds of all mels are stacked into one batch, so that the per-step overhead is shared between them.
 
-                x = torch.cat([x, m_t, a1_t], dim=1)
-                x = self.I(x)
-                h1 = rnn1(x, h1)
+        Args:
+            mels (list)   : Mels with shape=(1, n_mels, timesteps), may differ in length
+            target (int)  : Target timesteps for each fold
+            overlap (int) : Timesteps for both xfade and rnn warmup
 
-                x = x + h1
-                inp = torch.cat([x, a2_t], dim=1)
-                h2 = rnn2(inp, h2)
+        Return:
+            (list) : One waveform (np.float64) per input mel
+        """
+        self.eval()
 
-                x = x + h2
-                x = torch.cat([x, a3_t], dim=1)
-                x = F.relu(self.fc1(x))
+        device = next(self.parameters()).device  # use same device as parameters
 
-                x = torch.cat([x, a4_t], dim=1)
-                x = F.relu(self.fc2(x))
+        mu_law = mu_law if self.mode == 'RAW' else False
 
-                logits = self.fc3(x)
+        with torch.no_grad():
 
-                if self.mode == 'MOL':
-                    sample = sample_from_discretized_mix_logistic(logits.unsqueeze(0).transpose(1, 2))
-                    output.append(sample.view(-1))
-                    # x = torch.FloatTensor([[sample]]).cuda()
-                    x = sample.transpose(0, 1)
+            folded_mels, folded_aux, wave_lens = [], [], []
+            for m in mels:
+                m = torch.as_tensor(m, device=device)
+                wave_lens.append((m.size(-1) - 1) * self.hop_length)
+                m = self.pad_tensor(m.transpose(1, 2), pad=self.pad, side='both')
+                m, aux = self.upsample(m.transpose(1, 2))
+                folded_mels.append(self.fold_with_overlap(m, target, overlap))
+                folded_aux.append(self.fold_with_overlap(aux, target, overlap))
 
-                elif self.mode == 'RAW':
-                    posterior = F.softmax(logits, dim=1)
-                    distrib = torch.distributions.Categorical(posterior)
+            num_folds = [m.size(0) for m in folded_mels]
+            output = self._sample(torch.cat(folded_mels, dim=0),
+                                  torch.cat(folded_aux, dim=0), silent)
 
-                    sample = 2 * distrib.sample().float() / (self.n_classes - 1.) - 1.
-                    output.append(sample)
-                    x = sample.unsqueeze(-1)
-                else:
-                    raise RuntimeError("Unknown model mode value - ", self.mode)
+        if mu_law:
+            output = DSP.decode_mu_law(output, self.n_classes, False)
 
-                if not silent and i % 100 == 0:
-                    self.gen_display(i, seq_len, b_size, start)
+        wavs = []
+        fold_ends = np.cumsum(num_folds)
+        for fold_end, n, wave_len in zip(fold_ends, num_folds, wave_lens):
+            wav = self.xfade_and_unfold(output[fold_end - n:fold_end], target, overlap)
+            wavs.append(self._fade_out(wav, wave_len))
+
+        return wavs
+
+    def generate_stream(self, mels, target, overlap, mu_law, folds_per_chunk=2) -> Iterator[np.array]:
+        """
+        Generates the waveform of a mel incrementally. The folds are vocoded in groups of folds_per_chunk
+        consecutive folds and every sample that is no longer affected by a crossfade with a later fold
+        is yielded right away, so that playback can start after the first group is finished.
+        The concatenated chunks have the same length and crossfade layout as the output of generate with
+        the same target and overlap. The samples themselves only match generate if folds_per_chunk is at
+        least the number of folds, otherwise the folds are sampled in different batches.
+        """
+        self.eval()
 
-        output = torch.stack(output).transpose(0, 1)
-        output = output.cpu().numpy()
-        output = output.astype(np.float64)
+        device = next(self.parameters()).device  # use same device as parameters
 
-        if mu_law:
-            output = DSP.decode_mu_law(output, self.n_classes, False)
+        mu_law = mu_law if self.mode == 'RAW' else False
 
-        if batched:
-            output = self.xfade_and_unfold(output, target, overlap)
-        else:
-            output = output[0]
+        with torch.no_grad():
+            mels = torch.as_tensor(mels, device=device)
+            wave_len = (mels.size(-1) - 1) * self.hop_length
+            mels = self.pad_tensor(mels.transpose(1, 2), pad=self.pad, side='both')
+            mels, aux = self.upsample(mels.transpose(1, 2))
+            mels = self.fold_with_overlap(mels, target, overlap)
+            aux = self.fold_with_overlap(aux, target, overlap)
+
+        num_folds = mels.size(0)
+        fade_in, fade_out = self._xfade_envelopes(overlap)
+        unfolded = np.zeros(num_folds * (target + overlap) + overlap, dtype=np.float64)
+        fade_start = max(0, wave_len - 20 * self.hop_length)
+        emitted = 0
+
+        for fold_start in range(0, num_folds, folds_per_chunk):
+            fold_end = min(fold_start + folds_per_chunk, num_folds)
+            with torch.no_grad():
+                y = self._sample(mels[fold_start:fold_end], aux[fold_start:fold_end], silent=True)
+            if mu_law:
+                y = DSP.decode_mu_law(y, self.n_classes, False)
+            y[:, :overlap] *= fade_in
+            y[:, -overlap:] *= fade_out
+            for i in range(fold_end - fold_start):
+                start = (fold_start + i) * (target + overlap)
+                unfolded[start:start + target + 2 * overlap] += y[i]
+
+            if fold_end < num_folds:
+                # samples before the next fold are final, except for the fade-out at the very end
+                ready = min(fold_end * (target + overlap), fade_start)
+            else:
+                ready = wave_len
+                unfolded = self._fade_out(unfolded, wave_len)
+            if ready > emitted:
+                yield unfolded[emitted:ready]
+                emitted = ready
+
+    def _sample(self, mels: torch.Tensor, aux: torch.Tensor, silent: bool) -> np.array:
+        """ Runs the autoregressive sample loop over a batch of upsampled (and possibly folded) conditioning features. """
+        if self.use_jit or self.use_quantized:
+            return self._sample_with_sampler(mels, aux)
+        device = mels.device
+        output = []
+        start = time.time()
+        rnn1 = self.get_gru_cell(self.rnn1)
+        rnn2 = self.get_gru_cell(self.rnn2)
 
-        # Fade-out at the end to avoid signal cutting out suddenly
-        fade_out = np.linspace(1, 0, 20 * self.hop_length)
-        output = output[:wave_len]
-        output[-20 * self.hop_length:] *= fade_out
+        b_size, seq_len, _ = mels.size()
 
-        self.train()
+        h1 = torch.zeros(b_size, self.rnn_dims, device=device)
+        h2 = torch.zeros(b_size, self.rnn_dims, device=device)
+        x = torch.zeros(b_size, 1, device=device)
 
-        return output
+        d = self.aux_dims
+        aux_split = [aux[:, :, d * i:d * (i + 1)] for i in range(4)]
+
+        for i in range(seq_len):
+
+            m_t = mels[:, i, :]
+
+            a1_t, a2_t, a3_t, a4_t = \
+                (a[:, i, :] for a in aux_split)
+
+            x = torch.cat([x, m_t, a1_t], dim=1)
+            x = self.I(x)
+            h1 = rnn1(x, h1)
+
+            x = x + h1
+            inp = torch.cat([x, a2_t], dim=1)
+            h2 = rnn2(inp, h2)
+
+            x = x + h2
+            x = torch.cat([x, a3_t], dim=1)
+            x = F.relu(self.fc1(x))
+
+            x = torch.cat([x, a4_t], dim=1)
+            x = F.relu(self.fc2(x))
+
+            logits = self.fc3(x)
+
+            if self.mode == 'MOL':
+                sample = sample_from_discretized_mix_logistic(logits.unsqueeze(0).transpose(1, 2))
+                output.append(sample.view(-1))
+                # x = torch.FloatTensor([[sample]]).cuda()
+                x = sample.transpose(0, 1)
+
+            elif self.mode == 'RAW':
+                posterior = F.softmax(logits, dim=1)
+                distrib = torch.distributions.Categorical(posterior)
+
+                sample = 2 * distrib.sample().float() / (self.n_classes - 1.) - 1.
+                output.append(sample)
+                x = sample.unsqueeze(-1)
+            else:
+                raise RuntimeError("Unknown model mode value - ", self.mode)
 
+            if not silent and i % 100 == 0:
+                self.gen_display(i, seq_len, b_size, start)
+
+        output = torch.stack(output).transpose(0, 1)
+        output = output.cpu().numpy()
+        return output.astype(np.float64)
+
+    def _sample_with_sampler(self, mels: torch.Tensor, aux: torch.Tensor) -> np.array:
+        # the sampler is built once per device and training step, as it holds copies of the gru weights
+        if self.use_quantized:
+            mels, aux = mels.cpu(), aux.cpu()
+        key = (str(mels.device), self.get_step(), self.use_jit, self.use_quantized)
+        # the model is shared between threads, the dict is never mutated but replaced in a single assignment,
+        # so a concurrent lookup never fails and an evicted sampler is still usable by the thread holding it
+        sampler = self._samplers.get(key)
+        if sampler is None:
+            sampler = WaveRNNSampler(self)
+            if self.use_quantized:
+                sampler = quantize_model(sampler)
+            if self.use_jit:
+                sampler = torch.jit.script(sampler)
+            self._samplers = {key: sampler}
+        output = sampler(mels, aux)
+        return output.cpu().numpy().astype(np.float64)
+
+    def _fade_out(self, output: np.array, wave_len: int) -> np.array:
+        # Fade-out at the end to avoid signal cutting out suddenly
+        output = output[:wave_len]
+        fade_len = min(20 * self.hop_length, len(output))
+        fade_out = np.linspace(1, 0, fade_len)
+        output[len(output) - fade_len:] *= fade_out
+        return output
 
     def gen_display(self, i, seq_len, b_size, start):
         gen_rate = (i + 1) / (time.time() - start) * b_size / 1000
@@ -272,7 +464,8 @@ class WaveRNN(nn.Module):
         stream(msg)
 
     def get_gru_cell(self, gru):
-        gru_cell = nn.GRUCell(gru.input_size, gru.hidden_size)
+        # skip the random init of the cell to leave the random state for sampling untouched
+        gru_cell = torch.nn.utils.skip_init(nn.GRUCell, gru.input_size, gru.hidden_size)
         gru_cell.weight_hh.data = gru.weight_hh_l0.data
         gru_cell.weight_ih.data = gru.weight_ih_l0.data
         gru_cell.bias_hh.data = gru.bias_hh_l0.data
@@ -376,20 +569,7 @@ class WaveRNN(nn.Module):
         target = length - 2 * overlap
         total_len = num_folds * (target + overlap) + overlap
 
-        # Need some silence for the rnn warmup
-        silence_len = overlap // 2
-        fade_len = overlap - silence_len
-        silence = np.zeros((silence_len), dtype=np.float64)
-        linear = np.ones((silence_len), dtype=np.float64)
-
-        # Equal power crossfade
-        t = np.linspace(-1, 1, fade_len, dtype=np.float64)
-        fade_in = np.sqrt(0.5 * (1 + t))
-        fade_out = np.sqrt(0.5 * (1 - t))
-
-        # Concat the silence to the fades
-        fade_in = np.concatenate([silence, fade_in])
-        fade_out = np.concatenate([linear, fade_out])
+        fade_in, fade_out = self._xfade_envelopes(overlap)
 
         # Apply the gain to the overlap samples
         y[:, :overlap] *= fade_in
@@ -405,6 +585,23 @@ class WaveRNN(nn.Module):
 
         return unfolded
 
+    def _xfade_envelopes(self, overlap):
+        # Need some silence for the rnn warmup
+        silence_len = overlap // 2
+        fade_len = overlap - silence_len
+        silence = np.zeros((silence_len), dtype=np.float64)
+        linear = np.ones((silence_len), dtype=np.float64)
+
+        # Equal power crossfade
+        t = np.linspace(-1, 1, fade_len, dtype=np.float64)
+        fade_in = np.sqrt(0.5 * (1 + t))
+        fade_out = np.sqrt(0.5 * (1 - t))
+
+        # Concat the silence to the fades
+        fade_in = np.concatenate([silence, fade_in])
+        fade_out = np.concatenate([linear, fade_out])
+        return fade_in, fade_out
+
     def get_step(self):
         return self.step.data.item()
 
@@ -450,4 +647,5 @@ class WaveRNN(nn.Module):
         checkpoint = torch.load(path, map_location=torch.device('cpu'))
         model = WaveRNN.from_config(checkpoint['config'])
         model.load_state_dict(checkpoint['model'])
+        model.eval()
         return model
\ No newline at end of file
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import Union, Callable, Dict, Any
+from typing import Union, Callable, Dict, Any, Optional, Tuple
 import numpy as np
 import torch
 import torch.nn as nn
@@ -11,6 +11,11 @@ from models.common_layers import CBHG, LengthRegulator
 from utils.text.symbols import phonemes
 
 
+def make_len_mask(lens: torch.Tensor, max_len: int) -> torch.Tensor:
+    seq_range = torch.arange(max_len, device=lens.device)
+    return (seq_range[None, :] < lens[:, None]).float()
+
+
 class SeriesPredictor(nn.Module):
 
     def __init__(self, num_chars, emb_dim=64, conv_dims=256, rnn_dims=64, dropout=0.5):
@@ -27,14 +32,24 @@ class SeriesPredictor(nn.Module):
 
     def forward(self,
                 x: torch.Tensor,
-                alpha: float = 1.0) -> torch.Tensor:
+                alpha: float = 1.0,
+                x_lens: Optional[torch.Tensor] = None) -> torch.Tensor:
+        seq_len = x.size(1)
+        mask = torch.ones(1, 1, seq_len, device=x.device)
+        if x_lens is not None:
+            mask = make_len_mask(x_lens.to(x.device), seq_len).unsqueeze(1)
         x = self.embedding(x)
-        x = x.transpose(1, 2)
+        x = x.transpose(1, 2) * mask
         for conv in self.convs:
-            x = conv(x)
+            x = conv(x) * mask
             x = F.dropout(x, p=self.dropout, training=self.training)
         x = x.transpose(1, 2)
-        x, _ = self.rnn(x)
+        if x_lens is not None:
+            x_packed = pack_padded_sequence(x, lengths=x_lens.cpu(), enforce_sorted=False, batch_first=True)
+            x_packed, _ = self.rnn(x_packed)
+            x, _ = pad_packed_sequence(x_packed, batch_first=True, total_length=seq_len)
+        else:
+            x, _ = self.rnn(x)
         x = self.lin(x)
         return x / alpha
 
@@ -158,7 +173,7 @@ class ForwardTacotron(nn.Module):
         energy_proj = energy_proj.transpose(1, 2)
         x = x + energy_proj * self.energy_strength
 
-        x = self.lr(x, dur)
+        x, _ = self.lr(x, dur)
 
         x = pack_padded_sequence(x, lengths=mel_lens.cpu(), enforce_sorted=False,
                                  batch_first=True)
@@ -184,48 +199,74 @@ class ForwardTacotron(nn.Module):
                  x: torch.Tensor,
                  alpha=1.0,
                  pitch_function: Callable[[torch.Tensor], torch.Tensor] = lambda x: x,
-                 energy_function: Callable[[torch.Tensor], torch.Tensor] = lambda x: x) -> Dict[str, torch.Tensor]:
+                 energy_function: Callable[[torch.Tensor], torch.Tensor] = lambda x: x,
+                 x_lens: Optional[torch.Tensor] = None) -> Dict[str, torch.Tensor]:
+        """
+        Generates mels for a single sequence or for a zero padded batch of sequences.
+        For padded batches, x_lens must be given, the returned 'mel_len' holds the
+        number of valid mel frames of each batch item.
+        """
         self.eval()
         with torch.no_grad():
-            dur_hat = self.dur_pred(x, alpha=alpha)
-            dur_hat = dur_hat.squeeze(2)
-            if torch.sum(dur_hat.long()) <= 0:
-                torch.fill_(dur_hat, value=2.)
-            pitch_hat = self.pitch_pred(x).transpose(1, 2)
-            pitch_hat = pitch_function(pitch_hat)
-            energy_hat = self.energy_pred(x).transpose(1, 2)
-            energy_hat = energy_function(energy_hat)
+            dur_hat, pitch_hat, energy_hat = self._predict(x, alpha=alpha, x_lens=x_lens)
             return self._generate_mel(x=x, dur_hat=dur_hat,
-                                      pitch_hat=pitch_hat,
-                                      energy_hat=energy_hat)
+                                      pitch_hat=pitch_function(pitch_hat),
+                                      energy_hat=energy_function(energy_hat),
+                                      x_lens=x_lens)
 
     @torch.jit.export
     def generate_jit(self,
                      x: torch.Tensor,
                      alpha: float = 1.0,
-                     beta: float = 1.0) -> Dict[str, torch.Tensor]:
+                     beta: float = 1.0,
+                     gamma: float = 1.0,
+                     x_lens: Optional[torch.Tensor] = None) -> Dict[str, torch.Tensor]:
+        """
+        Scriptable variant of generate, the pitch and energy are scaled by beta and gamma.
+        """
         with torch.no_grad():
-            dur_hat = self.dur_pred(x, alpha=alpha)
-            dur_hat = dur_hat.squeeze(2)
+            dur_hat, pitch_hat, energy_hat = self._predict(x, alpha=alpha, x_lens=x_lens)
+            return self._generate_mel(x=x, dur_hat=dur_hat,
+                                      pitch_hat=pitch_hat * beta,
+                                      energy_hat=energy_hat * gamma,
+                                      x_lens=x_lens)
+
+    def _predict(self,
+                 x: torch.Tensor,
+                 alpha: float,
+                 x_lens: Optional[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        dur_hat = self.dur_pred(x, alpha=alpha, x_lens=x_lens)
+        dur_hat = dur_hat.squeeze(2)
+        if x_lens is None:
             if torch.sum(dur_hat.long()) <= 0:
                 torch.fill_(dur_hat, value=2.)
-            pitch_hat = self.pitch_pred(x).transpose(1, 2) * beta
-            energy_hat = self.energy_pred(x).transpose(1, 2)
-            return self._generate_mel(x=x, dur_hat=dur_hat,
-                                      pitch_hat=pitch_hat,
-                                      energy_hat=energy_hat)
+        else:
+            len_mask = make_len_mask(x_lens, x.size(1))
+            dur_hat = dur_hat * len_mask
+            empty = torch.sum(dur_hat.long(), dim=1) <= 0
+            dur_hat[empty] = 2. * len_mask[empty]
+        pitch_hat = self.pitch_pred(x, x_lens=x_lens).transpose(1, 2)
+        energy_hat = self.energy_pred(x, x_lens=x_lens).transpose(1, 2)
+        return dur_hat, pitch_hat, energy_hat
 
+    @torch.jit.export
     def get_step(self) -> int:
-        return self.step.data.item()
+        return int(self.step.item())
 
     def _generate_mel(self,
                       x: torch.Tensor,
                       dur_hat: torch.Tensor,
                       pitch_hat: torch.Tensor,
-                      energy_hat: torch.Tensor) -> Dict[str, torch.Tensor]:
+                      energy_hat: torch.Tensor,
+                      x_lens: Optional[torch.Tensor] = None) -> Dict[str, torch.Tensor]:
+        if x_lens is not None:
+            len_mask = make_len_mask(x_lens, x.size(1)).unsqueeze(1)
+            pitch_hat = pitch_hat * len_mask
+            energy_hat = energy_hat * len_mask
+
         x = self.embedding(x)
         x = x.transpose(1, 2)
-        x = self.prenet(x)
+        x = self.prenet(x, x_lens=x_lens)
 
         pitch_proj = self.pitch_proj(pitch_hat)
         pitch_proj = pitch_proj.transpose(1, 2)
@@ -235,19 +276,28 @@ class ForwardTacotron(nn.Module):
         energy_proj = energy_proj.transpose(1, 2)
         x = x + energy_proj * self.energy_strength
 
-        x = self.lr(x, dur_hat)
+        dur_hat = torch.clamp(dur_hat, min=0.)
+        x, mel_mask = self.lr(x, dur_hat)
+        mel_lens = torch.sum(mel_mask, dim=1)
 
-        x, _ = self.lstm(x)
+        if x_lens is not None:
+            x_packed = pack_padded_sequence(x, lengths=mel_lens.cpu(), enforce_sorted=False,
+                                            batch_first=True)
+            x_packed, _ = self.lstm(x_packed)
+            x, _ = pad_packed_sequence(x_packed, padding_value=self.padding_value,
+                                       batch_first=True, total_length=x.size(1))
+        else:
+            x, _ = self.lstm(x)
 
         x = self.lin(x)
         x = x.transpose(1, 2)
 
-        x_post = self.postnet(x)
+        x_post = self.postnet(x, x_lens=mel_lens if x_lens is not None else None)
         x_post = self.post_proj(x_post)
         x_post = x_post.transpose(1, 2)
 
         return {'mel': x, 'mel_post': x_post, 'dur': dur_hat,
-                'pitch': pitch_hat, 'energy': energy_hat}
+                'pitch': pitch_hat, 'energy': energy_hat, 'mel_len': mel_lens}
 
     def _pad(self, x: torch.Tensor, max_len: int) -> torch.Tensor:
         x = x[:, :, :max_len]
@@ -0,0 +1,36 @@
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from utils.feature_store import pack_feature, unpack_feature
+from utils.files import read_config
+
+# feature directories of a preprocessed data dir
+FEATURES = ['mel', 'quant', 'raw_pitch', 'gta', 'alg', 'phon_pitch', 'phon_energy']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts the .npy files of a preprocessed data dir '
+                                                 'into packed shard files (and back with --unpack).')
+    parser.add_argument('--config', metavar='FILE', default='config.yaml', help='The config containing all hyperparams.')
+    parser.add_argument('--data_path', type=str, default=None, help='[string/path] preprocessed data, '
+                                                                    'defaults to data_path of the config.')
+    parser.add_argument('--features', nargs='+', default=FEATURES, choices=FEATURES, help='Features to convert.')
+    parser.add_argument('--keep_files', action='store_true', help='Keep the .npy files after packing.')
+    parser.add_argument('--unpack', action='store_true', help='Convert packed features back to .npy files.')
+    parser.add_argument('--compact_quant', action='store_true', help='Store quant as uint16 instead of int64, '
+                                                                    'also converts already packed quant.')
+    args = parser.parse_args()
+
+    data_path = Path(args.data_path or read_config(args.config)['data_path']).expanduser().resolve()
+    for feature in args.features:
+        if args.unpack:
+            num_items = unpack_feature(data_path / feature)
+            print(f'{feature}: unpacked {num_items} items.')
+        else:
+            dtype = np.uint16 if args.compact_quant and feature == 'quant' else None
+            num_items = pack_feature(data_path / feature, delete_files=not args.keep_files, dtype=dtype)
+            print(f'{feature}: packed {num_items} files.')
+    if not args.unpack:
+        print('Set pack_features: True in the preprocessing section of the config to keep new features packed.')
@@ -2,11 +2,13 @@ import argparse
 from dataclasses import dataclass
 from multiprocessing import Pool, cpu_count
 from random import Random
+from typing import Dict, List, Tuple
 
 import pyworld as pw
 
 from utils.display import *
 from utils.dsp import *
+from utils.feature_store import ShardWriter, get_shard_dir, unpack_feature
 from utils.files import get_files, pickle_binary, read_config
 from utils.paths import Paths
 from utils.text.cleaners import Cleaner
@@ -24,32 +26,54 @@ def valid_n_workers(num):
 class DataPoint:
     item_id: str = None
     mel_len: int = None
-    text: str = None
     mel: np.array = None
     quant: np.array = None
     pitch: np.array = None
 
 
+class TextPreprocessor:
+
+    def __init__(self, cleaner: Cleaner) -> None:
+        self.cleaner = cleaner
+
+    def __call__(self, items: List[Tuple[str, str]]) -> Tuple[List[Tuple[str, str]], Dict]:
+        """ Returns the cleaned items and the new phoneme cache entries, which are saved by the main process. """
+        return self._clean(items), self.cleaner.phoneme_cache.pop_new_entries()
+
+    def _clean(self, items: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        item_ids = [item_id for item_id, _ in items]
+        try:
+            texts = self.cleaner.clean_batch([text for _, text in items])
+            return list(zip(item_ids, texts))
+        except Exception as e:
+            print(e)
+        # clean the items one by one, so that only the failing texts are skipped
+        cleaned = []
+        for item_id, text in items:
+            try:
+                cleaned.append((item_id, self.cleaner(text)))
+            except Exception as e:
+                print(f'Skipping {item_id}: {e}')
+        return cleaned
+
+
 class Preprocessor:
 
     def __init__(self,
                  paths: Paths,
-                 text_dict: Dict[str, str],
-                 cleaner: Cleaner,
-                 lang: str,
-                 dsp: DSP) -> None:
+                 dsp: DSP,
+                 save_files: bool = True) -> None:
         self.paths = paths
-        self.text_dict = text_dict
-        self.cleaner = cleaner
-        self.lang = lang
         self.dsp = dsp
+        self.save_files = save_files
 
     def __call__(self, path: Path) -> Union[DataPoint, None]:
         try:
             dp = self._convert_file(path)
-            np.save(self.paths.mel/f'{dp.item_id}.npy', dp.mel, allow_pickle=False)
-            np.save(self.paths.quant/f'{dp.item_id}.npy', dp.quant, allow_pickle=False)
-            np.save(self.paths.raw_pitch/f'{dp.item_id}.npy', dp.pitch, allow_pickle=False)
+            if self.save_files:
+                np.save(self.paths.mel/f'{dp.item_id}.npy', dp.mel, allow_pickle=False)
+                np.save(self.paths.quant/f'{dp.item_id}.npy', dp.quant, allow_pickle=False)
+                np.save(self.paths.raw_pitch/f'{dp.item_id}.npy', dp.pitch, allow_pickle=False)
             return dp
         except Exception as e:
             print(e)
@@ -75,15 +99,10 @@ class Preprocessor:
         else:
             raise ValueError(f'Unexpected voc mode {self.dsp.voc_mode}, should be either RAW or MOL.')
 
-        item_id = path.stem
-        text = self.text_dict[item_id]
-        text = self.cleaner(text)
-
-        return DataPoint(item_id=item_id,
+        return DataPoint(item_id=path.stem,
                          mel=mel.astype(np.float32),
                          mel_len=mel.shape[-1],
-                         text=text,
-                         quant=quant.astype(np.int64),
+                         quant=quant.astype(np.uint16),
                          pitch=pitch.astype(np.float32))
 
 
@@ -91,6 +110,7 @@ parser = argparse.ArgumentParser(description='Preprocessing for WaveRNN and Taco
 parser.add_argument('--path', '-p', help='directly point to dataset path')
 parser.add_argument('--num_workers', '-w', metavar='N', type=valid_n_workers, default=cpu_count()-1, help='The number of worker threads to use for preprocessing')
 parser.add_argument('--config', metavar='FILE', default='config.yaml', help='The config containing all hyperparams.')
+parser.add_argument('--text_batch_size', type=int, default=1000, help='The number of texts that are cleaned and phonemized in one batch')
 args = parser.parse_args()
 
 
@@ -123,22 +143,51 @@ if __name__ == '__main__':
     ])
 
     pool = Pool(processes=n_workers)
-    dataset = []
-    cleaned_texts = []
     cleaner = Cleaner.from_config(config)
-    preprocessor = Preprocessor(paths=paths,
-                                text_dict=text_dict,
-                                dsp=dsp,
-                                cleaner=cleaner,
-                                lang=config['preprocessing']['language'])
+
+    # text stage: clean and phonemize all texts in large batches before processing any audio
+    print('Cleaning texts...')
+    text_items = sorted(text_dict.items())
+    text_batches = [text_items[i:i+args.text_batch_size] for i in range(0, len(text_items), args.text_batch_size)]
+    cleaned_texts = []
+    text_preprocessor = TextPreprocessor(cleaner)
+    for i, (cleaned_batch, phoneme_entries) in enumerate(pool.imap_unordered(text_preprocessor, text_batches), 1):
+        cleaned_texts += cleaned_batch
+        cleaner.phoneme_cache.update(phoneme_entries)
+        bar = progbar(i, len(text_batches))
+        message = f'{bar} {i}/{len(text_batches)} '
+        stream(message)
+    cleaner.phoneme_cache.save()
+    text_dict = {id: text for id, text in cleaned_texts}
+    pickle_binary(text_dict, paths.data/'text_dict.pkl')
+    wav_files = [w for w in wav_files if w.stem in text_dict]
+
+    # audio stage
+    print('\nProcessing audio...')
+    dataset = []
+    # packed features are written to large shard files by the main process instead of one file per item
+    pack_features = config['preprocessing'].get('pack_features', False)
+    preprocessor = Preprocessor(paths=paths, dsp=dsp, save_files=not pack_features)
+    shard_writers = {}
+    if pack_features:
+        shard_writers = {'mel': ShardWriter(get_shard_dir(paths.mel)),
+                         'quant': ShardWriter(get_shard_dir(paths.quant)),
+                         'pitch': ShardWriter(get_shard_dir(paths.raw_pitch))}
+    else:
+        # shards of an earlier packed run would shadow the new .npy files
+        for feature_path in [paths.mel, paths.quant, paths.raw_pitch]:
+            unpack_feature(feature_path)
 
     for i, dp in enumerate(pool.imap_unordered(preprocessor, wav_files), 1):
         if dp is not None and dp.item_id in text_dict:
             dataset += [(dp.item_id, dp.mel_len)]
-            cleaned_texts += [(dp.item_id, dp.text)]
+            for name, writer in shard_writers.items():
+                writer.write(dp.item_id, getattr(dp, name))
         bar = progbar(i, len(wav_files))
         message = f'{bar} {i}/{len(wav_files)} '
         stream(message)
+    for writer in shard_writers.values():
+        writer.close()
 
     dataset.sort()
     random = Random(42)
@@ -149,9 +198,6 @@ if __name__ == '__main__':
     val_dataset.sort(key=lambda d: -d[1])
     print(f'First val sample: {val_dataset[0][0]}')
 
-    text_dict = {id: text for id, text in cleaned_texts}
-
-    pickle_binary(text_dict, paths.data/'text_dict.pkl')
     pickle_binary(train_dataset, paths.data/'train_dataset.pkl')
     pickle_binary(val_dataset, paths.data/'val_dataset.pkl')
 
@@ -52,7 +52,33 @@ function startGenerateCallback(text)
     <p class="req-status" id="{0}-status">Pending...</p>
   </div>`.format(respJson["id"]);
   $("#audio-playback").append(reqDiv)
-  activeRequests.push(respJson["id"]);
+  if (respJson["status"] != 0)
+  {
+    checkGenerateCallback(text);
+  }
+  else if (window.EventSource)
+  {
+    watchRequest(respJson["id"]);
+  }
+  else
+  {
+    activeRequests.push(respJson["id"]);
+  }
+}
+
+// the server pushes the status of the request once it is finished, no polling needed
+function watchRequest(requestId)
+{
+  var eventsUrl = apiUrl + "/api/v1/tts/events?request=" + encodeURIComponent(requestId);
+  var source = new EventSource(eventsUrl);
+  source.onmessage = function(event) {
+    var respJson = JSON.parse(event.data);
+    if (respJson["status"] != 0)
+    {
+      source.close();
+      checkGenerateCallback(event.data);
+    }
+  };
 }
 
 function checkGenerateCallback(text)
@@ -130,5 +156,6 @@ $(window).on('load', function() {
     }
   });
 
+  // fallback for browsers without EventSource support
   var intervalId = setInterval(function() { checkActiveRequests(); }, 2500);
 });
\ No newline at end of file
@@ -0,0 +1,45 @@
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from api.api_db import API_DB, MemoryRequestStore, RequestStatus, create_request_store
+
+
+class TestRequestStore(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.temp_dir.name) / 'api.db'
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def assert_store_happy_path(self, store) -> None:
+        request_id, status = store.add_request('hello')
+        self.assertEqual(RequestStatus.PENDING, status)
+        self.assertEqual(RequestStatus.PENDING.value, store.check_request(request_id)[3])
+
+        store.update_request_status(request_id, RequestStatus.COMPLETED, queue_time=0.5)
+        store.update_request_status(request_id, RequestStatus.COMPLETED, compute_time=2.)
+        row = store.check_request(request_id)
+        self.assertEqual((request_id, 'hello', RequestStatus.COMPLETED.value, 0.5, 2.),
+                         (row[1], row[2], row[3], row[5], row[6]))
+        store.flush()
+        self.assertEqual(row, store.check_request(request_id))
+        self.assertIsNone(store.check_request('unknown'))
+
+    def test_sqlite_store(self) -> None:
+        store = API_DB(self.db_path, write_interval_ms=10000)
+        self.assert_store_happy_path(store)
+
+        conn = sqlite3.connect(str(self.db_path))
+        self.assertEqual('wal', conn.execute('PRAGMA journal_mode;').fetchone()[0])
+        plan = conn.execute('EXPLAIN QUERY PLAN SELECT * FROM REQUESTS WHERE requestid = ?', ('x',)).fetchall()
+        self.assertIn('REQUESTS_REQUESTID', str(plan))
+        self.assertEqual(RequestStatus.COMPLETED.value, conn.execute('SELECT status FROM REQUESTS').fetchone()[0])
+
+    def test_memory_store(self) -> None:
+        self.assert_store_happy_path(create_request_store('memory', self.db_path))
+        self.assertFalse(self.db_path.exists())
+        self.assertIsInstance(create_request_store('memory', self.db_path), MemoryRequestStore)
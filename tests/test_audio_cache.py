@@ -0,0 +1,45 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from api.cache import AudioCache
+
+
+class TestAudioCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.temp_dir.name)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def write_wav(self, name: str, size: int) -> Path:
+        path = self.path / name
+        path.write_bytes(b'x' * size)
+        return path
+
+    def test_get_put_evict(self) -> None:
+        cache = AudioCache(self.path / 'cache', max_size_bytes=250)
+        key_a = AudioCache.key('model', 'Hello  world ', {'alpha': 1})
+        key_b = AudioCache.key('model', 'Hello world', {'alpha': 2})
+        key_c = AudioCache.key('other_model', 'Hello world', {'alpha': 1})
+        self.assertEqual(key_a, AudioCache.key('model', 'Hello world', {'alpha': 1}))
+        self.assertNotEqual(key_a, key_b)
+        self.assertNotEqual(key_a, key_c)
+
+        self.assertFalse(cache.get(key_a, self.path / 'out_a.wav'))
+        cache.put(key_a, self.write_wav('a.wav', 100))
+        cache.put(key_b, self.write_wav('b.wav', 100))
+        self.assertTrue(cache.get(key_a, self.path / 'out_a.wav'))
+        self.assertEqual(100, (self.path / 'out_a.wav').stat().st_size)
+
+        # b is the least recently used entry
+        cache.put(key_c, self.write_wav('c.wav', 100))
+        self.assertFalse(cache.get(key_b, self.path / 'out_b.wav'))
+        stats = cache.stats()
+        self.assertEqual({'hits': 1, 'misses': 2, 'evictions': 1, 'entries': 2, 'size_bytes': 200},
+                         {k: stats[k] for k in ['hits', 'misses', 'evictions', 'entries', 'size_bytes']})
+
+        reloaded = AudioCache(self.path / 'cache', max_size_bytes=250)
+        self.assertEqual(list(cache.entries.items()), list(reloaded.entries.items()))
@@ -1,6 +1,11 @@
+import pickle
+import tempfile
 import unittest
+from pathlib import Path
+from unittest.mock import patch
 
-from utils.text.cleaners import Cleaner
+from utils.files import unpickle_binary
+from utils.text.cleaners import Cleaner, PhonemeCache
 
 
 class TestCleaner(unittest.TestCase):
@@ -23,3 +28,72 @@ class TestCleaner(unittest.TestCase):
                           use_phonemes=False, lang='en-us')
         cleaned = cleaner('hello there Mr. 1!')
         self.assertEqual('hello there mister one!', cleaned)
+
+    @patch('utils.text.cleaners.phonemize')
+    def test_phoneme_cache(self, phonemize_mock) -> None:
+        phonemes = {'hello there?!.': 'həloʊ ðɛɹ?!.', 'you!': 'juː!'}
+        phonemize_mock.side_effect = lambda texts, **kwargs: [phonemes[t] for t in texts]
+
+        cache = PhonemeCache()
+        cleaner = Cleaner(cleaner_name='no_cleaners', use_phonemes=True,
+                          lang='en-us', phoneme_cache=cache)
+        # whole texts are phonemized to keep the sentence context
+        self.assertEqual(['həloʊ ðɛɹ?!.', 'juː!', ''], cleaner.clean_batch(['hello there?!.', 'you!', '']))
+        self.assertEqual(['hello there?!.', 'you!'], phonemize_mock.call_args[0][0])
+        self.assertEqual('juː!', cleaner('you!'))
+        self.assertEqual(1, phonemize_mock.call_count)
+
+    @patch('utils.text.cleaners.phonemize')
+    def test_phoneme_cache_words(self, phonemize_mock) -> None:
+        phonemes = {'hello': 'həloʊ', 'there': 'ðɛɹ', 'you': 'juː'}
+        phonemize_mock.side_effect = lambda words, **kwargs: [phonemes[w] for w in words]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = Path(tmp_dir) / 'phonemes.pkl'
+            cache = PhonemeCache(path=cache_path)
+            cleaner = Cleaner(cleaner_name='no_cleaners', use_phonemes=True,
+                              lang='en-us', phoneme_cache=cache, cache_words=True)
+            self.assertEqual('həloʊ ðɛɹ?!.', cleaner('hello there?!.'))
+            self.assertEqual(['hello', 'there'], phonemize_mock.call_args[0][0])
+
+            # only the missing word is phonemized
+            self.assertEqual('həloʊ, juː!', cleaner('hello, you!'))
+            self.assertEqual(['you'], phonemize_mock.call_args[0][0])
+            self.assertEqual(2, phonemize_mock.call_count)
+
+            # a batch of texts needs a single phonemizer call for all missing words
+            phonemes.update({'is': 'ɪz', 'it': 'ɪt'})
+            self.assertEqual(['ɪz ɪt?', 'juː ðɛɹ.'], cleaner.clean_batch(['is it?', 'you there.']))
+            self.assertEqual(['is', 'it'], phonemize_mock.call_args[0][0])
+            self.assertEqual(3, phonemize_mock.call_count)
+
+            cache.save()
+            reloaded = PhonemeCache(path=cache_path)
+            self.assertEqual(dict(cache.entries), dict(reloaded.entries))
+
+    @patch('utils.text.cleaners.phonemize')
+    def test_phoneme_cache_workers(self, phonemize_mock) -> None:
+        phonemize_mock.side_effect = lambda texts, **kwargs: [t.upper() for t in texts]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = Path(tmp_dir) / 'phonemes.pkl'
+            cache = PhonemeCache(path=cache_path)
+            cache(['a'], 'en-us')
+            cache.save()
+
+            # a worker copy reads the cache file but returns its new entries instead of saving them
+            worker_cache = pickle.loads(pickle.dumps(cache))
+            self.assertFalse(worker_cache.autosave)
+            self.assertEqual({'a': 'A', 'b': 'B'}, worker_cache(['a', 'b'], 'en-us'))
+            self.assertEqual({('en-us', 'b'): 'B'}, worker_cache.pop_new_entries())
+            self.assertEqual({}, worker_cache.pop_new_entries())
+            self.assertEqual({('en-us', 'a'): 'A'}, unpickle_binary(cache_path))
+
+            # saving merges the entries that another process saved in the meantime
+            other_cache = PhonemeCache(path=cache_path)
+            other_cache(['c'], 'en-us')
+            other_cache.flush()
+            cache.update({('en-us', 'b'): 'B'})
+            cache.flush()
+            self.assertEqual({('en-us', 'a'): 'A', ('en-us', 'b'): 'B', ('en-us', 'c'): 'C'},
+                             unpickle_binary(cache_path))
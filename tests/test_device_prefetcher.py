@@ -0,0 +1,45 @@
+import pickle
+import threading
+import unittest
+
+import torch
+
+from trainer.common import DevicePrefetcher
+from utils.dataset import TTSCollator
+
+
+class TestDevicePrefetcher(unittest.TestCase):
+
+    def test_iterate(self) -> None:
+        batches = [{'x': torch.full((2, 3), fill_value=i), 'item_id': [str(i)]} for i in range(5)]
+        prefetcher = DevicePrefetcher(batches, device=torch.device('cpu'), depth=2)
+        self.assertEqual(5, len(prefetcher))
+        for epoch in range(2):
+            result = list(prefetcher)
+            self.assertEqual([b['item_id'] for b in batches], [b['item_id'] for b in result])
+            for batch, expected in zip(result, batches):
+                self.assertTrue(torch.equal(expected['x'], batch['x']))
+
+    def test_early_stop(self) -> None:
+        num_threads = threading.active_count()
+        batches = [{'x': torch.zeros(1)} for _ in range(10)]
+        for i, _ in enumerate(DevicePrefetcher(batches, device=torch.device('cpu'), depth=1)):
+            if i == 2:
+                break
+        self.assertEqual(num_threads, threading.active_count())
+
+    def test_loader_error(self) -> None:
+        def loader():
+            yield {'x': torch.zeros(1)}
+            raise ValueError('broken batch')
+
+        class Loader:
+            def __iter__(self):
+                return loader()
+
+        with self.assertRaises(ValueError):
+            list(DevicePrefetcher(Loader(), device=torch.device('cpu')))
+
+    def test_collator_is_picklable(self) -> None:
+        collator = pickle.loads(pickle.dumps(TTSCollator(r=2)))
+        self.assertEqual(2, collator.r)
@@ -55,3 +55,24 @@ class TestDurationExtractor(unittest.TestCase):
         durs, att_score = duration_extractor(x=x, mel=mel, att=att)
         expected = [2., 2., 2., 2., 2]
         self.assertEqual(expected, durs.tolist())
+
+    def test_extract_batch(self) -> None:
+        torch.manual_seed(42)
+        x_lens, mel_lens = [5, 3, 7], [10, 4, 20]
+        x = torch.zeros(3, 7).long()
+        mel = torch.full((3, 80, 20), fill_value=-11.51).float()
+        att = torch.zeros(3, 20, 7)
+        for b, (x_len, mel_len) in enumerate(zip(x_lens, mel_lens)):
+            x[b, :x_len] = torch.randint(5, 30, (x_len,))
+            mel[b, :, :mel_len] = torch.randn(80, mel_len) - 10.5
+            att[b, :mel_len, :x_len] = torch.softmax(torch.randn(mel_len, x_len), dim=1)
+
+        duration_extractor = DurationExtractor(silence_threshold=-11., silence_prob_shift=0.25)
+        results = duration_extractor.extract_batch(x=x, mel=mel, att=att, x_lens=x_lens, mel_lens=mel_lens)
+        for b, (durs, att_score) in enumerate(results):
+            x_len, mel_len = x_lens[b], mel_lens[b]
+            expected_durs, expected_score = duration_extractor(x=x[b, :x_len], mel=mel[b, :, :mel_len],
+                                                               att=att[b, :mel_len, :x_len])
+            self.assertEqual(expected_durs.tolist(), durs.tolist())
+            self.assertAlmostEqual(expected_score, att_score, places=6)
+            self.assertEqual(mel_len, int(durs.sum()))
@@ -0,0 +1,143 @@
+import io
+import pickle
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from pathlib import Path
+
+import numpy as np
+from torch.utils.data import DataLoader
+
+from utils.dataset import VocoderDataset
+from utils.feature_store import FeatureStore, FeatureCache, ShardWriter, get_shard_dir, pack_feature, unpack_feature
+
+
+class TestFeatureStore(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = Path(tempfile.mkdtemp(prefix='TestFeatureStoreTmp'))
+        self.mel_dir = self.temp_dir / 'mel'
+        self.mel_dir.mkdir()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_write_read(self) -> None:
+        arrays = {'0': np.random.randn(80, 7).astype(np.float32),
+                  '1': np.arange(5, dtype=np.int64),
+                  '2': np.zeros((0,), dtype=np.float32),
+                  '3': np.random.randn(3, 2)}
+        with ShardWriter(get_shard_dir(self.mel_dir), shard_size=100) as writer:
+            for item_id, array in arrays.items():
+                writer.write(item_id, array)
+
+        store = FeatureStore(self.mel_dir)
+        self.assertTrue(store.packed)
+        self.assertGreater(len(list(get_shard_dir(self.mel_dir).glob('*.bin'))), 1)
+        for item_id, array in arrays.items():
+            self.assertIn(item_id, store)
+            self.assertEqual(array.dtype, store[item_id].dtype)
+            np.testing.assert_array_equal(array, store[item_id])
+        self.assertNotIn('4', store)
+
+        # memmaps are not pickled
+        store['0']
+        store = pickle.loads(pickle.dumps(store))
+        self.assertEqual({}, store._shards)
+        np.testing.assert_array_equal(arrays['3'], store['3'])
+
+    def test_pack_unpack(self) -> None:
+        np.save(self.mel_dir / '0.npy', np.full((2, 3), 1.))
+        np.save(self.mel_dir / '1.npy', np.full((2, 4), 2.))
+        self.assertEqual(2, pack_feature(self.mel_dir))
+        self.assertEqual([], list(self.mel_dir.glob('*.npy')))
+
+        # new files are merged into the existing shards and override packed items
+        np.save(self.mel_dir / '1.npy', np.full((2, 5), 3.))
+        np.save(self.mel_dir / '2.npy', np.full((2, 1), 4.))
+        self.assertEqual(2, pack_feature(self.mel_dir))
+        store = FeatureStore(self.mel_dir)
+        self.assertEqual([1.] * 6, store['0'].flatten().tolist())
+        self.assertEqual([3.] * 10, store['1'].flatten().tolist())
+        self.assertEqual([4.] * 2, store['2'].flatten().tolist())
+
+        self.assertEqual(3, unpack_feature(self.mel_dir))
+        self.assertFalse(get_shard_dir(self.mel_dir).exists())
+        store = FeatureStore(self.mel_dir)
+        self.assertFalse(store.packed)
+        self.assertEqual([3.] * 10, store['1'].flatten().tolist())
+
+    def test_stale_shards(self) -> None:
+        np.save(self.mel_dir / '0.npy', np.full((2, 3), 1.))
+        pack_feature(self.mel_dir)
+
+        # a stage that writes .npy files unpacks the feature first, the new file replaces the packed item
+        unpack_feature(self.mel_dir)
+        np.save(self.mel_dir / '0.npy', np.full((2, 3), 2.))
+        store = FeatureStore(self.mel_dir)
+        self.assertFalse(store.packed)
+        self.assertEqual([2.] * 6, store['0'].flatten().tolist())
+
+        # .npy files next to shards are reported, as the store reads the shards
+        pack_feature(self.mel_dir)
+        np.save(self.mel_dir / '0.npy', np.full((2, 3), 3.))
+        with redirect_stdout(io.StringIO()) as out:
+            FeatureStore(self.mel_dir)
+        self.assertIn('WARNING', out.getvalue())
+
+    def test_pack_feature_dtype(self) -> None:
+        for i in range(3):
+            np.save(self.mel_dir / f'{i}.npy', np.arange(i + 1, dtype=np.int64) * 1000)
+        pack_feature(self.mel_dir, dtype=np.uint16)
+        store = FeatureStore(self.mel_dir)
+        self.assertEqual(np.uint16, store['2'].dtype)
+        self.assertEqual([0, 1000, 2000], store['2'].tolist())
+
+        np.save(self.mel_dir / '3.npy', np.array([-1], dtype=np.int64))
+        with self.assertRaises(ValueError):
+            pack_feature(self.mel_dir, dtype=np.uint16)
+        self.assertEqual([0, 1000, 2000], FeatureStore(self.mel_dir)['2'].tolist())
+
+    def test_vocoder_dataset_windows(self) -> None:
+        quant_dir = self.temp_dir / 'quant'
+        quant_dir.mkdir()
+        hop_length, voc_pad, voc_seq_len = 4, 1, 8
+        mel = np.arange(3 * 20, dtype=np.float32).reshape(3, 20)
+        np.save(self.mel_dir / '0.npy', mel)
+        np.save(quant_dir / '0.npy', np.arange(20 * hop_length, dtype=np.uint16))
+        dataset = VocoderDataset(self.temp_dir, ['0'], hop_length=hop_length,
+                                 voc_pad=voc_pad, voc_seq_len=voc_seq_len)
+        for _ in range(10):
+            item = dataset[0]
+            mel_offset = int(item['mel'][0, 0])
+            sig_offset = (mel_offset + voc_pad) * hop_length
+            np.testing.assert_array_equal(mel[:, mel_offset:mel_offset + 4], item['mel'])
+            self.assertEqual(np.int64, item['x'].dtype)
+            self.assertEqual(list(range(sig_offset, sig_offset + voc_seq_len + 1)), item['x'].tolist())
+
+    def test_feature_cache(self) -> None:
+        quant_dir = self.temp_dir / 'quant'
+        quant_dir.mkdir()
+        for i in range(4):
+            np.save(self.mel_dir / f'{i}.npy', np.full((2, 8), fill_value=i, dtype=np.float32))
+            np.save(quant_dir / f'{i}.npy', np.arange(i + 1, dtype=np.int64))
+        pack_feature(quant_dir)
+
+        # each item takes 64 bytes for the mel and 64 bytes for the quant array
+        cache = FeatureCache({'mel': FeatureStore(self.mel_dir), 'quant': FeatureStore(quant_dir)})
+        self.assertEqual(2, cache.fill(['0', '1', '2', '3'], max_bytes=300))
+        self.assertEqual(256, cache.num_bytes)
+        self.assertTrue(cache.buffer.is_shared())
+        self.assertIn(('mel', '1'), cache.index)
+        self.assertNotIn(('mel', '2'), cache.index)
+        for i in range(4):
+            self.assertEqual([float(i)] * 16, cache['mel', str(i)].flatten().tolist())
+            self.assertEqual(list(range(i + 1)), cache['quant', str(i)].tolist())
+        self.assertFalse(cache['mel', '0'].flags.writeable)
+
+        dataset = VocoderDataset(self.temp_dir, ['0', '1', '2', '3'], feature_cache=cache)
+        loader = DataLoader(dataset, batch_size=None, num_workers=2, collate_fn=lambda item: item)
+        for i, item in enumerate(loader):
+            self.assertEqual([float(i)] * 16, item['mel'].flatten().tolist())
+            self.assertEqual(list(range(i + 1)), item['x'].tolist())
@@ -0,0 +1,66 @@
+import unittest
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from models.fast_pitch import FastPitch
+from models.forward_tacotron import ForwardTacotron
+
+
+def new_forward_tacotron() -> ForwardTacotron:
+    return ForwardTacotron(embed_dims=16, series_embed_dims=8, num_chars=20,
+                           durpred_conv_dims=8, durpred_rnn_dims=8, durpred_dropout=0.,
+                           pitch_conv_dims=8, pitch_rnn_dims=8, pitch_dropout=0., pitch_strength=1.,
+                           energy_conv_dims=8, energy_rnn_dims=8, energy_dropout=0., energy_strength=1.,
+                           rnn_dims=16, prenet_dims=16, prenet_k=4, postnet_num_highways=1,
+                           prenet_dropout=0., postnet_dims=16, postnet_k=4, prenet_num_highways=1,
+                           postnet_dropout=0., n_mels=10)
+
+
+def new_fast_pitch() -> FastPitch:
+    return FastPitch(num_chars=20,
+                     durpred_dropout=0., durpred_d_model=16, durpred_n_heads=2, durpred_layers=1, durpred_d_fft=16,
+                     pitch_dropout=0., pitch_d_model=16, pitch_n_heads=2, pitch_layers=1, pitch_d_fft=16,
+                     energy_dropout=0., energy_d_model=16, energy_n_heads=2, energy_layers=1, energy_d_fft=16,
+                     pitch_strength=1., energy_strength=1., d_model=16, conv1_kernel=3, conv2_kernel=1,
+                     prenet_layers=1, prenet_heads=2, prenet_fft=16, prenet_dropout=0.,
+                     postnet_layers=1, postnet_heads=2, postnet_fft=16, postnet_dropout=0., n_mels=10)
+
+
+class TestForwardGenerate(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(42)
+        self.seqs = [torch.randint(1, 20, (n,)) for n in (7, 3, 12)]
+        self.x_lens = torch.tensor([len(s) for s in self.seqs])
+        self.x = pad_sequence(self.seqs, batch_first=True)
+
+    def assert_batch_matches_single(self, model: torch.nn.Module) -> None:
+        model.eval()
+        batch_gen = model.generate(self.x, x_lens=self.x_lens)
+        for i, seq in enumerate(self.seqs):
+            gen = model.generate(seq.unsqueeze(0))
+            mel_len = int(batch_gen['mel_len'][i])
+            self.assertEqual(gen['mel_post'].size(-1), mel_len)
+            torch.testing.assert_close(gen['mel_post'], batch_gen['mel_post'][i:i+1, :, :mel_len],
+                                       rtol=1e-4, atol=1e-4)
+
+    def test_forward_tacotron_batch_generate(self) -> None:
+        self.assert_batch_matches_single(new_forward_tacotron())
+
+    def test_fast_pitch_batch_generate(self) -> None:
+        self.assert_batch_matches_single(new_fast_pitch())
+
+    def assert_scripted_matches_eager(self, model: torch.nn.Module) -> None:
+        model.eval()
+        scripted = torch.jit.script(model)
+        eager_gen = model.generate(self.x, x_lens=self.x_lens, pitch_function=lambda p: p * 1.5)
+        scripted_gen = scripted.generate_jit(self.x, alpha=1., beta=1.5, gamma=1., x_lens=self.x_lens)
+        torch.testing.assert_close(scripted_gen['mel_len'], eager_gen['mel_len'])
+        torch.testing.assert_close(scripted_gen['mel_post'], eager_gen['mel_post'])
+
+    def test_forward_tacotron_scripted_generate(self) -> None:
+        self.assert_scripted_matches_eager(new_forward_tacotron())
+
+    def test_fast_pitch_scripted_generate(self) -> None:
+        self.assert_scripted_matches_eager(new_fast_pitch())
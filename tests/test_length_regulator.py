@@ -0,0 +1,42 @@
+import unittest
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from models.common_layers import LengthRegulator
+
+
+def expand_loop(x: torch.Tensor, dur: torch.Tensor) -> torch.Tensor:
+    dur = torch.clamp(dur, min=0.)
+    x_expanded = [torch.repeat_interleave(x[i], (dur[i] + 0.5).long(), dim=0) for i in range(x.size(0))]
+    return pad_sequence(x_expanded, padding_value=0., batch_first=True)
+
+
+class TestLengthRegulator(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(42)
+        self.lr = LengthRegulator()
+
+    def test_matches_loop(self) -> None:
+        for batch_size in [1, 3, 16]:
+            x = torch.randn(batch_size, 11, 4)
+            dur = torch.randn(batch_size, 11) * 3. + 1.
+            dur[0, -3:] = 0.
+            expected = expand_loop(x, dur)
+            x_expanded, mask = self.lr(x, dur)
+            torch.testing.assert_close(x_expanded, expected, rtol=0, atol=0)
+            mel_lens = (torch.clamp(dur, min=0.) + 0.5).long().sum(dim=1)
+            self.assertEqual(mel_lens.tolist(), mask.sum(dim=1).tolist())
+
+    def test_does_not_mutate_dur(self) -> None:
+        dur = torch.tensor([[-1., 2., 0.25]])
+        x_expanded, mask = self.lr(torch.ones(1, 3, 2), dur)
+        self.assertEqual([-1., 2., 0.25], dur[0].tolist())
+        self.assertEqual((1, 2, 2), tuple(x_expanded.shape))
+        self.assertEqual([[True, True]], mask.tolist())
+
+    def test_zero_durations(self) -> None:
+        x_expanded, mask = self.lr(torch.ones(2, 3, 2), torch.zeros(2, 3))
+        self.assertEqual((2, 0, 2), tuple(x_expanded.shape))
+        self.assertEqual((2, 0), tuple(mask.shape))
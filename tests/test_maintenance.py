@@ -0,0 +1,70 @@
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from api.api_db import MemoryRequestStore
+from api.cache import AudioCache
+from api.maintenance import MaintenanceService
+
+
+class TestMaintenanceService(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.temp_dir.name)
+        (self.path / 'cache').mkdir()
+        (self.path / 'cache' / 'cached.wav').write_bytes(b'x' * 100)
+
+    def tearDown(self) -> None:
+        self.temp_dir.cleanup()
+
+    def write_wav(self, name: str, size: int, age_s: float) -> Path:
+        path = self.path / name
+        path.write_bytes(b'x' * size)
+        mtime = time.time() - age_s
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_delete_expired_and_over_quota(self) -> None:
+        self.write_wav('expired.wav', 100, age_s=7200)
+        self.write_wav('old.wav', 100, age_s=1800)
+        self.write_wav('new.wav', 100, age_s=10)
+        os.link(self.path / 'new.wav', self.path / 'cache' / 'new_link.wav')
+        self.write_wav('newest.wav', 100, age_s=1)
+
+        service = MaintenanceService(MemoryRequestStore(), self.path, wav_ttl_s=3600, max_output_bytes=150)
+        metrics = service.run_once()
+
+        self.assertEqual(['newest.wav'], [p.name for p in self.path.glob('*.wav')])
+        self.assertTrue((self.path / 'cache' / 'cached.wav').is_file())
+        self.assertEqual(3, metrics['deleted_files'])
+        self.assertEqual(200, metrics['reclaimed_bytes'])
+        self.assertEqual(100, metrics['output_bytes'])
+
+    def test_keep_served_cache_hit(self) -> None:
+        cache = AudioCache(self.path / 'audio_cache', max_size_bytes=10000)
+        synthesized = self.write_wav('synthesized.wav', 100, age_s=7200)
+        cache.put('key', synthesized)
+        cache_mtime = time.time() - 7200
+        os.utime(cache.cache_dir / 'key.wav', (cache_mtime, cache_mtime))
+
+        self.assertTrue(cache.get('key', self.path / 'served.wav'))
+        service = MaintenanceService(MemoryRequestStore(), self.path, wav_ttl_s=3600, max_output_bytes=150)
+        service.run_once()
+
+        self.assertEqual(['served.wav'], [p.name for p in self.path.glob('*.wav')])
+        self.assertEqual(b'x' * 100, (self.path / 'served.wav').read_bytes())
+        self.assertTrue((cache.cache_dir / 'key.wav').is_file())
+
+    def test_delete_rows(self) -> None:
+        store = MemoryRequestStore()
+        request_ids = [store.add_request('text')[0] for _ in range(5)]
+        for request_id in request_ids[:3]:
+            row = store.rows[request_id]
+            store.rows[request_id] = row[:4] + (row[4] - 7200,) + row[5:]
+
+        service = MaintenanceService(store, self.path, request_ttl_s=3600, batch_size=2)
+        self.assertEqual(3, service.run_once()['deleted_rows'])
+        self.assertEqual(request_ids[3:], list(store.rows.keys()))
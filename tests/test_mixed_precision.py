@@ -0,0 +1,44 @@
+import unittest
+
+import torch
+
+from trainer.common import MixedPrecision
+
+
+class TestMixedPrecision(unittest.TestCase):
+
+    def test_disabled_matches_float32_step(self) -> None:
+        torch.manual_seed(42)
+        model = torch.nn.Linear(4, 2)
+        other = torch.nn.Linear(4, 2)
+        other.load_state_dict(model.state_dict())
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        other_optimizer = torch.optim.SGD(other.parameters(), lr=0.1)
+        x = torch.randn(3, 4)
+
+        amp = MixedPrecision(torch.device('cpu'))
+        with amp.autocast():
+            loss = model(x).pow(2).mean()
+        amp.step(loss, optimizer, model.parameters(), clip_grad_norm=0.1)
+
+        other_optimizer.zero_grad()
+        other(x).pow(2).mean().backward()
+        torch.nn.utils.clip_grad_norm_(other.parameters(), 0.1)
+        other_optimizer.step()
+
+        self.assertEqual(torch.float32, loss.dtype)
+        torch.testing.assert_close(other.weight, model.weight)
+
+    def test_cpu_autocast(self) -> None:
+        model = torch.nn.Linear(4, 2)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        amp = MixedPrecision(torch.device('cpu'), enabled=True, dtype='float16')
+        self.assertEqual(torch.bfloat16, amp.dtype)
+        self.assertFalse(amp.scaler.is_enabled())
+        with amp.autocast():
+            y = model(torch.randn(3, 4))
+        self.assertEqual(torch.bfloat16, y.dtype)
+        weight = model.weight.detach().clone()
+        amp.step(y.float().pow(2).mean(), optimizer, model.parameters(), clip_grad_norm=1.)
+        self.assertEqual(torch.float32, model.weight.dtype)
+        self.assertFalse(torch.equal(weight, model.weight))
@@ -0,0 +1,38 @@
+import unittest
+
+from api.registry import ModelRegistry
+
+
+class TestModelRegistry(unittest.TestCase):
+
+    def test_lazy_loading_and_eviction(self) -> None:
+        created = []
+        registry = ModelRegistry(max_models=2, memory_func=lambda model: 10)
+        for name in ['a', 'b', 'c']:
+            registry.register(name, lambda name=name: created.append(name) or f'model_{name}')
+
+        self.assertEqual([], created)
+        self.assertEqual('model_a', registry.get('a'))
+        self.assertEqual('model_b', registry.get('b'))
+        self.assertEqual('model_a', registry.get('a'))
+        self.assertEqual(['a', 'b'], created)
+
+        # b is the least recently used model
+        registry.get('c')
+        self.assertEqual(['a', 'c'], registry.stats()['loaded_models'])
+        registry.get('b')
+        self.assertEqual(['a', 'b', 'c', 'b'], created)
+        self.assertEqual(2, registry.stats()['evictions'])
+        self.assertIn('c', registry)
+        self.assertNotIn('d', registry)
+
+    def test_memory_budget_and_shared(self) -> None:
+        registry = ModelRegistry(max_memory_bytes=25, memory_func=lambda model: 10)
+        for name in ['a', 'b', 'c']:
+            registry.register(name, lambda name=name: name)
+        for name in ['a', 'b', 'c']:
+            registry.get(name)
+        self.assertEqual(['b', 'c'], registry.stats()['loaded_models'])
+
+        shared = [registry.shared('vocoder', lambda: object()) for _ in range(3)]
+        self.assertTrue(shared[0] is shared[1] is shared[2])
@@ -0,0 +1,29 @@
+import unittest
+
+import numpy as np
+
+from train_tacotron import average_phoneme_values, merge_stats
+
+
+class TestPhonemeValues(unittest.TestCase):
+
+    def test_average_phoneme_values(self) -> None:
+        values = np.array([1., 3., 0., 5., 700., 2., 4.], dtype=np.float32)
+        durs = np.array([0, 2, 3, 0, 2, 0])
+        mask = (values != 0.) & (values < 600.)
+        result = average_phoneme_values(values, durs, mask)
+        self.assertEqual(np.float32, result.dtype)
+        self.assertEqual([0., 2., 5., 0., 3., 0.], result.tolist())
+
+        result = average_phoneme_values(values, durs)
+        self.assertAlmostEqual(235., float(result[2]), places=4)
+
+    def test_merge_stats(self) -> None:
+        values = np.random.RandomState(42).rand(100)
+        stats = (0, 0., 0.)
+        for chunk in np.split(values, [10, 11, 60]):
+            stats = merge_stats(stats, (len(chunk), float(np.mean(chunk)), float(np.sum((chunk - np.mean(chunk)) ** 2))))
+        n, mean, m2 = stats
+        self.assertEqual(100, n)
+        self.assertAlmostEqual(float(np.mean(values)), mean, places=10)
+        self.assertAlmostEqual(float(np.std(values)), float(np.sqrt(m2 / n)), places=10)
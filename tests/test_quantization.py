@@ -0,0 +1,41 @@
+import unittest
+
+import torch
+import torch.nn as nn
+
+from models.fatchord_version import WaveRNN
+from utils.quantization import quantize_model
+from tests.test_forward_generate import new_forward_tacotron
+from tests.test_wavernn_generate import new_wavernn
+
+
+class TestQuantization(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(42)
+
+    def test_quantize_forward_tacotron(self) -> None:
+        model = new_forward_tacotron().eval()
+        quantized = quantize_model(model)
+        self.assertIsInstance(model.dur_pred.lin, nn.Linear)
+        self.assertIsInstance(quantized.dur_pred.lin, torch.nn.quantized.dynamic.Linear)
+
+        x = torch.randint(1, 20, (2, 9))
+        x_lens = torch.tensor([9, 5])
+        gen = model.generate_jit(x, 1., 1., 1., x_lens)
+        gen_quantized = quantized.generate_jit(x, 1., 1., 1., x_lens)
+        torch.testing.assert_close(gen_quantized['mel_post'], gen['mel_post'], rtol=0.1, atol=0.1)
+
+    def test_quantize_scripted_model(self) -> None:
+        scripted = torch.jit.script(new_forward_tacotron().eval())
+        with self.assertRaises(ValueError):
+            quantize_model(scripted)
+
+    def test_quantized_wavernn(self) -> None:
+        model: WaveRNN = new_wavernn()
+        mel = torch.randn(1, 10, 30)
+        wav = model.generate(mel, batched=True, target=200, overlap=50, mu_law=True, silent=True)
+        model.use_quantized = True
+        wav_quantized = model.generate(mel, batched=True, target=200, overlap=50, mu_law=True, silent=True)
+        self.assertEqual(len(wav), len(wav_quantized))
+        self.assertIsInstance(model.fc3, nn.Linear)
@@ -0,0 +1,15 @@
+import unittest
+
+from utils.text.splitter import split_sentences
+
+
+class TestSplitter(unittest.TestCase):
+
+    def test_split_sentences_happy_path(self) -> None:
+        sentences = split_sentences('Hello there.  How are you? "I am fine!" she said; ok')
+        self.assertEqual(['Hello there.', 'How are you?', '"I am fine!"', 'she said;', 'ok'], sentences)
+
+    def test_split_long_sentences(self) -> None:
+        sentences = split_sentences('one two, three four, five six seven eight', max_chars=12)
+        self.assertEqual(['one two,', 'three four,', 'five six', 'seven eight'], sentences)
+        self.assertEqual([], split_sentences('  '))
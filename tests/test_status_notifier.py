@@ -0,0 +1,28 @@
+import threading
+import time
+import unittest
+
+from api.api_db import RequestStatus
+from api.notifier import StatusNotifier
+
+
+class TestStatusNotifier(unittest.TestCase):
+
+    def test_wait_for_status(self) -> None:
+        notifier = StatusNotifier(max_entries=2)
+        self.assertIsNone(notifier.wait('unknown', timeout=0.))
+
+        notifier.publish('a', RequestStatus.PENDING)
+        self.assertEqual(RequestStatus.PENDING, notifier.wait('a', timeout=0.01))
+
+        publisher = threading.Timer(0.05, notifier.publish, args=('a', RequestStatus.COMPLETED))
+        publisher.start()
+        start = time.time()
+        self.assertEqual(RequestStatus.COMPLETED, notifier.wait('a', timeout=10.))
+        self.assertLess(time.time() - start, 5.)
+        publisher.join()
+
+        notifier.publish('b', RequestStatus.FAILED)
+        notifier.publish('c', RequestStatus.PENDING)
+        self.assertIsNone(notifier.status('a'))
+        self.assertEqual(RequestStatus.FAILED, notifier.status('b'))
@@ -0,0 +1,37 @@
+import unittest
+
+import numpy as np
+
+from utils.dataset import TokenBudgetSampler
+
+
+class TestTokenBudgetSampler(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.lengths = np.random.RandomState(0).randint(10, 200, 500).tolist()
+
+    def test_batches_within_budget(self) -> None:
+        sampler = TokenBudgetSampler(self.lengths, max_frames=1000, max_batch_size=16, bucket_size=64)
+        batches = list(sampler)
+        self.assertEqual(list(range(len(self.lengths))), sorted(i for batch in batches for i in batch))
+        for batch in batches:
+            self.assertLessEqual(len(batch), 16)
+            self.assertLessEqual(max(self.lengths[i] for i in batch) * len(batch), 1000)
+        self.assertGreater(len(set(len(batch) for batch in batches)), 1)
+        self.assertLess(sampler.padding_waste, 0.2)
+
+    def test_long_item_forms_own_batch(self) -> None:
+        sampler = TokenBudgetSampler([10, 500, 20], max_frames=100)
+        self.assertIn([1], list(sampler))
+
+    def test_seeding(self) -> None:
+        sampler = TokenBudgetSampler(self.lengths, max_frames=1000, seed=1)
+        other = TokenBudgetSampler(self.lengths, max_frames=1000, seed=1)
+        epoch_0 = list(sampler)
+        self.assertEqual(epoch_0, list(sampler))
+        self.assertEqual(epoch_0, list(other))
+        sampler.set_epoch(1)
+        self.assertEqual(len(sampler), len(list(sampler)))
+        self.assertNotEqual(epoch_0, list(sampler))
+        other.set_epoch(1)
+        self.assertEqual(list(sampler), list(other))
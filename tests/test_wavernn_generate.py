@@ -0,0 +1,69 @@
+import unittest
+
+import numpy as np
+import torch
+
+from models.fatchord_version import WaveRNN
+
+
+def new_wavernn(mode: str = 'RAW') -> WaveRNN:
+    return WaveRNN(rnn_dims=16, fc_dims=16, bits=9, pad=2, upsample_factors=(4, 4, 4),
+                   feat_dims=10, compute_dims=16, res_out_dims=16, res_blocks=1,
+                   hop_length=64, sample_rate=22050, mode=mode)
+
+
+class TestWaveRNNGenerate(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(42)
+        self.model = new_wavernn()
+        self.mel = torch.randn(1, 10, 40)
+
+    def test_generate_stream(self) -> None:
+        torch.manual_seed(1)
+        wav = self.model.generate(self.mel, batched=True, target=200, overlap=50, mu_law=True, silent=True)
+        torch.manual_seed(1)
+        chunks = list(self.model.generate_stream(self.mel, target=200, overlap=50, mu_law=True, folds_per_chunk=4))
+        torch.manual_seed(1)
+        all_chunks = list(self.model.generate_stream(self.mel, target=200, overlap=50, mu_law=True, folds_per_chunk=100))
+
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(1, len(all_chunks))
+        np.testing.assert_array_equal(wav, all_chunks[0])
+        self.assertEqual(len(wav), sum(len(c) for c in chunks))
+
+    def test_generate_batch(self) -> None:
+        mels = [self.mel, torch.randn(1, 10, 30)]
+        wavs = self.model.generate_batch(mels, target=200, overlap=50, mu_law=True, silent=True)
+        for mel, wav in zip(mels, wavs):
+            single_wav = self.model.generate(mel, batched=True, target=200, overlap=50, mu_law=True, silent=True)
+            self.assertEqual(len(single_wav), len(wav))
+
+    def test_generate_keeps_eval_mode(self) -> None:
+        # the vocoder is shared between threads, inference must not switch the batch norm back to training
+        self.model.eval()
+        running_mean = self.model.upsample.resnet.batch_norm.running_mean.clone()
+        self.model.generate(self.mel, batched=True, target=200, overlap=50, mu_law=True, silent=True)
+        list(self.model.generate_stream(self.mel, target=200, overlap=50, mu_law=True))
+        self.model.generate_batch([self.mel], target=200, overlap=50, mu_law=True, silent=True)
+        self.assertFalse(any(module.training for module in self.model.modules()))
+        torch.testing.assert_close(running_mean, self.model.upsample.resnet.batch_norm.running_mean)
+
+    def test_generate_short_mel(self) -> None:
+        mel = torch.randn(1, 10, 5)
+        wav = self.model.generate(mel, batched=True, target=200, overlap=50, mu_law=True, silent=True)
+        self.assertEqual(4 * 64, len(wav))
+        chunks = list(self.model.generate_stream(mel, target=200, overlap=50, mu_law=True))
+        self.assertEqual(len(wav), sum(len(c) for c in chunks))
+        wavs = self.model.generate_batch([mel, self.mel], target=200, overlap=50, mu_law=True, silent=True)
+        self.assertEqual(len(wav), len(wavs[0]))
+
+    def test_generate_jit(self) -> None:
+        for mode in ['RAW', 'MOL']:
+            model = new_wavernn(mode)
+            torch.manual_seed(1)
+            wav = model.generate(self.mel, batched=True, target=200, overlap=50, mu_law=True, silent=True)
+            model.use_jit = True
+            torch.manual_seed(1)
+            jit_wav = model.generate(self.mel, batched=True, target=200, overlap=50, mu_law=True, silent=True)
+            np.testing.assert_array_equal(wav, jit_wav)
@@ -12,12 +12,13 @@ from torch.utils.data.dataloader import DataLoader
 
 from models.forward_tacotron import ForwardTacotron
 from models.tacotron import Tacotron
-from trainer.common import to_device
+from trainer.common import MixedPrecision, to_device
 from trainer.forward_trainer import ForwardTrainer
 from utils.checkpoints import restore_checkpoint, init_tts_model
 from utils.dataset import get_tts_datasets
 from utils.display import *
 from utils.dsp import DSP
+from utils.feature_store import FeatureStore, pack_feature, unpack_feature
 from utils.files import read_config
 from utils.paths import Paths
 
@@ -64,8 +65,9 @@ if __name__ == '__main__':
     dsp = DSP.from_config(config)
     paths = Paths(config['data_path'], config['voc_model_id'], config['tts_model_id'])
 
-    assert len(os.listdir(paths.alg)) > 0, f'Could not find alignment files in {paths.alg}, please predict ' \
-                                           f'alignments first with python train_tacotron.py --force_align!'
+    assert FeatureStore(paths.alg).packed or len(os.listdir(paths.alg)) > 0, \
+        f'Could not find alignment files in {paths.alg}, please predict ' \
+        f'alignments first with python train_tacotron.py --force_align!'
 
     force_gta = args.force_gta
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
@@ -75,18 +77,24 @@ if __name__ == '__main__':
     model = init_tts_model(config).to(device)
     print(f'\nInitialized tts model: {model}\n')
     optimizer = optim.Adam(model.parameters())
+    amp = MixedPrecision.from_config(config[config.get('tts_model', 'forward_tacotron')]['training'], device)
     restore_checkpoint(model=model, optim=optimizer,
                        path=paths.forward_checkpoints / 'latest_model.pt',
-                       device=device)
+                       device=device, scaler=amp.scaler)
 
     if force_gta:
         print('Creating Ground Truth Aligned Dataset...\n')
         train_set, val_set = get_tts_datasets(
             paths.data, 8, r=1, model_type='forward',
             filter_attention=False, max_mel_len=None)
+        pack_features = config['preprocessing'].get('pack_features', False)
+        if not pack_features:
+            unpack_feature(paths.gta)
         create_gta_features(model, train_set, val_set, paths.gta)
+        if pack_features:
+            pack_feature(paths.gta)
         print('\n\nYou can now train WaveRNN on GTA features - use python train_wavernn.py --gta\n')
     else:
         trainer = ForwardTrainer(paths=paths, dsp=dsp, config=config)
-        trainer.train(model, optimizer)
+        trainer.train(model, optimizer, amp)
 
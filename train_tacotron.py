@@ -1,82 +1,157 @@
 import argparse
 import itertools
+from collections import deque
+from multiprocessing import Pool, cpu_count
 from pathlib import Path
-from typing import Tuple
+from typing import Tuple, Dict, Any, List
 
 import torch
 from torch import optim
 from torch.utils.data.dataloader import DataLoader
 
 from models.tacotron import Tacotron
-from trainer.common import to_device, np_now
+from trainer.common import MixedPrecision, to_device, np_now
 from trainer.taco_trainer import TacoTrainer
 from utils.checkpoints import restore_checkpoint
-from utils.dataset import get_tts_datasets
+from utils.dataset import get_tts_datasets, TacoDataset, TTSCollator
 from utils.display import *
 from utils.dsp import DSP
 from utils.duration_extractor import DurationExtractor
+from utils.feature_store import FeatureStore, pack_feature, unpack_feature
 from utils.files import pickle_binary, unpickle_binary, read_config
 from utils.metrics import attention_score
 from utils.paths import Paths
+from utils.text.tokenizer import Tokenizer
 
 
-def normalize_values(phoneme_val) -> Tuple[float, float]:
+def average_phoneme_values(values: np.array,
+                           durs: np.array,
+                           mask: np.array = None) -> np.array:
     """
-    Normalizes non-zero phoneme values to zero mean and unitary
-    variance and returns mean and std of the original distribution.
+    Averages frame values over the duration of each phoneme, frames outside the mask are ignored.
+    Phonemes without any valid frame get the value zero.
     """
-    nonzeros = np.concatenate([v[np.where(v != 0.0)[0]]
-                               for item_id, v in phoneme_val])
-    mean, std = np.mean(nonzeros), np.std(nonzeros)
-    for item_id, v in phoneme_val:
-        zero_idxs = np.where(v == 0.0)[0]
-        v -= mean
-        v /= std
-        v[zero_idxs] = 0.0
-    return float(mean), float(std)
+    if mask is None:
+        mask = np.ones(values.shape, dtype=bool)
+    # a zero frame is appended so that all segment starts are valid indices for reduceat
+    values = np.append(np.where(mask, values, 0.), 0.)
+    counts = np.append(mask, False).astype(np.int64)
+    starts = np.cumsum(durs) - durs
+    sums = np.add.reduceat(values, starts)
+    counts = np.add.reduceat(counts, starts)
+    # reduceat returns the value at the start index for empty segments
+    counts[durs == 0] = 0
+    return np.where(counts > 0, sums / np.maximum(counts, 1), 0.).astype(np.float32)
+
+
+class PhonemeValueExtractor:
+
+    def __init__(self,
+                 paths: Paths,
+                 save_path_pitch: Path,
+                 save_path_energy: Path,
+                 pitch_max_freq: float) -> None:
+        self.save_path_pitch = save_path_pitch
+        self.save_path_energy = save_path_energy
+        self.pitch_max_freq = pitch_max_freq
+        self.dur_store = FeatureStore(paths.alg)
+        self.mel_store = FeatureStore(paths.mel)
+        self.pitch_store = FeatureStore(paths.raw_pitch)
+
+    def __call__(self, item: Tuple[str, int]) -> Tuple[int, float, float]:
+        """
+        Saves the phoneme energy and the unnormalized phoneme pitch of an item.
+
+        :return: Count, mean and sum of squared deviations of the non-zero phoneme pitches.
+        """
+        item_id, mel_len = item
+        dur = self.dur_store[item_id]
+        mel = self.mel_store[item_id]
+        assert np.sum(dur) == mel_len
+        energy = np.linalg.norm(np.exp(mel), axis=0, ord=2)
+        pitch = self.pitch_store[item_id][:mel_len]
+        pitch = np.pad(pitch, (0, mel_len - len(pitch)))
+        pitch_mask = (pitch != 0.0) & (pitch < self.pitch_max_freq)
+        pitch_char = average_phoneme_values(pitch, dur, pitch_mask)
+        energy_char = average_phoneme_values(energy, dur)
+        np.save(str(self.save_path_energy / f'{item_id}.npy'), energy_char, allow_pickle=False)
+        np.save(str(self.save_path_pitch / f'{item_id}.npy'), pitch_char, allow_pickle=False)
+        nonzeros = pitch_char[pitch_char != 0.0].astype(np.float64)
+        if len(nonzeros) == 0:
+            return 0, 0., 0.
+        mean = float(np.mean(nonzeros))
+        return len(nonzeros), mean, float(np.sum((nonzeros - mean) ** 2))
+
+
+class PhonemeValueNormalizer:
+
+    def __init__(self,
+                 save_path: Path,
+                 mean: float,
+                 std: float) -> None:
+        self.save_path = save_path
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, item_id: str) -> None:
+        """ Normalizes the non-zero phoneme values of an item to zero mean and unitary variance. """
+        path = self.save_path / f'{item_id}.npy'
+        values = np.load(path)
+        values = np.where(values != 0.0, (values - self.mean) / self.std, 0.0).astype(np.float32)
+        np.save(str(path), values, allow_pickle=False)
+
+
+def merge_stats(stats_a: Tuple[int, float, float],
+                stats_b: Tuple[int, float, float]) -> Tuple[int, float, float]:
+    """ Merges (count, mean, sum of squared deviations) of two sets of values (Chan et al.). """
+    n_a, mean_a, m2_a = stats_a
+    n_b, mean_b, m2_b = stats_b
+    n = n_a + n_b
+    if n == 0:
+        return 0, 0., 0.
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n
 
 
 # adapted from https://github.com/NVIDIA/DeepLearningExamples/blob/
 # 0b27e359a5869cd23294c1707c92f989c0bf201e/PyTorch/SpeechSynthesis/FastPitch/extract_mels.py
 def extract_pitch_energy(save_path_pitch: Path,
                          save_path_energy: Path,
-                         pitch_max_freq: float) -> Tuple[float, float]:
+                         pitch_max_freq: float,
+                         num_workers: int = 1,
+                         pack_features: bool = False) -> Tuple[float, float]:
+    if not pack_features:
+        # shards of an earlier packed run would shadow the new .npy files
+        unpack_feature(save_path_pitch)
+        unpack_feature(save_path_energy)
     train_data = unpickle_binary(paths.data / 'train_dataset.pkl')
     val_data = unpickle_binary(paths.data / 'val_dataset.pkl')
     all_data = train_data + val_data
-    phoneme_pitches = []
-    phoneme_energies = []
-    for prog_idx, (item_id, mel_len) in enumerate(all_data, 1):
-        dur = np.load(paths.alg / f'{item_id}.npy')
-        mel = np.load(paths.mel / f'{item_id}.npy')
-        energy = np.linalg.norm(np.exp(mel), axis=0, ord=2)
-        assert np.sum(dur) == mel_len
-        pitch = np.load(paths.raw_pitch / f'{item_id}.npy')
-        durs_cum = np.cumsum(np.pad(dur, (1, 0)))
-        pitch_char = np.zeros((dur.shape[0],), dtype=np.float32)
-        energy_char = np.zeros((dur.shape[0],), dtype=np.float32)
-        for idx, a, b in zip(range(mel_len), durs_cum[:-1], durs_cum[1:]):
-            values = pitch[a:b][np.where(pitch[a:b] != 0.0)[0]]
-            values = values[np.where(values < pitch_max_freq)[0]]
-            pitch_char[idx] = np.mean(values) if len(values) > 0 else 0.0
-            energy_values = energy[a:b]
-            energy_char[idx] = np.mean(energy_values)if len(energy_values) > 0 else 0.0
-        phoneme_pitches.append((item_id, pitch_char))
-        phoneme_energies.append((item_id, energy_char))
-        bar = progbar(prog_idx, len(all_data))
-        msg = f'{bar} {prog_idx}/{len(all_data)} Files '
-        stream(msg)
+    extractor = PhonemeValueExtractor(paths=paths, save_path_pitch=save_path_pitch,
+                                      save_path_energy=save_path_energy, pitch_max_freq=pitch_max_freq)
+
+    # first pass saves the phoneme values and collects the pitch statistics, the second pass normalizes the pitch
+    pitch_stats = (0, 0., 0.)
+    with Pool(processes=num_workers) as pool:
+        for prog_idx, item_stats in enumerate(pool.imap(extractor, all_data, chunksize=16), 1):
+            pitch_stats = merge_stats(pitch_stats, item_stats)
+            bar = progbar(prog_idx, len(all_data))
+            msg = f'{bar} {prog_idx}/{len(all_data)} Files '
+            stream(msg)
 
-    for item_id, phoneme_energy in phoneme_energies:
-        np.save(str(save_path_energy / f'{item_id}.npy'), phoneme_energy, allow_pickle=False)
+        n, mean, m2 = pitch_stats
+        std = float(np.sqrt(m2 / n))
+        normalizer = PhonemeValueNormalizer(save_path=save_path_pitch, mean=mean, std=std)
+        for _ in pool.imap_unordered(normalizer, [item_id for item_id, _ in all_data], chunksize=64):
+            pass
 
-    mean, var = normalize_values(phoneme_pitches)
-    for item_id, phoneme_pitch in phoneme_pitches:
-        np.save(str(save_path_pitch / f'{item_id}.npy'), phoneme_pitch, allow_pickle=False)
+    if pack_features:
+        pack_feature(save_path_pitch)
+        pack_feature(save_path_energy)
 
-    print(f'\nPitch mean: {mean} var: {var}')
+    print(f'\nPitch mean: {mean} var: {std}')
 
-    return mean, var
+    return mean, std
 
 
 def create_gta_features(model: Tacotron,
@@ -100,58 +175,126 @@ def create_gta_features(model: Tacotron,
         stream(msg)
 
 
+class AlignmentExtractor:
+
+    def __init__(self,
+                 duration_extractor: DurationExtractor,
+                 save_path: Path) -> None:
+        self.duration_extractor = duration_extractor
+        self.save_path = save_path
+
+    def __call__(self, batch: Dict[str, Any]) -> List[Tuple[str, float, float, bool]]:
+        """
+        Extracts and saves the durations of a padded batch of attention matrices.
+
+        :return: List with item id, alignment score, attention score and whether the durations sum up
+                 to the mel length for each item.
+        """
+        results = self.duration_extractor.extract_batch(x=batch['x'], mel=batch['mel'], att=batch['att'],
+                                                        x_lens=batch['x_len'], mel_lens=batch['mel_len'])
+        outputs = []
+        for item_id, align_score, mel_len, (durs, att_score) in zip(batch['item_id'], batch['align_score'],
+                                                                     batch['mel_len'], results):
+            durs = np_now(durs).astype(int)
+            np.save(str(self.save_path / f'{item_id}.npy'), durs, allow_pickle=False)
+            outputs.append((item_id, align_score, att_score, int(np.sum(durs)) == mel_len))
+        return outputs
+
+
 def create_align_features(model: Tacotron,
-                          train_set: DataLoader,
-                          val_set: DataLoader,
                           paths: Paths,
                           pitch_max_freq: float,
                           silence_threshold: float,
-                          silence_prob_shift: float) -> None:
+                          silence_prob_shift: float,
+                          batch_size: int = 32,
+                          num_workers: int = 1,
+                          pack_features: bool = False) -> None:
     assert model.r == 1, f'Reduction factor of tacotron must be 1 for creating alignment features! ' \
                          f'Reduction factor was: {model.r}'
+    if not pack_features:
+        # shards of an earlier packed run would shadow the new .npy files
+        unpack_feature(paths.alg)
     model.eval()
     device = next(model.parameters()).device  # use same device as model parameters
-    iters = len(val_set) + len(train_set)
-    dataset = itertools.chain(train_set, val_set)
+    train_data = unpickle_binary(paths.data / 'train_dataset.pkl')
+    val_data = unpickle_binary(paths.data / 'val_dataset.pkl')
+    text_dict = unpickle_binary(paths.data / 'text_dict.pkl')
+
+    # Resume an interrupted run, only alignments that were extracted with the same tacotron step are kept.
+    progress_path = paths.data / 'align_progress.pkl'
     att_score_dict = {}
+    if progress_path.is_file():
+        progress = unpickle_binary(progress_path)
+        if progress['step'] == model.get_step():
+            att_score_dict = {item_id: scores for item_id, scores in progress['att_score_dict'].items()
+                              if (paths.alg / f'{item_id}.npy').is_file()}
+    if len(att_score_dict) > 0:
+        print(f'Resuming alignment extraction, skipping {len(att_score_dict)} files with existing alignments.')
+
+    # Batches only contain texts of the same length, text padding would change the encoder outputs and the
+    # attention of the padded items. The mel padding at the end does not influence the earlier decoder frames.
+    tokenizer = Tokenizer()
+    todo = sorted([(len(tokenizer(text_dict[item_id])), mel_len, item_id) for item_id, mel_len
+                   in train_data + val_data if item_id not in att_score_dict])
+    batches = []
+    for _, group in itertools.groupby(range(len(todo)), key=lambda i: todo[i][0]):
+        group = list(group)
+        batches.extend(group[i:i + batch_size] for i in range(0, len(group), batch_size))
+    dataset = TacoDataset(path=paths.data, dataset_ids=[item_id for _, _, item_id in todo],
+                          text_dict=text_dict, tokenizer=tokenizer)
+    align_set = DataLoader(dataset, collate_fn=TTSCollator(r=1), batch_sampler=batches)
     duration_extractor = DurationExtractor(silence_threshold=silence_threshold,
                                            silence_prob_shift=silence_prob_shift)
-    sum_att_score = 0
+    pool = Pool(processes=num_workers)
+    alignment_extractor = AlignmentExtractor(duration_extractor=duration_extractor, save_path=paths.alg)
+    pending = deque()
+    iters = len(todo)
+    sum_att_score, done = 0, 0
+
+    def collect_batch() -> None:
+        nonlocal sum_att_score, done
+        for item_id, align_score, att_score, sum_ok in pending.popleft().get():
+            att_score_dict[item_id] = (align_score, att_score)
+            sum_att_score += att_score
+            done += 1
+            if not sum_ok:
+                print(f'WARNING: Sum of durations did not match mel length for item {item_id}!')
+        pickle_binary({'step': model.get_step(), 'att_score_dict': att_score_dict}, progress_path)
+        bar = progbar(done, iters)
+        msg = f'{bar} {done}/{iters} Files. Avg attention score: {sum_att_score / done} '
+        stream(msg)
 
-    print('Extracting durations using dijkstra...')
-    for i, batch in enumerate(dataset, 1):
+    print('Extracting durations using monotonic alignment search...')
+    for batch in align_set:
         batch = to_device(batch, device=device)
-        x, mel = batch['x'], batch['mel']
         with torch.no_grad():
-            _, _, att_batch = model(x, mel)
-
-        x = batch['x'][0].cpu()
-        mel_len = batch['mel_len'][0].cpu()
-        item_id = batch['item_id'][0]
-        mel = batch['mel'][0, :, :mel_len].cpu()
-        att = att_batch[0, :mel_len, :].cpu()
-
-        # we use the standard alignment score and the more accurate attention score from the duration extractor
-        align_score, _ = attention_score(att_batch, batch['mel_len'], r=1)
-        align_score = float(align_score[0])
-        durs, att_score = duration_extractor(x=x, mel=mel, att=att)
-        durs = np_now(durs).astype(np.int)
-        att_score_dict[item_id] = (align_score, att_score)
-        sum_att_score += att_score
-
-        if np.sum(durs) != mel_len:
-            print(f'WARNINNG: Sum of durations did not match mel length for item {item_id}!')
-        np.save(str(paths.alg / f'{item_id}.npy'), durs, allow_pickle=False)
-        bar = progbar(i, iters)
-        msg = f'{bar} {i}/{iters} Files. Avg attention score: {sum_att_score / i} '
-        stream(msg)
+            _, _, att_batch = model(batch['x'], batch['mel'])
+            # we use the standard alignment score and the more accurate attention score from the duration extractor
+            align_score, _ = attention_score(att_batch, batch['mel_len'], r=1)
+        # the attention matrices are sliced by x_len and mel_len in the worker
+        pending.append(pool.apply_async(alignment_extractor, ({
+            'item_id': batch['item_id'], 'x': batch['x'].cpu(), 'mel': batch['mel'].cpu(),
+            'att': att_batch.cpu(), 'x_len': batch['x_len'].tolist(), 'mel_len': batch['mel_len'].tolist(),
+            'align_score': align_score.cpu().tolist()},)))
+        # the model runs ahead of the duration workers by a bounded number of batches
+        while len(pending) > 2 * num_workers or (len(pending) > 0 and pending[0].ready()):
+            collect_batch()
+    while len(pending) > 0:
+        collect_batch()
+    pool.close()
+    pool.join()
 
     pickle_binary(att_score_dict, paths.data / 'att_score_dict.pkl')
+    progress_path.unlink(missing_ok=True)
+    if pack_features:
+        pack_feature(paths.alg)
 
-    print('Extracting Pitch Values...')
+    print('\nExtracting Pitch Values...')
     extract_pitch_energy(save_path_pitch=paths.phon_pitch,
                          save_path_energy=paths.phon_energy,
-                         pitch_max_freq=pitch_max_freq)
+                         pitch_max_freq=pitch_max_freq,
+                         num_workers=num_workers,
+                         pack_features=pack_features)
 
 
 if __name__ == '__main__':
@@ -161,17 +304,23 @@ if __name__ == '__main__':
     parser.add_argument('--extract_pitch', '-p', action='store_true', help='Extracts phoneme-pitch values only')
     parser.add_argument('--config', metavar='FILE', default='config.yaml', help='The config containing all hyperparams.')
     parser.add_argument('--skip_align', action='store_true', help='Force the model to create attention alignment features')
+    parser.add_argument('--align_batch_size', type=int, default=32, help='Batch size for extracting the attention alignments')
+    parser.add_argument('--num_workers', '-w', metavar='N', type=int, default=max(1, cpu_count() - 1),
+                        help='The number of worker processes for extracting durations, pitch and energy values')
 
     args = parser.parse_args()
     config = read_config(args.config)
     dsp = DSP.from_config(config)
     paths = Paths(config['data_path'], config['voc_model_id'], config['tts_model_id'])
+    pack_features = config['preprocessing'].get('pack_features', False)
 
     if args.extract_pitch:
         print('Extracting Pitch and Energy Values...')
         mean, var = extract_pitch_energy(save_path_pitch=paths.phon_pitch,
                                          save_path_energy=paths.phon_energy,
-                                         pitch_max_freq=dsp.pitch_max_freq)
+                                         pitch_max_freq=dsp.pitch_max_freq,
+                                         num_workers=args.num_workers,
+                                         pack_features=pack_features)
         print('\n\nYou can now train ForwardTacotron - use python train_forward.py\n')
         exit()
 
@@ -183,40 +332,41 @@ if __name__ == '__main__':
     model = Tacotron.from_config(config).to(device)
     
     optimizer = optim.Adam(model.parameters(), capturable=True)
+    train_cfg = config['tacotron']['training']
+    amp = MixedPrecision.from_config(train_cfg, device)
     restore_checkpoint(model=model, optim=optimizer,
                        path=paths.taco_checkpoints / 'latest_model.pt',
-                       device=device)
+                       device=device, scaler=amp.scaler)
 
-    train_cfg = config['tacotron']['training']
     if args.force_gta:
         print('Creating Ground Truth Aligned Dataset...\n')
         train_set, val_set = get_tts_datasets(paths.data, 1, model.r,
                                               max_mel_len=train_cfg['max_mel_len'],
                                               filter_attention=False)
+        if not pack_features:
+            unpack_feature(paths.gta)
         create_gta_features(model, train_set, val_set, paths.gta)
+        if pack_features:
+            pack_feature(paths.gta)
         print('\n\nYou can now train WaveRNN on GTA features - use python train_wavernn.py --gta\n')
     elif args.force_align:
         print('Creating Attention Alignments and Pitch Values...')
-        train_set, val_set = get_tts_datasets(paths.data, 1, model.r,
-                                              max_mel_len=None,
-                                              filter_attention=False)
-        create_align_features(model=model, train_set=train_set, val_set=val_set,
-                              paths=paths, pitch_max_freq=dsp.pitch_max_freq,
+        create_align_features(model=model, paths=paths, pitch_max_freq=dsp.pitch_max_freq,
                               silence_prob_shift=config['preprocessing']['silence_prob_shift'],
-                              silence_threshold=config['preprocessing']['silence_threshold'])
+                              silence_threshold=config['preprocessing']['silence_threshold'],
+                              batch_size=args.align_batch_size, num_workers=args.num_workers,
+                              pack_features=pack_features)
         print('\n\nYou can now train ForwardTacotron - use python train_forward.py\n')
     else:
         trainer = TacoTrainer(paths, config=config, dsp=dsp)
-        trainer.train(model, optimizer)
+        trainer.train(model, optimizer, amp)
         print('Training finished, now creating Attention Alignments and Pitch Values...')
         if not args.skip_align:
-          train_set, val_set = get_tts_datasets(paths.data, 1, model.r,
-                                                max_mel_len=None,
-                                                filter_attention=False)
-          create_align_features(model=model, train_set=train_set, val_set=val_set,
-                                paths=paths, pitch_max_freq=dsp.pitch_max_freq,
+          create_align_features(model=model, paths=paths, pitch_max_freq=dsp.pitch_max_freq,
                                 silence_prob_shift=config['preprocessing']['silence_prob_shift'],
-                                silence_threshold=config['preprocessing']['silence_threshold'])
+                                silence_threshold=config['preprocessing']['silence_threshold'],
+                                batch_size=args.align_batch_size, num_workers=args.num_workers,
+                                pack_features=pack_features)
           print('\n\nYou can now train ForwardTacotron - use python train_forward.py\n')
 
 
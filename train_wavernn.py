@@ -5,6 +5,7 @@ import torch
 from torch import optim
 
 from models.fatchord_version import WaveRNN
+from trainer.common import MixedPrecision
 from trainer.voc_trainer import VocTrainer
 from utils.checkpoints import restore_checkpoint
 from utils.dsp import DSP
@@ -28,9 +29,10 @@ if __name__ == '__main__':
     assert np.cumprod(config['vocoder']['model']['upsample_factors'])[-1] == dsp.hop_length
 
     optimizer = optim.Adam(voc_model.parameters())
+    amp = MixedPrecision.from_config(config['vocoder']['training'], device)
     restore_checkpoint(model=voc_model, optim=optimizer,
                        path=paths.voc_checkpoints / 'latest_model.pt',
-                       device=device)
+                       device=device, scaler=amp.scaler)
 
     voc_trainer = VocTrainer(paths=paths, dsp=dsp, config=config)
-    voc_trainer.train(voc_model, optimizer, train_gta=args.gta)
\ No newline at end of file
+    voc_trainer.train(voc_model, optimizer, train_gta=args.gta, amp=amp)
\ No newline at end of file
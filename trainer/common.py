@@ -1,7 +1,10 @@
-from typing import Dict
+from queue import Queue, Empty
+from threading import Thread, Event
+from typing import Any, Dict, Iterable, Iterator
 
 import torch
 import torch.nn.functional as F
+from torch.optim.optimizer import Optimizer
 from torch.utils.data.dataloader import DataLoader
 
 
@@ -93,12 +96,128 @@ def pad_mask(lens, max_len):
 
 
 def to_device(batch: Dict[str, torch.tensor],
-              device: torch.device) -> Dict[str, torch.tensor]:
+              device: torch.device,
+              non_blocking: bool = False) -> Dict[str, torch.tensor]:
     output = {}
     for key, val in batch.items():
-        val = val.to(device) if torch.is_tensor(val) else val
+        val = val.to(device, non_blocking=non_blocking) if torch.is_tensor(val) else val
         output[key] = val
     return output
 
 
+class DevicePrefetcher:
+
+    def __init__(self,
+                 loader: Iterable[Dict[str, torch.tensor]],
+                 device: torch.device,
+                 depth: int = 2) -> None:
+        """
+        Iterates over the batches of a loader in a background thread and moves them to the device, so that
+        loading, collating and the host to device copies overlap with the training step. On cuda the copies
+        are made on a separate stream from the pinned batches.
+
+        :param loader: Dataloader or list of batches.
+        :param device: Device of the model.
+        :param depth: Number of batches that are prepared ahead.
+        """
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def __iter__(self) -> Iterator[Dict[str, torch.tensor]]:
+        queue = Queue(maxsize=self.depth)
+        stop = Event()
+        thread = Thread(target=self._load, args=(queue, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch, event, error = queue.get()
+                if error is not None:
+                    raise error
+                if batch is None:
+                    return
+                if event is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(event)
+                    for val in batch.values():
+                        if torch.is_tensor(val):
+                            val.record_stream(current_stream)
+                yield batch
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    thread.join(timeout=0.01)
+
+    def _load(self, queue: Queue, stop: Event) -> None:
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for batch in self.loader:
+                if stop.is_set():
+                    return
+                event = None
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = to_device(batch, self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch = to_device(batch, self.device)
+                queue.put((batch, event, None))
+            queue.put((None, None, None))
+        except Exception as e:
+            queue.put((None, None, e))
+
+
+class MixedPrecision:
+
+    def __init__(self,
+                 device: torch.device,
+                 enabled: bool = False,
+                 dtype: str = 'float16') -> None:
+        """
+        Runs the training forward passes and losses in autocast and takes the optimizer steps with gradient
+        scaling. On cpu autocast always uses bfloat16, on cuda float16 (scaled) or bfloat16 (no scaling needed).
+
+        :param device: Device of the model.
+        :param enabled: Whether to use mixed precision, otherwise everything runs in float32.
+        :param dtype: Autocast dtype on cuda, either float16 or bfloat16.
+        """
+        assert dtype in {'float16', 'bfloat16'}, f'Unsupported amp dtype: {dtype}, must be either [float16, bfloat16]!'
+        self.device_type = device.type
+        self.enabled = enabled
+        self.dtype = getattr(torch, dtype) if device.type == 'cuda' else torch.bfloat16
+        self.scaler = torch.amp.GradScaler('cuda', enabled=enabled and self.dtype == torch.float16)
+
+    @classmethod
+    def from_config(cls, train_cfg: Dict[str, Any], device: torch.device) -> 'MixedPrecision':
+        return cls(device=device, enabled=train_cfg.get('amp', False), dtype=train_cfg.get('amp_dtype', 'float16'))
+
+    def autocast(self) -> torch.autocast:
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def step(self,
+             loss: torch.Tensor,
+             optimizer: Optimizer,
+             parameters: Iterable[torch.Tensor],
+             clip_grad_norm: float) -> None:
+        """ Backward pass and optimizer step, the gradients are unscaled before they are clipped. """
+        optimizer.zero_grad()
+        self.scaler.scale(loss).backward()
+        self.scaler.unscale_(optimizer)
+        torch.nn.utils.clip_grad_norm_(parameters, clip_grad_norm)
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+
+def max_memory_gb(device: torch.device) -> float:
+    """ Returns the peak allocated device memory in GB, which is only tracked on cuda. """
+    return torch.cuda.max_memory_allocated(device) / 1e9 if device.type == 'cuda' else 0.
+
+
 def np_now(x: torch.Tensor): return x.detach().cpu().numpy()
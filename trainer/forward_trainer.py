@@ -9,9 +9,10 @@ from torch.utils.tensorboard import SummaryWriter
 
 from models.fast_pitch import FastPitch
 from models.forward_tacotron import ForwardTacotron
-from trainer.common import Averager, TTSSession, MaskedL1, to_device, np_now
+from trainer.common import Averager, TTSSession, MaskedL1, DevicePrefetcher, MixedPrecision, max_memory_gb, \
+    to_device, np_now
 from utils.checkpoints import  save_checkpoint
-from utils.dataset import get_tts_datasets
+from utils.dataset import get_tts_datasets, TokenBudgetSampler
 from utils.decorators import ignore_exception
 from utils.display import stream, simple_table, plot_mel, plot_pitch
 from utils.dsp import DSP
@@ -33,7 +34,11 @@ class ForwardTrainer:
         self.writer = SummaryWriter(log_dir=paths.forward_log, comment='v1')
         self.l1_loss = MaskedL1()
 
-    def train(self, model: Union[ForwardTacotron, FastPitch], optimizer: Optimizer) -> None:
+    def train(self,
+              model: Union[ForwardTacotron, FastPitch],
+              optimizer: Optimizer,
+              amp: MixedPrecision = None) -> None:
+        amp = amp or MixedPrecision(next(model.parameters()).device)
         forward_schedule = self.train_cfg['schedule']
         forward_schedule = parse_schedule(forward_schedule)
         for i, session_params in enumerate(forward_schedule, 1):
@@ -44,21 +49,27 @@ class ForwardTrainer:
                     max_mel_len=self.train_cfg['max_mel_len'],
                     filter_attention=self.train_cfg['filter_attention'],
                     filter_min_alignment=self.train_cfg['min_attention_alignment'],
-                    filter_min_sharpness=self.train_cfg['min_attention_sharpness'])
+                    filter_min_sharpness=self.train_cfg['min_attention_sharpness'],
+                    num_workers=self.train_cfg.get('num_workers', 0),
+                    persistent_workers=self.train_cfg.get('persistent_workers', False),
+                    prefetch_factor=self.train_cfg.get('prefetch_factor', 2),
+                    cache_gb=self.train_cfg.get('feature_cache_gb', 0.),
+                    max_batch_frames=self.train_cfg.get('max_batch_frames', 0))
                 session = TTSSession(
                     index=i, r=1, lr=lr, max_step=max_step,
                     bs=bs, train_set=train_set, val_set=val_set)
-                self.train_session(model, optimizer, session)
+                self.train_session(model, optimizer, session, amp)
 
     def train_session(self,  model: Union[ForwardTacotron, FastPitch],
-                      optimizer: Optimizer, session: TTSSession) -> None:
+                      optimizer: Optimizer, session: TTSSession, amp: MixedPrecision) -> None:
         current_step = model.get_step()
         training_steps = session.max_step - current_step
         total_iters = len(session.train_set)
         epochs = math.ceil(training_steps / total_iters)
         simple_table([(f'Steps', str(training_steps // 1000) + 'k Steps'),
                       ('Batch Size', session.bs),
-                      ('Learning Rate', session.lr)])
+                      ('Learning Rate', session.lr),
+                      ('Mixed Precision', str(amp.dtype) if amp.enabled else False)])
 
         for g in optimizer.param_groups:
             g['lr'] = session.lr
@@ -69,8 +80,9 @@ class ForwardTrainer:
         pitch_loss_avg = Averager()
         device = next(model.parameters()).device  # use same device as model parameters
         for e in range(1, epochs + 1):
-            for i, batch in enumerate(session.train_set, 1):
-                batch = to_device(batch, device=device)
+            if isinstance(session.train_set.batch_sampler, TokenBudgetSampler):
+                session.train_set.batch_sampler.set_epoch(e)
+            for i, batch in enumerate(DevicePrefetcher(session.train_set, device), 1):
                 start = time.time()
                 model.train()
 
@@ -82,25 +94,22 @@ class ForwardTrainer:
                 batch['pitch'] = batch['pitch'] * pitch_zoneout_mask.to(device).float()
                 batch['energy'] = batch['energy'] * energy_zoneout_mask.to(device).float()
 
-                pred = model(batch)
+                with amp.autocast():
+                    pred = model(batch)
 
-                m1_loss = self.l1_loss(pred['mel'], batch['mel'], batch['mel_len'])
-                m2_loss = self.l1_loss(pred['mel_post'], batch['mel'], batch['mel_len'])
+                    m1_loss = self.l1_loss(pred['mel'], batch['mel'], batch['mel_len'])
+                    m2_loss = self.l1_loss(pred['mel_post'], batch['mel'], batch['mel_len'])
 
-                dur_loss = self.l1_loss(pred['dur'].unsqueeze(1), batch['dur'].unsqueeze(1), batch['x_len'])
-                pitch_loss = self.l1_loss(pred['pitch'], pitch_target.unsqueeze(1), batch['x_len'])
-                energy_loss = self.l1_loss(pred['energy'], energy_target.unsqueeze(1), batch['x_len'])
+                    dur_loss = self.l1_loss(pred['dur'].unsqueeze(1), batch['dur'].unsqueeze(1), batch['x_len'])
+                    pitch_loss = self.l1_loss(pred['pitch'], pitch_target.unsqueeze(1), batch['x_len'])
+                    energy_loss = self.l1_loss(pred['energy'], energy_target.unsqueeze(1), batch['x_len'])
 
-                loss = m1_loss + m2_loss \
-                       + self.train_cfg['dur_loss_factor'] * dur_loss \
-                       + self.train_cfg['pitch_loss_factor'] * pitch_loss \
-                       + self.train_cfg['energy_loss_factor'] * energy_loss
+                    loss = m1_loss + m2_loss \
+                           + self.train_cfg['dur_loss_factor'] * dur_loss \
+                           + self.train_cfg['pitch_loss_factor'] * pitch_loss \
+                           + self.train_cfg['energy_loss_factor'] * energy_loss
 
-                optimizer.zero_grad()
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                               self.train_cfg['clip_grad_norm'])
-                optimizer.step()
+                amp.step(loss, optimizer, model.parameters(), self.train_cfg['clip_grad_norm'])
 
                 m_loss_avg.add(m1_loss.item() + m2_loss.item())
                 dur_loss_avg.add(dur_loss.item())
@@ -117,7 +126,7 @@ class ForwardTrainer:
 
                 if step % self.train_cfg['checkpoint_every'] == 0:
                     save_checkpoint(model=model, optim=optimizer, config=self.config,
-                                    path=self.paths.forward_checkpoints / f'forward_step{k}k.pt')
+                                    path=self.paths.forward_checkpoints / f'forward_step{k}k.pt', scaler=amp.scaler)
 
                 if step % self.train_cfg['plot_every'] == 0:
                     self.generate_plots(model, session)
@@ -126,18 +135,24 @@ class ForwardTrainer:
                 self.writer.add_scalar('Pitch_Loss/train', pitch_loss, model.get_step())
                 self.writer.add_scalar('Energy_Loss/train', energy_loss, model.get_step())
                 self.writer.add_scalar('Duration_Loss/train', dur_loss, model.get_step())
-                self.writer.add_scalar('Params/batch_size', session.bs, model.get_step())
+                self.writer.add_scalar('Params/batch_size', batch['x'].size(0), model.get_step())
                 self.writer.add_scalar('Params/learning_rate', session.lr, model.get_step())
+                self.writer.add_scalar('Stats/steps_per_sec', speed, model.get_step())
+                self.writer.add_scalar('Stats/max_memory_gb', max_memory_gb(device), model.get_step())
 
                 stream(msg)
 
+            if isinstance(session.train_set.batch_sampler, TokenBudgetSampler):
+                self.writer.add_scalar('Params/padding_waste',
+                                       session.train_set.batch_sampler.padding_waste, model.get_step())
+
             val_out = self.evaluate(model, session.val_set)
             self.writer.add_scalar('Mel_Loss/val', val_out['mel_loss'], model.get_step())
             self.writer.add_scalar('Duration_Loss/val', val_out['dur_loss'], model.get_step())
             self.writer.add_scalar('Pitch_Loss/val', val_out['pitch_loss'], model.get_step())
             self.writer.add_scalar('Energy_Loss/val', val_out['energy_loss'], model.get_step())
             save_checkpoint(model=model, optim=optimizer, config=self.config,
-                            path=self.paths.forward_checkpoints / 'latest_model.pt')
+                            path=self.paths.forward_checkpoints / 'latest_model.pt', scaler=amp.scaler)
 
             m_loss_avg.reset()
             duration_avg.reset()
@@ -151,8 +166,7 @@ class ForwardTrainer:
         pitch_val_loss = 0
         energy_val_loss = 0
         device = next(model.parameters()).device
-        for i, batch in enumerate(val_set, 1):
-            batch = to_device(batch, device=device)
+        for i, batch in enumerate(DevicePrefetcher(val_set, device), 1):
             with torch.no_grad():
                 pred = model(batch)
                 m1_loss = self.l1_loss(pred['mel'], batch['mel'], batch['mel_len'])
@@ -9,9 +9,9 @@ from torch.utils.tensorboard import SummaryWriter
 from typing import Tuple, Dict, Any
 
 from models.tacotron import Tacotron
-from trainer.common import Averager, TTSSession, to_device, np_now
+from trainer.common import Averager, TTSSession, DevicePrefetcher, MixedPrecision, max_memory_gb, to_device, np_now
 from utils.checkpoints import save_checkpoint
-from utils.dataset import get_tts_datasets
+from utils.dataset import get_tts_datasets, TokenBudgetSampler
 from utils.decorators import ignore_exception
 from utils.display import stream, simple_table, plot_mel, plot_attention
 from utils.dsp import DSP
@@ -34,7 +34,9 @@ class TacoTrainer:
 
     def train(self,
               model: Tacotron,
-              optimizer: Optimizer) -> None:
+              optimizer: Optimizer,
+              amp: MixedPrecision = None) -> None:
+        amp = amp or MixedPrecision(next(model.parameters()).device)
         tts_schedule = self.train_cfg['schedule']
         tts_schedule = parse_schedule(tts_schedule)
         for i, session_params in enumerate(tts_schedule, 1):
@@ -42,16 +44,22 @@ class TacoTrainer:
             if model.get_step() < max_step:
                 train_set, val_set = get_tts_datasets(
                     path=self.paths.data, batch_size=bs, r=r, model_type='tacotron',
-                    max_mel_len=self.train_cfg['max_mel_len'], filter_attention=False
+                    max_mel_len=self.train_cfg['max_mel_len'], filter_attention=False,
+                    num_workers=self.train_cfg.get('num_workers', 0),
+                    persistent_workers=self.train_cfg.get('persistent_workers', False),
+                    prefetch_factor=self.train_cfg.get('prefetch_factor', 2),
+                    cache_gb=self.train_cfg.get('feature_cache_gb', 0.),
+                    max_batch_frames=self.train_cfg.get('max_batch_frames', 0)
                 )
                 session = TTSSession(
                     index=i, r=r, lr=lr, max_step=max_step,
                     bs=bs, train_set=train_set, val_set=val_set)
-                self.train_session(model, optimizer, session=session)
+                self.train_session(model, optimizer, session=session, amp=amp)
 
     def train_session(self, model: Tacotron,
                       optimizer: Optimizer,
-                      session: TTSSession) -> None:
+                      session: TTSSession,
+                      amp: MixedPrecision) -> None:
         current_step = model.get_step()
         training_steps = session.max_step - current_step
         total_iters = len(session.train_set)
@@ -60,7 +68,8 @@ class TacoTrainer:
         simple_table([(f'Steps with r={session.r}', training_steps),
                       ('Batch Size', session.bs),
                       ('Learning Rate', session.lr),
-                      ('Outputs/Step (r)', model.r)])
+                      ('Outputs/Step (r)', model.r),
+                      ('Mixed Precision', str(amp.dtype) if amp.enabled else False)])
         for g in optimizer.param_groups:
             g['lr'] = session.lr
 
@@ -68,20 +77,18 @@ class TacoTrainer:
         duration_avg = Averager()
         device = next(model.parameters()).device  # use same device as model parameters
         for e in range(1, epochs + 1):
-            for i, batch in enumerate(session.train_set, 1):
-                batch = to_device(batch, device=device)
+            if isinstance(session.train_set.batch_sampler, TokenBudgetSampler):
+                session.train_set.batch_sampler.set_epoch(e)
+            for i, batch in enumerate(DevicePrefetcher(session.train_set, device), 1):
                 start = time.time()
                 model.train()
-                m1_hat, m2_hat, attention = model(batch['x'], batch['mel'])
+                with amp.autocast():
+                    m1_hat, m2_hat, attention = model(batch['x'], batch['mel'])
 
-                m1_loss = F.l1_loss(m1_hat, batch['mel'])
-                m2_loss = F.l1_loss(m2_hat, batch['mel'])
-                loss = m1_loss + m2_loss
-                optimizer.zero_grad()
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                               self.train_cfg['clip_grad_norm'])
-                optimizer.step()
+                    m1_loss = F.l1_loss(m1_hat, batch['mel'])
+                    m2_loss = F.l1_loss(m2_hat, batch['mel'])
+                    loss = m1_loss + m2_loss
+                amp.step(loss, optimizer, model.parameters(), self.train_cfg['clip_grad_norm'])
                 loss_avg.add(loss.item())
                 step = model.get_step()
                 k = step // 1000
@@ -93,7 +100,7 @@ class TacoTrainer:
 
                 if (self.train_cfg['checkpoint_every_step'] != -1) and (step % self.train_cfg['checkpoint_every'] == 0):
                     save_checkpoint(model=model, optim=optimizer, config=self.config,
-                                    path=self.paths.taco_checkpoints / f'taco_step{k}k.pt')
+                                    path=self.paths.taco_checkpoints / f'taco_step{k}k.pt', scaler=amp.scaler)
 
                 if (self.train_cfg['plot_every_step'] != -1) and (step % self.train_cfg['plot_every_step'] == 0):
                    self.generate_plots(model, session)
@@ -103,23 +110,29 @@ class TacoTrainer:
                 self.writer.add_scalar('Attention_Score/train', att_score, model.get_step())
                 self.writer.add_scalar('Loss/train', loss, model.get_step())
                 self.writer.add_scalar('Params/reduction_factor', session.r, model.get_step())
-                self.writer.add_scalar('Params/batch_size', session.bs, model.get_step())
+                self.writer.add_scalar('Params/batch_size', batch['x'].size(0), model.get_step())
                 self.writer.add_scalar('Params/learning_rate', session.lr, model.get_step())
+                self.writer.add_scalar('Stats/steps_per_sec', speed, model.get_step())
+                self.writer.add_scalar('Stats/max_memory_gb', max_memory_gb(device), model.get_step())
 
                 stream(msg)
 
             if (self.train_cfg['checkpoint_every_epoch'] != -1) and (e % self.train_cfg['checkpoint_every_epoch'] == 0):
                 save_checkpoint(model=model, optim=optimizer, config=self.config,
-                                path=self.paths.taco_checkpoints / f'taco_step{step}.pt')
+                                path=self.paths.taco_checkpoints / f'taco_step{step}.pt', scaler=amp.scaler)
 
             if (self.train_cfg['plot_every_epoch'] != -1) and (e % self.train_cfg['plot_every_epoch'] == 0):
                 self.generate_plots(model, session)
 
+            if isinstance(session.train_set.batch_sampler, TokenBudgetSampler):
+                self.writer.add_scalar('Params/padding_waste',
+                                       session.train_set.batch_sampler.padding_waste, model.get_step())
+
             val_loss, val_att_score = self.evaluate(model, session.val_set)
             self.writer.add_scalar('Loss/val', val_loss, model.get_step())
             self.writer.add_scalar('Attention_Score/val', val_att_score, model.get_step())
             save_checkpoint(model=model, optim=optimizer, config=self.config,
-                            path=self.paths.taco_checkpoints / 'latest_model.pt')
+                            path=self.paths.taco_checkpoints / 'latest_model.pt', scaler=amp.scaler)
 
             loss_avg.reset()
             duration_avg.reset()
@@ -130,8 +143,7 @@ class TacoTrainer:
         val_loss = 0
         val_att_score = 0
         device = next(model.parameters()).device
-        for i, batch in enumerate(val_set, 1):
-            batch = to_device(batch, device=device)
+        for i, batch in enumerate(DevicePrefetcher(val_set, device), 1):
             with torch.no_grad():
                 m1_hat, m2_hat, attention = model(batch['x'], batch['mel'])
                 m1_loss = F.l1_loss(m1_hat, batch['mel'])
@@ -9,7 +9,7 @@ from torch.utils.data.dataset import Dataset
 from torch.utils.tensorboard import SummaryWriter
 
 from models.fatchord_version import WaveRNN
-from trainer.common import Averager, VocSession, to_device
+from trainer.common import Averager, VocSession, DevicePrefetcher, MixedPrecision, max_memory_gb
 from utils.checkpoints import save_checkpoint
 from utils.dataset import get_vocoder_datasets
 from utils.decorators import ignore_exception
@@ -46,7 +46,9 @@ class VocTrainer:
     def train(self,
               model: WaveRNN,
               optimizer: Optimizer,
-              train_gta=False) -> None:
+              train_gta=False,
+              amp: MixedPrecision = None) -> None:
+        amp = amp or MixedPrecision(next(model.parameters()).device)
         voc_schedule = self.train_cfg['schedule']
         voc_schedule = parse_schedule(voc_schedule)
         for i, session_params in enumerate(voc_schedule, 1):
@@ -57,17 +59,22 @@ class VocTrainer:
                     max_mel_len=self.train_cfg['max_mel_len'], hop_length=self.dsp.hop_length,
                     voc_pad=model.pad, voc_seq_len=self.train_cfg['seq_len'],
                     voc_mode=self.dsp.voc_mode, bits=self.dsp.bits,
-                    num_gen_samples=self.train_cfg['num_gen_samples'])
+                    num_gen_samples=self.train_cfg['num_gen_samples'],
+                    num_workers=self.train_cfg.get('num_workers', 0),
+                    persistent_workers=self.train_cfg.get('persistent_workers', False),
+                    prefetch_factor=self.train_cfg.get('prefetch_factor', 2),
+                    cache_gb=self.train_cfg.get('feature_cache_gb', 0.))
                 session = VocSession(
                     index=i, lr=lr, max_step=max_step,
                     bs=bs, train_set=train_set, val_set=val_set,
                     val_set_samples=val_set_samples)
-                self.train_session(model, optimizer, session, train_gta)
+                self.train_session(model, optimizer, session, train_gta, amp)
 
     def train_session(self, model: WaveRNN,
                       optimizer: Optimizer,
                       session: VocSession,
-                      train_gta: bool) -> None:
+                      train_gta: bool,
+                      amp: MixedPrecision) -> None:
         current_step = model.get_step()
         training_steps = session.max_step - current_step
         total_iters = len(session.train_set)
@@ -76,7 +83,8 @@ class VocTrainer:
                       ('Batch Size', session.bs),
                       ('Learning Rate', session.lr),
                       ('Sequence Length', self.train_cfg['seq_len']),
-                      ('GTA Training', train_gta)])
+                      ('GTA Training', train_gta),
+                      ('Mixed Precision', str(amp.dtype) if amp.enabled else False)])
         for g in optimizer.param_groups:
             g['lr'] = session.lr
 
@@ -85,24 +93,20 @@ class VocTrainer:
         device = next(model.parameters()).device  # use same device as model parameters
 
         for e in range(1, epochs + 1):
-            for i, batch in enumerate(session.train_set, 1):
+            for i, batch in enumerate(DevicePrefetcher(session.train_set, device), 1):
                 start = time.time()
                 model.train()
-                batch = to_device(batch, device=device)
                 x, y = batch['x'], batch['y']
-                y_hat = model(x, batch['mel'])
-                if model.mode == 'RAW':
-                    y_hat = y_hat.transpose(1, 2).unsqueeze(-1)
-                elif model.mode == 'MOL':
-                    y = batch['y'].float()
-                y = y.unsqueeze(-1)
-
-                loss = self.loss_func(y_hat, y)
-                optimizer.zero_grad()
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(),
-                                               self.train_cfg['clip_grad_norm'])
-                optimizer.step()
+                with amp.autocast():
+                    y_hat = model(x, batch['mel'])
+                    if model.mode == 'RAW':
+                        y_hat = y_hat.transpose(1, 2).unsqueeze(-1)
+                    elif model.mode == 'MOL':
+                        y = batch['y'].float()
+                    y = y.unsqueeze(-1)
+
+                    loss = self.loss_func(y_hat, y)
+                amp.step(loss, optimizer, model.parameters(), self.train_cfg['clip_grad_norm'])
                 loss_avg.add(loss.item())
                 step = model.get_step()
                 k = step // 1000
@@ -122,18 +126,20 @@ class VocTrainer:
 
                 if step % self.train_cfg['checkpoint_every'] == 0:
                     save_checkpoint(model=model, optim=optimizer, config=self.config,
-                                    path=self.paths.voc_checkpoints / f'wavernn_step{k}k.pt')
+                                    path=self.paths.voc_checkpoints / f'wavernn_step{k}k.pt', scaler=amp.scaler)
 
                 self.writer.add_scalar('Loss/train', loss, model.get_step())
                 self.writer.add_scalar('Params/batch_size', session.bs, model.get_step())
                 self.writer.add_scalar('Params/learning_rate', session.lr, model.get_step())
+                self.writer.add_scalar('Stats/steps_per_sec', speed, model.get_step())
+                self.writer.add_scalar('Stats/max_memory_gb', max_memory_gb(device), model.get_step())
 
                 stream(msg)
 
             val_loss = self.evaluate(model, session.val_set)
             self.writer.add_scalar('Loss/val', val_loss, model.get_step())
             save_checkpoint(model=model, optim=optimizer, config=self.config,
-                            path=self.paths.voc_checkpoints / 'latest_model.pt')
+                            path=self.paths.voc_checkpoints / 'latest_model.pt', scaler=amp.scaler)
 
             loss_avg.reset()
             duration_avg.reset()
@@ -143,8 +149,7 @@ class VocTrainer:
         model.eval()
         val_loss = 0
         device = next(model.parameters()).device
-        for i, batch in enumerate(val_set, 1):
-            batch = to_device(batch, device=device)
+        for i, batch in enumerate(DevicePrefetcher(val_set, device), 1):
             x, y, m = batch['x'], batch['y'], batch['mel']
             with torch.no_grad():
                 y_hat = model(x, m)
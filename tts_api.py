@@ -1,14 +1,21 @@
-from gen_forward import ForwardGenerator
+from gen_forward import ForwardGenerator, load_wavernn
 from gen_tacotron import TacotronGenerator
 import flask
 from flask_cors import CORS, cross_origin
 import uuid
 from pathlib import Path
 import os
+import threading
 import datetime
 import argparse
-from api.api_db import API_DB, RequestStatus
-import threading
+from api.api_db import RequestStatus, create_request_store
+from api.scheduler import JobScheduler, Job, QueueFullError
+from api.streaming import wav_stream
+from api.cache import AudioCache, checkpoint_id
+from api.registry import ModelRegistry
+from api.notifier import StatusNotifier
+from api.maintenance import MaintenanceService
+import torch
 from utils.files import read_config
 
 parser = argparse.ArgumentParser()
@@ -27,54 +34,166 @@ database_path = Path(config['database_path'])
 api_base_url = config['api_base_url']
 response_base_url = config['response_base_url']
 
+workers_per_model = int(config.get('workers_per_model', 1))
+max_queue_size = int(config.get('max_queue_size', 32))
+max_batch_size = int(config.get('max_batch_size', 1))
+max_batch_wait_ms = float(config.get('max_batch_wait_ms', 0))
+max_streams = int(config.get('max_streams', 2))
+max_sentence_chars = int(config.get('max_sentence_chars', 300))
+sentence_pause = float(config.get('sentence_pause', 0.3))
+cache_max_size_mb = float(config.get('cache_max_size_mb', 0))
+max_loaded_models = int(config.get('max_loaded_models', 0))
+max_models_memory_mb = float(config.get('max_models_memory_mb', 0))
+max_wait_timeout = float(config.get('max_wait_timeout', 30))
+event_keepalive_interval = float(config.get('event_keepalive_interval', 15))
+wav_ttl_hours = float(config.get('wav_ttl_hours', 0))
+max_output_mb = float(config.get('max_output_mb', 0))
+request_ttl_days = float(config.get('request_ttl_days', 0))
+maintenance_interval_s = float(config.get('maintenance_interval_s', 300))
+vocoder_jit = bool(config.get('vocoder_jit', False))
+vocoder_quantize = bool(config.get('vocoder_quantize', False))
+
 app = flask.Flask(__name__)
 cors = CORS(app)
 app.config["CORS_HEADERS"] = 'Content-Type'
 
-generators = {}
+registry = None
 
-ttsdb = API_DB(database_path)
+ttsdb = create_request_store(config.get('request_store', 'sqlite'), database_path)
+scheduler = None
+stream_slots = threading.BoundedSemaphore(max_streams)
+audio_cache = AudioCache(output_path / 'cache', int(cache_max_size_mb * 1024 * 1024)) if cache_max_size_mb > 0 else None
+model_ids = {}
+notifier = StatusNotifier()
+maintenance = MaintenanceService(ttsdb, output_path,
+                                 wav_ttl_s=wav_ttl_hours * 3600,
+                                 max_output_bytes=int(max_output_mb * 1024 * 1024),
+                                 request_ttl_s=request_ttl_days * 24 * 3600,
+                                 interval_s=maintenance_interval_s)
 
-def create_generators(config):
-  generator_dict = {}
-  for line in config['forward_models']:
-    try:
-      name, filename = line.split(":")
-    except:
-      print(f"Unable to parse line {line}")
-    generator_dict[name] = ForwardGenerator(forward_models_base_path / filename, "wavernn", wavernn_model_path)
-  for line in config['tacotron_models']:
-    try:
-      name, filename = line.split(":")
-    except:
-      print(f"Unable to parse line {line}")
-    generator_dict[name] = TacotronGenerator(tacotron_models_base_path / filename, "wavernn", wavernn_model_path)
-  return generator_dict
+def create_registry(config):
+  model_registry = ModelRegistry(max_models=max_loaded_models,
+                                 max_memory_bytes=int(max_models_memory_mb * 1024 * 1024))
+  # all generators share one vocoder instance, it is loaded together with the first tts model
+  def load_vocoder():
+    return model_registry.shared(('wavernn', str(wavernn_model_path.resolve())),
+                                 lambda: load_wavernn(str(wavernn_model_path)))
+  def forward_factory(path, quantize):
+    def load():
+      voc_model, voc_config = load_vocoder()
+      return ForwardGenerator(path, "wavernn", wavernn_model_path,
+                              max_sentence_chars=max_sentence_chars, sentence_pause=sentence_pause,
+                              voc_model=voc_model, voc_config=voc_config, voc_jit=vocoder_jit,
+                              quantize=quantize, voc_quantize=vocoder_quantize)
+    return load
+  def tacotron_factory(path, quantize):
+    def load():
+      voc_model, voc_config = load_vocoder()
+      return TacotronGenerator(path, "wavernn", wavernn_model_path, voc_model=voc_model, voc_config=voc_config,
+                               voc_jit=vocoder_jit, quantize=quantize, voc_quantize=vocoder_quantize)
+    return load
+
+  for models_key, base_path, factory in [('forward_models', forward_models_base_path, forward_factory),
+                                         ('tacotron_models', tacotron_models_base_path, tacotron_factory)]:
+    for line in config[models_key]:
+      try:
+        name, filename, *options = line.split(":")
+      except:
+        print(f"Unable to parse line {line}")
+        continue
+      quantize = 'quantize' in options
+      model_registry.register(name, factory(base_path / filename, quantize))
+      # quantized models produce different audio and get their own cache entries
+      tts_id = checkpoint_id(base_path / filename) + ('|int8' if quantize else '')
+      voc_id = checkpoint_id(wavernn_model_path) + ('|int8' if vocoder_quantize else '')
+      model_ids[name] = f'{tts_id}|{voc_id}'
+  return model_registry
 
-def api_output(request_id, status):
+def status_output(request_id, status):
   location = "" if status != RequestStatus.COMPLETED else f"{response_base_url}{request_id}.wav"
-  resp = {
+  return {
     'id': request_id,
     'timestamp': datetime.datetime.now(),
     'status': status.value,
     'path': location
   }
-  return flask.jsonify(resp)
+
+def api_output(request_id, status, http_status=200):
+  return flask.jsonify(status_output(request_id, status)), http_status
+
+def request_status(request_id):
+  # recent requests are answered by the notifier without touching the db
+  status = notifier.status(request_id)
+  if status is not None:
+    return status
+  db_entry = ttsdb.check_request(request_id)
+  return RequestStatus(db_entry[3])
 
 def output_wav_path(request_id):
   return output_path / f'{request_id}.wav'
 
-def generate_tts(request_id, generator, text, vocoder="wavernn"):
+def generate_tts(generator, text, request_id, vocoder):
   try:
     wav_path = output_wav_path(request_id)
     if (vocoder == "grifflim"):
       generator.generate_grifflim(text, str(wav_path))
     else:
       generator.generate(text, str(wav_path))
-    ttsdb.update_request_status(request_id, RequestStatus.COMPLETED)
+    return RequestStatus.COMPLETED
   except:
     print("Failed to generate TTS output.")
-    ttsdb.update_request_status(request_id, RequestStatus.FAILED)
+    return RequestStatus.FAILED
+
+def generate_tts_batch(jobs):
+  generator = registry.get(jobs[0].model_name)
+  results = {}
+  for vocoder in {job.params['vocoder'] for job in jobs}:
+    voc_jobs = [job for job in jobs if job.params['vocoder'] == vocoder]
+    if len(voc_jobs) > 1 and hasattr(generator, 'generate_batch'):
+      try:
+        generator.generate_batch([job.params['text'] for job in voc_jobs],
+                                 [str(output_wav_path(job.request_id)) for job in voc_jobs],
+                                 vocoder=vocoder)
+        results.update({job.request_id: RequestStatus.COMPLETED for job in voc_jobs})
+        continue
+      except Exception as e:
+        print(f"Failed to generate batched TTS output, falling back to single requests: {e}")
+    for job in voc_jobs:
+      results[job.request_id] = generate_tts(generator, job.params['text'], job.request_id, vocoder)
+  return [results[job.request_id] for job in jobs]
+
+def cache_key(model_name, text, vocoder):
+  params = {
+    'vocoder': vocoder,
+    'alpha': 1,
+    'amp': 1,
+    'max_sentence_chars': max_sentence_chars,
+    'sentence_pause': sentence_pause
+  }
+  return AudioCache.key(model_ids[model_name], text, params)
+
+def finish_tts(job):
+  status = job.result if job.result is not None else RequestStatus.FAILED
+  if audio_cache is not None and status == RequestStatus.COMPLETED:
+    audio_cache.put(job.params['cache_key'], output_wav_path(job.request_id))
+  ttsdb.update_request_status(job.request_id, status,
+                              queue_time=job.queue_time,
+                              compute_time=job.compute_time)
+  notifier.publish(job.request_id, status)
+
+def create_scheduler(model_names):
+  # share the cores between the workers instead of letting every worker spawn one thread per core
+  total_workers = max(1, len(model_names) * workers_per_model)
+  torch.set_num_threads(int(config.get('torch_num_threads', max(1, (os.cpu_count() or 1) // total_workers))))
+  job_scheduler = JobScheduler(run_batch=generate_tts_batch,
+                               on_finished=finish_tts,
+                               workers_per_model=workers_per_model,
+                               max_queue_size=max_queue_size,
+                               max_batch_size=max_batch_size,
+                               max_batch_wait_ms=max_batch_wait_ms)
+  for name in model_names:
+    job_scheduler.add_model(name)
+  return job_scheduler
 
 @app.route('/', methods=['GET'])
 @cross_origin()
@@ -90,37 +209,145 @@ def api_tts():
     text = "Test input because no sentence was provided." if 'text' not in flask.request.args else flask.request.args['text']
     vocoder = "wavernn" if 'voc' not in flask.request.args else flask.request.args['voc']
 
-    # if the model name provided is not in our generators dictionary, return failed
-    if model_name not in generators:
-      print(f"Could not find model name {model_name} in generators.")
+    # if the model name provided is not in our model registry, return failed
+    if model_name not in registry:
+      print(f"Could not find model name {model_name} in the model registry.")
       return api_output("-1", RequestStatus.FAILED)
 
     if vocoder not in ['wavernn', 'grifflim']:
       vocoder = 'wavernn'
     
     (request_id, status) = ttsdb.add_request(text)
-    t1 = threading.Thread(target=generate_tts, args=(request_id, generators[model_name], text, vocoder))
-    t1.start()
+    key = cache_key(model_name, text, vocoder) if audio_cache is not None else None
+    if key is not None and audio_cache.get(key, output_wav_path(request_id)):
+      ttsdb.update_request_status(request_id, RequestStatus.COMPLETED, queue_time=0., compute_time=0.)
+      notifier.publish(request_id, RequestStatus.COMPLETED)
+      return api_output(request_id, RequestStatus.COMPLETED)
+    notifier.publish(request_id, status)
+    try:
+      scheduler.submit(Job(request_id, model_name, {'text': text, 'vocoder': vocoder, 'cache_key': key}))
+    except QueueFullError as e:
+      print(e)
+      ttsdb.update_request_status(request_id, RequestStatus.FAILED)
+      notifier.publish(request_id, RequestStatus.FAILED)
+      return api_output(request_id, RequestStatus.FAILED, http_status=503)
     return api_output(request_id, status)
   if 'request' in flask.request.args:
     request_id = flask.request.args['request']
     try:
-      db_entry = ttsdb.check_request(request_id)
-      return api_output(db_entry[1], RequestStatus(db_entry[3]))
+      return api_output(request_id, request_status(request_id))
     except:
       return api_output(request_id, RequestStatus.FAILED)
   else:
     return "Error."
 
+@app.route('/api/v1/tts/wait', methods=['GET'])
+@cross_origin()
+def api_tts_wait():
+  # long-poll, returns as soon as the request is finished or after timeout seconds
+  request_id = flask.request.args.get('request', '')
+  timeout = min(float(flask.request.args.get('timeout', max_wait_timeout)), max_wait_timeout)
+  try:
+    status = notifier.wait(request_id, timeout)
+    if status is None:
+      status = request_status(request_id)
+    return api_output(request_id, status)
+  except:
+    return api_output(request_id, RequestStatus.FAILED)
+
+@app.route('/api/v1/tts/events', methods=['GET'])
+@cross_origin()
+def api_tts_events():
+  # server-sent events with the status of a request, the stream ends once the request is finished
+  request_id = flask.request.args.get('request', '')
+  def events():
+    try:
+      status = request_status(request_id)
+    except:
+      status = RequestStatus.FAILED
+    yield f"data: {flask.json.dumps(status_output(request_id, status))}\n\n"
+    while status == RequestStatus.PENDING:
+      status = notifier.wait(request_id, event_keepalive_interval)
+      if status is None:
+        status = request_status(request_id)
+      if status == RequestStatus.PENDING:
+        # comment line that keeps proxies from closing the idle connection
+        yield ": keepalive\n\n"
+      else:
+        yield f"data: {flask.json.dumps(status_output(request_id, status))}\n\n"
+  return flask.Response(flask.stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+@app.route('/api/v1/tts/stream', methods=['GET'])
+@cross_origin()
+def api_tts_stream():
+  model_name = flask.request.args.get('model')
+  text = flask.request.args.get('text', "Test input because no sentence was provided.")
+  vocoder = flask.request.args.get('voc', 'wavernn')
+  if model_name not in registry:
+    print(f"Could not find model name {model_name} in the model registry.")
+    return api_output("-1", RequestStatus.FAILED, http_status=404)
+  if vocoder not in ['wavernn', 'grifflim']:
+    vocoder = 'wavernn'
+
+  # streams run in the request thread, so their number is bounded separately from the job queue
+  if not stream_slots.acquire(blocking=False):
+    print("Too many concurrent streams.")
+    return api_output("-1", RequestStatus.FAILED, http_status=503)
+
+  try:
+    generator = registry.get(model_name)
+  except Exception as e:
+    stream_slots.release()
+    print(f"Failed to load model {model_name}: {e}")
+    return api_output("-1", RequestStatus.FAILED, http_status=500)
+
+  def stream():
+    try:
+      chunks = generator.generate_stream(text, vocoder=vocoder)
+      yield from wav_stream(chunks, generator.tts_dsp.sample_rate)
+    except Exception as e:
+      print(f"Failed to stream TTS output: {e}")
+
+  response = flask.Response(flask.stream_with_context(stream()), mimetype='audio/wav')
+  # the slot is released when the response is closed, also if the client disconnects before the body is read
+  response.call_on_close(stream_slots.release)
+  return response
+
 @app.route('/api/v1/models', methods=['GET'])
 @cross_origin()
 def api_models():
   resp = {
     'timestamp': datetime.datetime.now(),
-    'model_names': list(generators.keys())
+    'model_names': registry.names()
+  }
+  return flask.jsonify(resp)
+
+@app.route('/api/v1/queue', methods=['GET'])
+@cross_origin()
+def api_queue():
+  resp = {
+    'timestamp': datetime.datetime.now(),
+    'workers_per_model': workers_per_model,
+    'max_queue_size': max_queue_size,
+    'max_batch_size': max_batch_size,
+    'queue_sizes': scheduler.queue_sizes()
+  }
+  return flask.jsonify(resp)
+
+@app.route('/api/v1/stats', methods=['GET'])
+@cross_origin()
+def api_stats():
+  resp = {
+    'timestamp': datetime.datetime.now(),
+    'cache': audio_cache.stats() if audio_cache is not None else None,
+    'models': registry.stats(),
+    'maintenance': maintenance.stats()
   }
   return flask.jsonify(resp)
 
 if __name__ == '__main__':
-  generators = create_generators(config)
+  registry = create_registry(config)
+  scheduler = create_scheduler(registry.names())
+  maintenance.start()
   app.run(host=config['host'], port=int(config['port']), debug=False)
@@ -12,20 +12,27 @@ from models.tacotron import Tacotron
 def save_checkpoint(model: torch.nn.Module,
                     optim: torch.optim.Optimizer,
                     config: Dict[str, Any],
-                    path: Path) -> None:
-    torch.save({'model': model.state_dict(),
-                'optim': optim.state_dict(),
-                'config': config}, str(path))
+                    path: Path,
+                    scaler: torch.amp.GradScaler = None) -> None:
+    checkpoint = {'model': model.state_dict(),
+                  'optim': optim.state_dict(),
+                  'config': config}
+    if scaler is not None and scaler.is_enabled():
+        checkpoint['scaler'] = scaler.state_dict()
+    torch.save(checkpoint, str(path))
 
 
 def restore_checkpoint(model: Union[FastPitch, ForwardTacotron, Tacotron, WaveRNN],
                        optim: torch.optim.Optimizer,
                        path: Path,
-                       device: torch.device) -> None:
+                       device: torch.device,
+                       scaler: torch.amp.GradScaler = None) -> None:
     if path.is_file():
         checkpoint = torch.load(path, map_location=device)
         model.load_state_dict(checkpoint['model'], strict=False)
         optim.load_state_dict(checkpoint['optim'])
+        if scaler is not None and 'scaler' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler'])
         print(f'Restored model with step {model.get_step()}\n')
 
 
@@ -4,6 +4,7 @@ from torch.utils.data import Dataset, DataLoader
 from typing import List, Dict, Union, Tuple
 
 from utils.dsp import *
+from utils.feature_store import FeatureStore, FeatureCache
 from utils.files import unpickle_binary
 from pathlib import Path
 import random
@@ -17,15 +18,36 @@ from utils.text.tokenizer import Tokenizer
 
 class VocoderDataset(Dataset):
 
-    def __init__(self, path: Path, dataset_ids, train_gta=False) -> None:
+    def __init__(self,
+                 path: Path,
+                 dataset_ids,
+                 train_gta=False,
+                 feature_cache: FeatureCache = None,
+                 hop_length: int = None,
+                 voc_pad: int = None,
+                 voc_seq_len: int = None) -> None:
+        """
+        Returns the mel and quant of an item, or a random training window of them if voc_seq_len is given.
+        The windows are sliced from memory mapped features, so only the needed frames and samples are read.
+        """
         self.metadata = dataset_ids
-        self.mel_path = path/'gta' if train_gta else path/'mel'
-        self.quant_path = path/'quant'
+        self.feature_cache = feature_cache or new_vocoder_feature_cache(path, train_gta)
+        self.hop_length = hop_length
+        self.voc_pad = voc_pad
+        self.voc_seq_len = voc_seq_len
 
     def __getitem__(self, index: int) -> Dict[str, np.array]:
         item_id = self.metadata[index]
-        mel = np.load(self.mel_path/f'{item_id}.npy')
-        x = np.load(self.quant_path/f'{item_id}.npy')
+        mel = self.feature_cache['mel', item_id]
+        x = self.feature_cache['quant', item_id]
+        if self.voc_seq_len is None:
+            return {'mel': np.array(mel), 'x': x.astype(np.int64)}
+        mel_win = self.voc_seq_len // self.hop_length + 2 * self.voc_pad
+        max_offset = mel.shape[-1] - 2 - (mel_win + 2 * self.voc_pad)
+        mel_offset = np.random.randint(0, max_offset)
+        sig_offset = (mel_offset + self.voc_pad) * self.hop_length
+        mel = np.array(mel[:, mel_offset:mel_offset + mel_win])
+        x = x[sig_offset:sig_offset + self.voc_seq_len + 1].astype(np.int64)
         return {'mel': mel, 'x': x}
 
     def __len__(self):
@@ -41,25 +63,31 @@ def get_vocoder_datasets(path: Path,
                          voc_seq_len: int,
                          voc_mode: str,
                          bits: int,
-                         num_gen_samples: int):
+                         num_gen_samples: int,
+                         num_workers: int = 0,
+                         persistent_workers: bool = False,
+                         prefetch_factor: int = 2,
+                         cache_gb: float = 0.):
     train_data = unpickle_binary(path/'train_dataset.pkl')
     val_data = unpickle_binary(path/'val_dataset.pkl')
     train_ids, train_lens = zip(*filter_max_len(train_data, max_mel_len))
     val_ids, val_lens = zip(*filter_max_len(val_data, max_mel_len))
-    train_dataset = VocoderDataset(path, train_ids, train_gta)
-    val_dataset = VocoderDataset(path, val_ids, train_gta)
-    voc_collator = VocCollator(hop_length=hop_length,
-                               voc_pad=voc_pad,
-                               voc_seq_len=voc_seq_len,
+    feature_cache = new_vocoder_feature_cache(path, train_gta)
+    fill_feature_cache(feature_cache, train_ids + val_ids, cache_gb)
+    window_args = {'hop_length': hop_length, 'voc_pad': voc_pad, 'voc_seq_len': voc_seq_len}
+    train_dataset = VocoderDataset(path, train_ids, train_gta, feature_cache=feature_cache, **window_args)
+    val_dataset = VocoderDataset(path, val_ids, train_gta, feature_cache=feature_cache, **window_args)
+    voc_collator = VocCollator(voc_seq_len=voc_seq_len,
                                voc_mode=voc_mode,
                                bits=bits)
     train_set = DataLoader(train_dataset,
                            collate_fn=voc_collator,
                            batch_size=batch_size,
-                           num_workers=0,
                            shuffle=True,
-                           pin_memory=True)
+                           pin_memory=True,
+                           **worker_args(num_workers, persistent_workers, prefetch_factor))
 
+    # the val set is loaded in the main process, workers would not use the fixed numpy seed for the offsets
     val_set = DataLoader(val_dataset,
                          collate_fn=voc_collator,
                          batch_size=batch_size,
@@ -71,7 +99,7 @@ def get_vocoder_datasets(path: Path,
     val_set = [b for b in val_set]
     np.random.seed()
 
-    val_set_samples = DataLoader(val_dataset,
+    val_set_samples = DataLoader(VocoderDataset(path, val_ids, train_gta, feature_cache=feature_cache),
                                  batch_size=1,
                                  num_workers=0,
                                  shuffle=False,
@@ -86,29 +114,17 @@ def get_vocoder_datasets(path: Path,
 class VocCollator:
 
     def __init__(self,
-                 hop_length: int,
-                 voc_pad: int,
                  voc_seq_len: int,
                  voc_mode: str,
                  bits: int):
-        self.hop_length = hop_length
-        self.voc_pad = voc_pad
         self.voc_seq_len = voc_seq_len
         self.voc_mode = voc_mode
         self.bits = bits
 
     def __call__(self, batch: List[Dict[str, torch.tensor]]) -> Dict[str, torch.tensor]:
-        mel_win = self.voc_seq_len // self.hop_length + 2 * self.voc_pad
-        max_offsets = [b['mel'].shape[-1] -2 - (mel_win + 2 * self.voc_pad) for b in batch]
-        mel_offsets = [np.random.randint(0, offset) for offset in max_offsets]
-        sig_offsets = [(offset + self.voc_pad) * self.hop_length for offset in mel_offsets]
-
-        mels = [b['mel'][:, mel_offsets[i]:mel_offsets[i] + mel_win] for i, b in enumerate(batch)]
-
-        labels = [b['x'][sig_offsets[i]:sig_offsets[i] + self.voc_seq_len + 1] for i, b in enumerate(batch)]
-
-        mels = np.stack(mels).astype(np.float32)
-        labels = np.stack(labels).astype(np.int64)
+        """ Collates the training windows of VocoderDataset. """
+        mels = np.stack([b['mel'] for b in batch]).astype(np.float32)
+        labels = np.stack([b['x'] for b in batch]).astype(np.int64)
 
         mel = torch.tensor(mels)
         labels = torch.tensor(labels).long()
@@ -138,7 +154,12 @@ def get_tts_datasets(path: Path,
                      filter_attention=True,
                      filter_min_alignment=0.5,
                      filter_min_sharpness=0.9,
-                     model_type='tacotron') -> Tuple[DataLoader, DataLoader]:
+                     model_type='tacotron',
+                     num_workers=0,
+                     persistent_workers=False,
+                     prefetch_factor=2,
+                     cache_gb=0.,
+                     max_batch_frames=0) -> Tuple[DataLoader, DataLoader]:
 
     tokenizer = Tokenizer()
 
@@ -167,38 +188,78 @@ def get_tts_datasets(path: Path,
     val_ids, val_lens = zip(*val_data)
 
     if model_type == 'tacotron':
-        train_dataset = TacoDataset(path=path, dataset_ids=train_ids,
-                                    text_dict=text_dict, tokenizer=tokenizer)
-        val_dataset = TacoDataset(path=path, dataset_ids=val_ids,
-                                  text_dict=text_dict, tokenizer=tokenizer)
+        feature_cache = new_tts_feature_cache(path, TacoDataset.features)
+        fill_feature_cache(feature_cache, train_ids + val_ids, cache_gb)
+        train_dataset = TacoDataset(path=path, dataset_ids=train_ids, text_dict=text_dict,
+                                    tokenizer=tokenizer, feature_cache=feature_cache)
+        val_dataset = TacoDataset(path=path, dataset_ids=val_ids, text_dict=text_dict,
+                                  tokenizer=tokenizer, feature_cache=feature_cache)
     elif model_type == 'forward':
-        train_dataset = ForwardDataset(path=path, dataset_ids=train_ids,
-                                       text_dict=text_dict, tokenizer=tokenizer)
-        val_dataset = ForwardDataset(path=path, dataset_ids=val_ids,
-                                     text_dict=text_dict, tokenizer=tokenizer)
+        feature_cache = new_tts_feature_cache(path, ForwardDataset.features)
+        fill_feature_cache(feature_cache, train_ids + val_ids, cache_gb)
+        train_dataset = ForwardDataset(path=path, dataset_ids=train_ids, text_dict=text_dict,
+                                       tokenizer=tokenizer, feature_cache=feature_cache)
+        val_dataset = ForwardDataset(path=path, dataset_ids=val_ids, text_dict=text_dict,
+                                     tokenizer=tokenizer, feature_cache=feature_cache)
     else:
         raise ValueError(f'Unknown model: {model_type}, must be either [tacotron, forward]!')
 
-    train_sampler = BinnedLengthSampler(train_lens, batch_size, batch_size * 3)
-
-    train_set = DataLoader(train_dataset,
-                           collate_fn=lambda batch: collate_tts(batch, r),
-                           batch_size=batch_size,
-                           sampler=train_sampler,
-                           num_workers=0,
-                           pin_memory=True)
+    if max_batch_frames > 0:
+        # batches are filled up to the frame budget, the batch size only limits the number of items
+        train_sampler = TokenBudgetSampler(train_lens, max_frames=max_batch_frames, max_batch_size=batch_size)
+        train_set = DataLoader(train_dataset,
+                               collate_fn=TTSCollator(r),
+                               batch_sampler=train_sampler,
+                               pin_memory=True,
+                               **worker_args(num_workers, persistent_workers, prefetch_factor))
+    else:
+        train_sampler = BinnedLengthSampler(train_lens, batch_size, batch_size * 3)
+        train_set = DataLoader(train_dataset,
+                               collate_fn=TTSCollator(r),
+                               batch_size=batch_size,
+                               sampler=train_sampler,
+                               pin_memory=True,
+                               **worker_args(num_workers, persistent_workers, prefetch_factor))
 
     val_set = DataLoader(val_dataset,
-                         collate_fn=lambda batch: collate_tts(batch, r),
+                         collate_fn=TTSCollator(r),
                          batch_size=batch_size,
                          sampler=None,
-                         num_workers=0,
                          shuffle=False,
-                         pin_memory=True)
+                         pin_memory=True,
+                         **worker_args(num_workers, persistent_workers, prefetch_factor))
 
     return train_set, val_set
 
 
+def worker_args(num_workers: int,
+                persistent_workers: bool,
+                prefetch_factor: int) -> Dict[str, Union[int, bool]]:
+    """ DataLoader arguments for loading in worker processes, the prefetch options require num_workers > 0. """
+    if num_workers == 0:
+        return {'num_workers': 0}
+    return {'num_workers': num_workers,
+            'persistent_workers': persistent_workers,
+            'prefetch_factor': prefetch_factor}
+
+
+def new_tts_feature_cache(path: Path, features: List[str]) -> FeatureCache:
+    return FeatureCache({name: FeatureStore(path/name) for name in features})
+
+
+def new_vocoder_feature_cache(path: Path, train_gta: bool) -> FeatureCache:
+    return FeatureCache({'mel': FeatureStore(path/'gta' if train_gta else path/'mel', mmap=True),
+                         'quant': FeatureStore(path/'quant', mmap=True)})
+
+
+def fill_feature_cache(feature_cache: FeatureCache, item_ids: List[str], cache_gb: float) -> None:
+    """ Caches the features of the items in RAM up to cache_gb, the remaining items are read from disk. """
+    if cache_gb <= 0:
+        return
+    num_cached = feature_cache.fill(item_ids, max_bytes=int(cache_gb * 2 ** 30))
+    print(f'Cached {num_cached}/{len(item_ids)} items in RAM ({feature_cache.num_bytes / 2 ** 30:.2f} GB).')
+
+
 def filter_max_len(dataset: List[tuple], max_mel_len: int) -> List[tuple]:
     if max_mel_len is None:
         return dataset
@@ -220,21 +281,25 @@ def filter_bad_attentions(dataset: List[tuple],
 
 class TacoDataset(Dataset):
 
+    features = ['mel']
+
     def __init__(self,
                  path: Path,
                  dataset_ids: List[str],
                  text_dict: Dict[str, str],
-                 tokenizer: Tokenizer) -> None:
+                 tokenizer: Tokenizer,
+                 feature_cache: FeatureCache = None) -> None:
         self.path = path
         self.metadata = dataset_ids
         self.text_dict = text_dict
         self.tokenizer = tokenizer
+        self.feature_cache = feature_cache or new_tts_feature_cache(path, self.features)
 
     def __getitem__(self, index: int) -> Dict[str, torch.tensor]:
         item_id = self.metadata[index]
         text = self.text_dict[item_id]
         x = self.tokenizer(text)
-        mel = np.load(str(self.path/'mel'/f'{item_id}.npy'))
+        mel = self.feature_cache['mel', item_id]
         mel_len = mel.shape[-1]
         return {'x': x, 'mel': mel, 'item_id': item_id,
                 'mel_len': mel_len, 'x_len': len(x)}
@@ -245,25 +310,29 @@ class TacoDataset(Dataset):
 
 class ForwardDataset(Dataset):
 
+    features = ['mel', 'alg', 'phon_pitch', 'phon_energy']
+
     def __init__(self,
                  path: Path,
                  dataset_ids: List[str],
                  text_dict: Dict[str, str],
-                 tokenizer: Tokenizer):
+                 tokenizer: Tokenizer,
+                 feature_cache: FeatureCache = None):
         self.path = path
         self.metadata = dataset_ids
         self.text_dict = text_dict
         self.tokenizer = tokenizer
+        self.feature_cache = feature_cache or new_tts_feature_cache(path, self.features)
 
     def __getitem__(self, index: int) -> Dict[str, torch.tensor]:
         item_id = self.metadata[index]
         text = self.text_dict[item_id]
         x = self.tokenizer(text)
-        mel = np.load(str(self.path/'mel'/f'{item_id}.npy'))
+        mel = self.feature_cache['mel', item_id]
         mel_len = mel.shape[-1]
-        dur = np.load(str(self.path/'alg'/f'{item_id}.npy'))
-        pitch = np.load(str(self.path/'phon_pitch'/f'{item_id}.npy'))
-        energy = np.load(str(self.path/'phon_energy'/f'{item_id}.npy'))
+        dur = self.feature_cache['alg', item_id]
+        pitch = self.feature_cache['phon_pitch', item_id]
+        energy = self.feature_cache['phon_energy', item_id]
         return {'x': x, 'mel': mel, 'item_id': item_id, 'x_len': len(x),
                 'mel_len': mel_len, 'dur': dur, 'pitch': pitch, 'energy': energy}
 
@@ -315,6 +384,15 @@ def collate_tts(batch: List[Dict[str, Union[str, torch.tensor]]], r: int) -> Dic
             'mel_len': mel_lens, 'dur': dur, 'pitch': pitch, 'energy': energy}
 
 
+class TTSCollator:
+
+    def __init__(self, r: int) -> None:
+        self.r = r
+
+    def __call__(self, batch: List[Dict[str, Union[str, torch.tensor]]]) -> Dict[str, torch.tensor]:
+        return collate_tts(batch, self.r)
+
+
 class BinnedLengthSampler(Sampler):
     def __init__(self, lengths, batch_size, bin_size):
         _, self.idx = torch.sort(torch.tensor(lengths).long())
@@ -345,3 +423,77 @@ class BinnedLengthSampler(Sampler):
 
     def __len__(self):
         return len(self.idx)
+
+
+class TokenBudgetSampler(Sampler):
+
+    def __init__(self,
+                 lengths: List[int],
+                 max_frames: int,
+                 max_batch_size: int = None,
+                 bucket_size: int = 256,
+                 seed: int = 42) -> None:
+        """
+        Batch sampler that fills each batch up to a budget of padded mel frames (batch size * max mel length
+        of the batch). The items are sorted by length and split into buckets, the items of each bucket are
+        shuffled and packed into batches and the batches of all buckets are shuffled. The epoch is set with
+        set_epoch (as for the DistributedSampler) and epoch e is seeded with seed + e, so the batches are reproducible.
+
+        :param lengths: Mel lengths of the items.
+        :param max_frames: Maximum number of padded frames per batch, an item longer than that is a batch on its own.
+        :param max_batch_size: Optional maximum number of items per batch.
+        :param bucket_size: Number of items of similar length that are shuffled together.
+        :param seed: Random seed.
+        """
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.max_frames = max_frames
+        self.max_batch_size = max_batch_size
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        self.padding_waste = None
+        self._batches = None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def get_batches(self, epoch: int) -> List[List[int]]:
+        if self._batches is None or self._batches[0] != epoch:
+            rng = np.random.RandomState(self.seed + epoch)
+            # items of the same length are ordered randomly, so that the buckets differ between epochs
+            order = np.lexsort((rng.rand(len(self.lengths)), self.lengths))
+            batches = []
+            for start in range(0, len(order), self.bucket_size):
+                bucket = order[start:start + self.bucket_size]
+                batches.extend(self._pack(rng.permutation(bucket)))
+            rng.shuffle(batches)
+            self._batches = (epoch, batches)
+        return self._batches[1]
+
+    def get_padding_waste(self, batches: List[List[int]]) -> float:
+        """ Returns the fraction of padded frames of the given batches. """
+        num_frames = sum(int(self.lengths[batch].sum()) for batch in batches)
+        num_padded = sum(int(self.lengths[batch].max()) * len(batch) for batch in batches)
+        return 1. - num_frames / max(num_padded, 1)
+
+    def _pack(self, indices: np.array) -> List[List[int]]:
+        batches, batch, max_len = [], [], 0
+        for index in indices:
+            new_max_len = max(max_len, self.lengths[index])
+            if len(batch) > 0 and (new_max_len * (len(batch) + 1) > self.max_frames
+                                   or len(batch) == self.max_batch_size):
+                batches.append(batch)
+                batch, new_max_len = [], self.lengths[index]
+            batch.append(int(index))
+            max_len = new_max_len
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        batches = self.get_batches(self.epoch)
+        self.padding_waste = self.get_padding_waste(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.get_batches(self.epoch))
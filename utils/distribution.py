@@ -1,3 +1,5 @@
+from typing import Optional
+
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -84,9 +86,9 @@ def discretized_mix_logistic_loss(y_hat, y, num_classes=65536,
         return -log_sum_exp(log_probs).unsqueeze(-1)
 
 
-def sample_from_discretized_mix_logistic(y, log_scale_min=None):
+def sample_from_discretized_mix_logistic(y: torch.Tensor, log_scale_min: Optional[float] = None) -> torch.Tensor:
     """
-    Sample from discretized mixture of logistic distributions
+    Sample from discretized mixture of logistic distributions, can be compiled with TorchScript.
     Args:
         y (Tensor): B x C x T
         log_scale_min (float): Log scale minimum value
@@ -94,7 +96,7 @@ def sample_from_discretized_mix_logistic(y, log_scale_min=None):
         Tensor: sample in range of [-1, 1].
     """
     if log_scale_min is None:
-        log_scale_min = float(np.log(1e-14))
+        log_scale_min = -32.23619130191664  # log(1e-14)
     assert y.size(1) % 3 == 0
     nr_mix = y.size(1) // 3
 
@@ -103,8 +105,8 @@ def sample_from_discretized_mix_logistic(y, log_scale_min=None):
     logit_probs = y[:, :, :nr_mix]
 
     # sample mixture indicator from softmax
-    temp = logit_probs.data.new(logit_probs.size()).uniform_(1e-5, 1.0 - 1e-5)
-    temp = logit_probs.data - torch.log(- torch.log(temp))
+    temp = torch.empty_like(logit_probs).uniform_(1e-5, 1.0 - 1e-5)
+    temp = logit_probs.detach() - torch.log(- torch.log(temp))
     _, argmax = temp.max(dim=-1)
 
     # (B, T) -> (B, T, nr_mix)
@@ -115,7 +117,7 @@ def sample_from_discretized_mix_logistic(y, log_scale_min=None):
         y[:, :, 2 * nr_mix:3 * nr_mix] * one_hot, dim=-1), min=log_scale_min)
     # sample from logistic & clip to interval
     # we don't actually round to the nearest 8bit value when sampling
-    u = means.data.new(means.size()).uniform_(1e-5, 1.0 - 1e-5)
+    u = torch.empty_like(means).uniform_(1e-5, 1.0 - 1e-5)
     x = means + torch.exp(log_scales) * (torch.log(u) - torch.log(1. - u))
 
     x = torch.clamp(torch.clamp(x, min=-1.), max=1.)
@@ -1,7 +1,7 @@
 import math
 import struct
 from pathlib import Path
-from typing import Dict, Any, Union
+from typing import Dict, Any, Union, Iterator
 import numpy as np
 import librosa
 import webrtcvad
@@ -102,6 +102,31 @@ class DSP:
             win_length=self.win_length)
         return wav
 
+    def griffinlim_stream(self, mel: np.array, n_iter=32, chunk_frames=64, context_frames=16) -> Iterator[np.array]:
+        """
+        Windowed Griffin-Lim that yields the wav of a mel in chunks of chunk_frames frames. Every window is
+        extended by context_frames on both sides so that the phase estimate at the chunk borders is stable,
+        and consecutive chunks are joined with a short linear crossfade of one hop.
+        """
+        n_frames = mel.shape[-1]
+        fade_len = self.hop_length
+        fade_in = np.linspace(0, 1, fade_len, dtype=np.float32)
+        tail = None
+        for start in range(0, n_frames, chunk_frames):
+            end = min(start + chunk_frames, n_frames)
+            win_start = max(0, start - context_frames)
+            win_end = min(n_frames, end + context_frames)
+            wav = self.griffinlim(mel[:, win_start:win_end], n_iter=n_iter)
+            offset = (start - win_start) * self.hop_length
+            length = (end - start) * self.hop_length
+            chunk = wav[offset:offset + length + fade_len]
+            if tail is not None:
+                overlap = min(len(tail), len(chunk))
+                chunk[:overlap] = chunk[:overlap] * fade_in[:overlap] + tail[:overlap] * (1 - fade_in[:overlap])
+            if end < n_frames:
+                chunk, tail = chunk[:length], chunk[length:]
+            yield chunk
+
     def normalize(self, mel: np.array) -> np.array:
         mel = np.clip(mel, a_min=1.e-5, a_max=None)
         return np.log(mel)
@@ -1,9 +1,7 @@
-from typing import Tuple
+from typing import Tuple, List
 
 import numpy as np
 import torch
-from scipy.sparse import coo_matrix, csr_matrix
-from scipy.sparse.csgraph import dijkstra
 
 from utils.text.symbols import silent_phonemes_indices
 
@@ -33,98 +31,100 @@ class DurationExtractor:
         :param att: Attention matrix with shape (mel_len, x_len).
         :return: Tuple, where the first entry is the durations and the second entry is the average attention probability.
         """
-        att = att[...]
-        mel_len = mel.shape[-1]
+        return self.extract_batch(x=x.unsqueeze(0), mel=mel.unsqueeze(0), att=att.unsqueeze(0),
+                                  x_lens=[x.shape[0]], mel_lens=[mel.shape[-1]])[0]
+
+    def extract_batch(self,
+                      x: torch.Tensor,
+                      mel: torch.Tensor,
+                      att: torch.Tensor,
+                      x_lens: List[int],
+                      mel_lens: List[int]) -> List[Tuple[torch.tensor, float]]:
+        """
+        Extracts durations for a zero padded batch, the shortest paths of all items are searched at once.
+
+        :param x: Tokenized sequences with shape (b, x_len).
+        :param mel: Mel specs with shape (b, n_mels, mel_len).
+        :param att: Attention matrices with shape (b, mel_len, x_len).
+        :param x_lens: Number of tokens of each item.
+        :param mel_lens: Number of mel frames of each item.
+        :return: List with a tuple of durations and average attention probability for each item.
+        """
+        x_lens, mel_lens = [int(l) for l in x_lens], [int(l) for l in mel_lens]
+        max_x_len, max_mel_len = max(x_lens), max(mel_lens)
+        x = x[:, :max_x_len].cpu()
+        mel = mel[:, :, :max_mel_len].cpu()
+        att = att[:, :max_mel_len, :max_x_len].cpu()
 
         # We add a little probability to silent phonemes within unvoiced parts of the spec where the tacotron attention
         # is usually very unreliable. As a result we get more accurate (larger) durations for unvoiced parts and
         # avoid 'leakage' of durations into surrounding word phonemes.
-        sil_mask = mel.mean(dim=0) < self.silence_threshold
-        sil_mel_inds = sil_mask.nonzero().squeeze()
-        sil_mel_inds = list(sil_mel_inds) if len(sil_mel_inds.size()) > 0 else []
-
-        sil_phon_inds = torch.tensor(silent_phonemes_indices)
-        for i in sil_mel_inds:
-            sil_tok_inds = torch.isin(x, sil_phon_inds)
-            att_shift = sil_tok_inds.float() * self.silence_prob_shift * 2 - self.silence_prob_shift
-            att[i, :] = att[i, :] + att_shift
-
-        att = torch.clamp(att, min=0., max=1.)
-        path_probs = 1.-att[:mel_len, :]
-        adj_matrix = self._to_adj_matrix(path_probs)
-        dist_matrix, predecessors = dijkstra(csgraph=adj_matrix, directed=True,
-                                             indices=0, return_predecessors=True)
-        path = []
-        pr_index = predecessors[-1]
-        while pr_index != 0:
-            path.append(pr_index)
-            pr_index = predecessors[pr_index]
-        path.reverse()
-
-        # append first and last node
-        path = [0] + path + [dist_matrix.size-1]
-        cols = path_probs.shape[1]
-        mel_text = {}
-        durations = torch.zeros(x.shape[0])
-
-        att_scores = []
-
-        # collect indices (mel, text) along the path
-        for node_index in path:
-            i, j = self._from_node_index(node_index, cols)
-            mel_text[i] = j
-            if not sil_mask[i]:
-                att_scores.append(float(att[i, j]))
-
-        for j in mel_text.values():
-            durations[j] += 1
-
-        att_score = sum(att_scores) / len(att_scores)
-
-        return durations, att_score
-
-    @staticmethod
-    def _to_node_index(i: int, j: int, cols: int) -> int:
-        return cols * i + j
-
-    @staticmethod
-    def _from_node_index(node_index: int, cols: int) -> Tuple[int, int]:
-        return node_index // cols, node_index % cols
+        sil_mask = mel.mean(dim=1) < self.silence_threshold
+        sil_tok_inds = torch.isin(x, torch.tensor(silent_phonemes_indices))
+        att_shift = sil_tok_inds.float() * self.silence_prob_shift * 2 - self.silence_prob_shift
+        att = att + sil_mask.unsqueeze(-1).float() * att_shift.unsqueeze(1)
+        att = torch.clamp(att, min=0., max=1.).double().numpy()
+        sil_mask = sil_mask.numpy()
+
+        paths = self._shortest_monotonic_paths(1. - att, rows=mel_lens, cols=x_lens)
+        results = []
+        for b, (path_rows, path_cols) in enumerate(paths):
+            # each mel frame belongs to the last token the path visits in its row
+            last_in_row = np.append(path_rows[1:] != path_rows[:-1], True)
+            durations = np.bincount(path_cols[last_in_row], minlength=x_lens[b])
+            voiced = ~sil_mask[b, path_rows]
+            att_score = float(np.sum(att[b, path_rows[voiced], path_cols[voiced]])) / int(np.sum(voiced))
+            results.append((torch.tensor(durations).float(), att_score))
+        return results
 
     @staticmethod
-    def _to_adj_matrix(mat: np.array) -> csr_matrix:
-        rows = mat.shape[0]
-        cols = mat.shape[1]
-
-        row_ind = []
-        col_ind = []
-        data = []
-
-        for i in range(rows):
-            for j in range(cols):
-
-                node = DurationExtractor._to_node_index(i, j, cols)
-
-                if j < cols - 1:
-                    right_node = DurationExtractor._to_node_index(i, j + 1, cols)
-                    weight_right = mat[i, j + 1]
-                    row_ind.append(node)
-                    col_ind.append(right_node)
-                    data.append(weight_right)
-
-                if i < rows - 1 and j < cols:
-                    bottom_node = DurationExtractor._to_node_index(i + 1, j, cols)
-                    weight_bottom = mat[i + 1, j]
-                    row_ind.append(node)
-                    col_ind.append(bottom_node)
-                    data.append(weight_bottom)
-
-                if i < rows - 1 and j < cols - 1:
-                    bottom_right_node = DurationExtractor._to_node_index(i + 1, j + 1, cols)
-                    weight_bottom_right = mat[i + 1, j + 1]
-                    row_ind.append(node)
-                    col_ind.append(bottom_right_node)
-                    data.append(weight_bottom_right)
+    def _shortest_monotonic_paths(costs: np.array,
+                                  rows: List[int],
+                                  cols: List[int]) -> List[Tuple[np.array, np.array]]:
+        """
+        Finds the cheapest path from the top left to the bottom right cell (rows[b]-1, cols[b]-1) of each
+        cost matrix with steps to the right, down and diagonally down right. The cost of a path is the sum
+        over the cells it enters. The rows are processed one after another, the steps to the right within a row
+        are resolved with a cumulative minimum.
 
-        adj_mat = coo_matrix((data, (row_ind, col_ind)), shape=(rows * cols, rows * cols))
-        return adj_mat.tocsr()
+        :param costs: Cost matrices with shape (b, max_rows, max_cols).
+        :return: List with the row and column indices of the cells along each path.
+        """
+        b, max_rows, max_cols = costs.shape
+        dist = np.empty((b, max_rows, max_cols))
+        from_left = np.zeros((b, max_rows, max_cols), dtype=bool)
+        from_diag = np.zeros((b, max_rows, max_cols), dtype=bool)
+        dist[:, 0, 0] = 0.
+        dist[:, 0, 1:] = np.cumsum(costs[:, 0, 1:], axis=1)
+        from_left[:, 0, 1:] = True
+        diag = np.full((b, max_cols), np.inf)
+
+        for i in range(1, max_rows):
+            up = dist[:, i - 1]
+            diag[:, 1:] = up[:, :-1]
+            from_diag[:, i] = diag < up
+            vertical = np.minimum(up, diag) + costs[:, i]
+            # entering the row at column k and stepping right up to column j costs
+            # vertical[k] + cum[j] - cum[k], the best k is found with a cumulative minimum,
+            # on ties the path advances to the next token as early as possible
+            cum = np.cumsum(costs[:, i], axis=1)
+            entry = vertical - cum
+            best_entry = np.minimum.accumulate(entry, axis=1)
+            dist[:, i] = best_entry + cum
+            from_left[:, i, 1:] = best_entry[:, :-1] <= entry[:, 1:]
+
+        paths = []
+        for k in range(b):
+            i, j = rows[k] - 1, cols[k] - 1
+            path = [(i, j)]
+            while i > 0 or j > 0:
+                if from_left[k, i, j]:
+                    j -= 1
+                elif from_diag[k, i, j]:
+                    i, j = i - 1, j - 1
+                else:
+                    i -= 1
+                path.append((i, j))
+            path_rows, path_cols = np.array(path[::-1]).T
+            paths.append((path_rows, path_cols))
+        return paths
@@ -0,0 +1,246 @@
+import itertools
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Tuple, Union, Iterable
+
+import numpy as np
+import torch
+
+from utils.files import pickle_binary, unpickle_binary
+
+SHARD_INDEX_FILE = 'index.pkl'
+
+
+def get_shard_dir(path: Path) -> Path:
+    """ Returns the shard directory of a feature directory, e.g. data/mel -> data/mel_shards. """
+    return path.parent / f'{path.name}_shards'
+
+
+class ShardWriter:
+
+    def __init__(self,
+                 shard_dir: Path,
+                 shard_size: int = 2 ** 30,
+                 alignment: int = 64) -> None:
+        """
+        Appends the arrays of a feature to large contiguous shard files. The index maps each item id
+        to (shard number, byte offset, dtype, shape) and is written on close.
+
+        :param shard_dir: Directory for the shard files, existing shards are replaced.
+        :param shard_size: Number of bytes after which a new shard file is started.
+        :param alignment: Byte alignment of the arrays within a shard.
+        """
+        self.shard_dir = shard_dir
+        self.shard_size = shard_size
+        self.alignment = alignment
+        self.index = {}
+        self.shard, self.offset = 0, 0
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        os.makedirs(shard_dir)
+        self.file = open(self._shard_path(), 'wb')
+
+    def write(self, item_id: str, array: np.array) -> None:
+        if self.offset >= self.shard_size:
+            self.file.close()
+            self.shard, self.offset = self.shard + 1, 0
+            self.file = open(self._shard_path(), 'wb')
+        array = np.ascontiguousarray(array)
+        self.file.write(array.tobytes())
+        self.index[item_id] = (self.shard, self.offset, array.dtype.str, array.shape)
+        padding = -array.nbytes % self.alignment
+        self.file.write(bytes(padding))
+        self.offset += array.nbytes + padding
+
+    def close(self) -> None:
+        self.file.close()
+        pickle_binary(self.index, self.shard_dir / SHARD_INDEX_FILE)
+
+    def _shard_path(self) -> Path:
+        return self.shard_dir / f'{self.shard:04d}.bin'
+
+    def __enter__(self) -> 'ShardWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class FeatureStore:
+
+    def __init__(self, path: Path, mmap: bool = False, check_files: bool = True) -> None:
+        """
+        Reads the arrays of a feature. If the feature is packed, the arrays are read-only memmap slices
+        of the shard files, otherwise they are loaded from one .npy file per item.
+
+        :param path: Feature directory, e.g. data/mel.
+        :param mmap: Whether to memory map the .npy files, so that slices of an item only read the needed pages.
+        :param check_files: Whether to warn about .npy files that are shadowed by the shards of a packed feature.
+        """
+        self.path = path
+        self.mmap = mmap
+        self.shard_dir = get_shard_dir(path)
+        index_path = self.shard_dir / SHARD_INDEX_FILE
+        self.index = unpickle_binary(index_path) if index_path.is_file() else None
+        self._shards: Dict[int, np.memmap] = {}
+        if check_files and self.index is not None and next(path.glob('*.npy'), None) is not None:
+            print(f'WARNING: {path} contains .npy files that are shadowed by the shards in {self.shard_dir}! '
+                  f'Run pack_feature or unpack_feature on {path} to merge them.')
+
+    @property
+    def packed(self) -> bool:
+        return self.index is not None
+
+    def __getitem__(self, item_id: str) -> np.array:
+        if self.index is None:
+            return np.load(self.path / f'{item_id}.npy', mmap_mode='r' if self.mmap else None)
+        shard, offset, dtype, shape = self.index[item_id]
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(self.shard_dir / f'{shard:04d}.bin', dtype=np.uint8, mode='r')
+        dtype = np.dtype(dtype)
+        num_bytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        return self._shards[shard][offset:offset + num_bytes].view(dtype).reshape(shape)
+
+    def __contains__(self, item_id: str) -> bool:
+        if self.index is None:
+            return (self.path / f'{item_id}.npy').is_file()
+        return item_id in self.index
+
+    def get_info(self, item_id: str) -> Tuple[np.dtype, Tuple[int, ...]]:
+        """ Returns dtype and shape of an item without reading its data. """
+        if self.index is None:
+            array = np.load(self.path / f'{item_id}.npy', mmap_mode='r')
+            return array.dtype, array.shape
+        _, _, dtype, shape = self.index[item_id]
+        return np.dtype(dtype), shape
+
+    def __getstate__(self) -> Dict:
+        # memmaps are opened lazily in each dataloader worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+
+class FeatureCache:
+
+    def __init__(self, stores: Dict[str, FeatureStore], alignment: int = 64) -> None:
+        """
+        Keeps the features of a set of items in one shared memory buffer. The buffer is shared with the
+        dataloader workers without copying, items that are not cached are read from the feature stores.
+
+        :param stores: Feature stores by feature name, e.g. {'mel': FeatureStore(data/mel)}.
+        :param alignment: Byte alignment of the arrays within the buffer.
+        """
+        self.stores = stores
+        self.alignment = alignment
+        self.index = {}
+        self.buffer = torch.empty(0, dtype=torch.uint8)
+        self._array = None
+
+    @property
+    def num_bytes(self) -> int:
+        return self.buffer.numel()
+
+    def fill(self, item_ids: Iterable[str], max_bytes: int) -> int:
+        """
+        Loads all features of the items in the given order until the memory budget is reached.
+
+        :return: Number of cached items.
+        """
+        index, offset, num_items = {}, 0, 0
+        for item_id in item_ids:
+            item_index, item_offset = {}, offset
+            for name, store in self.stores.items():
+                dtype, shape = store.get_info(item_id)
+                item_index[(name, item_id)] = (item_offset, dtype, shape)
+                num_bytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+                item_offset += num_bytes + (-num_bytes % self.alignment)
+            if item_offset > max_bytes:
+                break
+            index.update(item_index)
+            offset = item_offset
+            num_items += 1
+
+        self.buffer = torch.empty(offset, dtype=torch.uint8).share_memory_()
+        buffer = self.buffer.numpy()
+        for (name, item_id), (item_offset, dtype, shape) in index.items():
+            array = np.ascontiguousarray(self.stores[name][item_id]).reshape(-1).view(np.uint8)
+            buffer[item_offset:item_offset + array.size] = array
+        self.index = index
+        self._array = None
+        return num_items
+
+    def __getitem__(self, key: Tuple[str, str]) -> np.array:
+        """ Returns the feature of an item, the key is a tuple (feature name, item id). """
+        if key not in self.index:
+            name, item_id = key
+            return self.stores[name][item_id]
+        if self._array is None:
+            self._array = self.buffer.numpy()
+        offset, dtype, shape = self.index[key]
+        num_bytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        array = self._array[offset:offset + num_bytes].view(dtype).reshape(shape)
+        array.flags.writeable = False
+        return array
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
+
+
+def pack_feature(path: Path,
+                 delete_files: bool = True,
+                 shard_size: int = 2 ** 30,
+                 dtype: np.dtype = None) -> int:
+    """
+    Packs the .npy files of a feature directory into shard files. Items of existing shards are kept,
+    unless they are overwritten by a .npy file.
+
+    :param path: Feature directory, e.g. data/mel.
+    :param delete_files: Whether to delete the .npy files after packing.
+    :param dtype: Optional dtype to convert all items to (also the already packed ones), e.g. np.uint16 for quant.
+    :return: Number of packed .npy files.
+    """
+    files = {f.stem: f for f in path.glob('*.npy')}
+    store = FeatureStore(path, check_files=False)
+    if len(files) == 0 and (dtype is None or not store.packed):
+        return 0
+    packed_ids = [item_id for item_id in store.index if item_id not in files] if store.packed else []
+    shard_dir = get_shard_dir(path)
+    tmp_dir = shard_dir.parent / f'{shard_dir.name}_tmp'
+    try:
+        with ShardWriter(tmp_dir, shard_size=shard_size) as writer:
+            arrays = itertools.chain(((item_id, store[item_id]) for item_id in packed_ids),
+                                     ((item_id, np.load(file)) for item_id, file in sorted(files.items())))
+            for item_id, array in arrays:
+                if dtype is not None:
+                    converted = array.astype(dtype)
+                    if not np.array_equal(converted, array):
+                        raise ValueError(f'Values of item {item_id} in {path} do not fit into {np.dtype(dtype)}!')
+                    array = converted
+                writer.write(item_id, array)
+    except ValueError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    del store
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.rename(tmp_dir, shard_dir)
+    if delete_files:
+        for file in files.values():
+            file.unlink()
+    return len(files)
+
+
+def unpack_feature(path: Path) -> int:
+    """ Writes the items of a packed feature back to .npy files and removes the shards. """
+    store = FeatureStore(path)
+    if not store.packed:
+        return 0
+    os.makedirs(path, exist_ok=True)
+    for item_id in store.index:
+        np.save(str(path / f'{item_id}.npy'), store[item_id], allow_pickle=False)
+    num_items = len(store.index)
+    del store
+    shutil.rmtree(get_shard_dir(path))
+    return num_items
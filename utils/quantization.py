@@ -0,0 +1,18 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+# layers that get int8 weights, convolutions and embeddings stay in fp32
+QUANTIZED_LAYERS = {nn.Linear, nn.LSTM, nn.GRU, nn.LSTMCell, nn.GRUCell}
+
+
+def quantize_model(model: nn.Module) -> nn.Module:
+    """
+    Returns a copy of the model with dynamically quantized linear and recurrent layers: the weights are
+    stored as int8 and the activations are quantized on the fly. The quantized model only runs on CPU.
+    """
+    if isinstance(model, torch.jit.ScriptModule):
+        raise ValueError('Scripted models can not be quantized, export the model with --quantize instead.')
+    model = copy.deepcopy(model).cpu().eval()
+    return torch.quantization.quantize_dynamic(model, QUANTIZED_LAYERS, dtype=torch.qint8, inplace=True)
@@ -1,7 +1,13 @@
+import atexit
+import os
 import re
-from typing import Dict, Any
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Any, List, Iterable, Optional, Tuple, Union
 
 from phonemizer.phonemize import phonemize
+from utils.files import pickle_binary, unpickle_binary
 from utils.text.numbers import normalize_numbers
 from utils.text.symbols import phonemes_set
 from unidecode import unidecode
@@ -53,18 +59,163 @@ def english_cleaners(text):
     return text
 
 
-def to_phonemes(text: str, lang: str) -> str:
-    phonemes = phonemize(text,
-                         language=lang,
-                         backend='espeak',
-                         strip=True,
-                         preserve_punctuation=True,
-                         with_stress=False,
-                         njobs=1,
-                         punctuation_marks=';:,.!?¡¿—…"«»“”()',
-                         language_switch='remove-flags')
-    phonemes = ''.join([p for p in phonemes if p in phonemes_set])
-    return phonemes
+_punctuation_marks = ';:,.!?¡¿—…"«»“”()'
+
+# Splits a text into words, keeping the separators (whitespace and punctuation) as odd list elements:
+_word_split_re = re.compile(f'([\\s{re.escape(_punctuation_marks)}]+)')
+
+
+def phonemize_texts(texts: List[str], lang: str) -> List[str]:
+    return phonemize(texts,
+                     language=lang,
+                     backend='espeak',
+                     strip=True,
+                     preserve_punctuation=True,
+                     with_stress=False,
+                     njobs=1,
+                     punctuation_marks=_punctuation_marks,
+                     language_switch='remove-flags')
+
+
+class PhonemeCache:
+    """
+    LRU cache of phonemizer outputs for whole texts or single words, optionally persisted to a pickled
+    dictionary file. Only the texts that are not cached yet are sent to the phonemizer, in a single batched call.
+
+    With autosave the file is saved every save_every new entries and at exit. Without autosave (the copies in
+    preprocessing workers) the file is only read and the new entries are collected with pop_new_entries(),
+    so that the parent process can merge them and save the file once.
+    """
+
+    def __init__(self,
+                 max_size: int = 100000,
+                 path: Union[str, Path, None] = None,
+                 save_every: int = 1000,
+                 autosave: bool = True) -> None:
+        self.max_size = max_size
+        self.path = Path(path) if path is not None else None
+        self.save_every = save_every
+        self.autosave = autosave
+        self.lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()
+        self.new_entries: Dict = {}
+        self.num_unsaved = 0
+        if self.path is not None and self.path.is_file():
+            self.entries = OrderedDict(unpickle_binary(self.path))
+        if self.path is not None and self.autosave:
+            atexit.register(self.flush)
+
+    def __call__(self, texts: Iterable[str], lang: str) -> Dict[str, str]:
+        """ Returns the phonemes of the given texts. """
+        texts = set(texts)
+        with self.lock:
+            result = {}
+            for text in texts:
+                phons = self.entries.get((lang, text))
+                if phons is not None:
+                    self.entries.move_to_end((lang, text))
+                    result[text] = phons
+        misses = sorted(texts - result.keys())
+        if len(misses) > 0:
+            phons = phonemize_texts(misses, lang)
+            result.update(zip(misses, phons))
+            with self.lock:
+                new_entries = {(lang, text): text_phons for text, text_phons in zip(misses, phons)}
+                should_save = self._add(new_entries)
+            if should_save:
+                self.save()
+        return result
+
+    def update(self, entries: Dict) -> None:
+        """ Adds entries, e.g. the new entries of a preprocessing worker. """
+        with self.lock:
+            should_save = self._add(entries)
+        if should_save:
+            self.save()
+
+    def pop_new_entries(self) -> Dict:
+        """ Returns and clears the entries added since the last call, only collected without autosave. """
+        with self.lock:
+            new_entries, self.new_entries = self.new_entries, {}
+        return new_entries
+
+    def _add(self, entries: Dict) -> bool:
+        self.entries.update(entries)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        if not self.autosave:
+            self.new_entries.update(entries)
+            return False
+        self.num_unsaved += len(entries)
+        return self.path is not None and self.num_unsaved >= self.save_every
+
+    def __reduce__(self):
+        # in another process (e.g. a preprocessing worker) the cache resolves to a read-only cache of the same file,
+        # the worker returns its new entries to the parent instead of saving the file
+        return get_phoneme_cache, (self.path, False)
+
+    def flush(self) -> None:
+        """ Saves the cache if there are unsaved entries. """
+        if self.num_unsaved > 0:
+            self.save()
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        # keeps the entries that another process has saved in the meantime, the own entries are more recent
+        disk_entries = unpickle_binary(self.path) if self.path.is_file() else {}
+        with self.lock:
+            entries = OrderedDict((key, val) for key, val in disk_entries.items() if key not in self.entries)
+            entries.update(self.entries)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+            self.entries = entries
+            entries = dict(entries)
+            self.num_unsaved = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        pickle_binary(entries, tmp_path)
+        os.replace(tmp_path, self.path)
+
+
+_phoneme_caches: Dict[Tuple[Optional[str], bool], PhonemeCache] = {}
+_phoneme_caches_lock = threading.Lock()
+
+
+def get_phoneme_cache(path: Union[str, Path, None] = None, autosave: bool = True) -> PhonemeCache:
+    """ Returns the phoneme cache shared by all cleaners that use the same cache file. """
+    key = (str(path) if path is not None else None, autosave)
+    with _phoneme_caches_lock:
+        if key not in _phoneme_caches:
+            _phoneme_caches[key] = PhonemeCache(path=path, autosave=autosave)
+        return _phoneme_caches[key]
+
+
+def to_phonemes_batch(texts: List[str],
+                      lang: str,
+                      cache: PhonemeCache = None,
+                      cache_words: bool = False) -> List[str]:
+    """
+    Phonemizes several texts with a single phonemizer call for all texts missing in the cache. By default whole
+    texts are cached, with cache_words the texts are split into words, which gives more cache hits but loses
+    the sentence context of espeak (e.g. stress and liaison), so the phonemes can differ.
+    """
+    cache = cache if cache is not None else get_phoneme_cache()
+    out = []
+    if cache_words:
+        splits = [_word_split_re.split(text) for text in texts]
+        words = {word for split in splits for word in split[::2] if word}
+        word_phonemes = cache(words, lang)
+        for split in splits:
+            out.append(''.join(word_phonemes[part] if i % 2 == 0 and part else part for i, part in enumerate(split)))
+    else:
+        text_phonemes = cache((text for text in texts if text), lang)
+        out = [text_phonemes[text] if text else text for text in texts]
+    return [''.join([p for p in phonemes if p in phonemes_set]) for phonemes in out]
+
+
+def to_phonemes(text: str, lang: str, cache: PhonemeCache = None, cache_words: bool = False) -> str:
+    return to_phonemes_batch([text], lang, cache, cache_words)[0]
 
 
 class Cleaner:
@@ -72,7 +223,9 @@ class Cleaner:
     def __init__(self,
                  cleaner_name: str,
                  use_phonemes: bool,
-                 lang: str) -> None:
+                 lang: str,
+                 phoneme_cache: PhonemeCache = None,
+                 cache_words: bool = False) -> None:
         if cleaner_name == 'english_cleaners':
             self.clean_func = english_cleaners
         elif cleaner_name == 'no_cleaners':
@@ -82,20 +235,27 @@ class Cleaner:
                              f'Currently supported: [\'english_cleaners\', \'no_cleaners\']')
         self.use_phonemes = use_phonemes
         self.lang = lang
+        self.phoneme_cache = phoneme_cache if phoneme_cache is not None else get_phoneme_cache()
+        self.cache_words = cache_words
 
     def __call__(self, text: str) -> str:
-        text = self.clean_func(text)
+        return self.clean_batch([text])[0]
+
+    def clean_batch(self, texts: List[str]) -> List[str]:
+        """ Cleans several texts, the texts missing in the phoneme cache are phonemized in a single call. """
+        texts = [self.clean_func(text) for text in texts]
         if self.use_phonemes:
-            text = to_phonemes(text, self.lang)
-        text = collapse_whitespace(text)
-        text = text.strip()
-        return text
+            texts = to_phonemes_batch(texts, self.lang, self.phoneme_cache, self.cache_words)
+        texts = [collapse_whitespace(text).strip() for text in texts]
+        return texts
 
     @classmethod
     def from_config(cls, config: Dict[str, Any]) -> 'Cleaner':
         return Cleaner(
             cleaner_name=config['preprocessing']['cleaner_name'],
             use_phonemes=config['preprocessing']['use_phonemes'],
-            lang=config['preprocessing']['language']
+            lang=config['preprocessing']['language'],
+            phoneme_cache=get_phoneme_cache(config['preprocessing'].get('phoneme_cache_path')),
+            cache_words=config['preprocessing'].get('phoneme_cache_words', False)
         )
 
@@ -0,0 +1,45 @@
+import re
+from typing import List
+
+_whitespace_re = re.compile(r'\s+')
+
+# sentence ends: terminal punctuation (optionally followed by closing quotes or brackets) and whitespace
+_sentence_end_re = re.compile(r'([.!?…;:]["”»)]*)\s+')
+
+# clause ends that can be used to break up sentences that are too long
+_clause_end_re = re.compile(r'(?<=[,—])\s+')
+
+
+def _split_at(text: str, regex: re.Pattern, max_chars: int) -> List[str]:
+    """ Splits the text at the matches of the regex and greedily merges the parts up to max_chars. """
+    parts = [p for p in regex.split(text) if p]
+    chunks = []
+    for part in parts:
+        if len(chunks) > 0 and len(chunks[-1]) + len(part) + 1 <= max_chars:
+            chunks[-1] = f'{chunks[-1]} {part}'
+        else:
+            chunks.append(part)
+    return chunks
+
+
+def split_sentences(text: str, max_chars: int = 300) -> List[str]:
+    """
+    Splits a (cleaned) text into sentences. Sentences longer than max_chars are split further at clause
+    boundaries (commas, dashes) and, if still too long, at whitespace, so that every part stays below
+    max_chars unless it contains a single longer word.
+    """
+    text = _whitespace_re.sub(' ', text).strip()
+    sentences = []
+    for sentence in _sentence_end_re.sub('\\1\n', text).split('\n'):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(sentence) <= max_chars:
+            sentences.append(sentence)
+            continue
+        for clause in _split_at(sentence, _clause_end_re, max_chars):
+            if len(clause) <= max_chars:
+                sentences.append(clause)
+            else:
+                sentences.extend(_split_at(clause, _whitespace_re, max_chars))
+    return sentences